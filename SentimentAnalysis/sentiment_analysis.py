@@ -9,14 +9,41 @@ but relies on tweet_processing to handle the cleanup of the tweets. Analysis is
 done using Naive Bayes.
 
 '''
+import os
+import sys
+import json
+import argparse
+import mmap
+import heapq
+import shutil
+import bisect
+import time
+import struct
 import random
+import tempfile
+import tracemalloc
+from array import array
+from itertools import repeat
+from hashlib import blake2b
+from functools import partial, lru_cache
+from multiprocessing import Pool
 import tweet_processor as tp
 import numpy as np
-from openai import OpenAI
+from typing import TYPE_CHECKING
 
-client = OpenAI()
+# the OpenAI client is only made in main, so a process that just loads a
+# saved model and scores tweets doesn't import openai or need an API key
+if TYPE_CHECKING:
+    from openai import OpenAI
 
-def get_llm_response(client : OpenAI, prompt : str) -> str:
+# resource is Unix only, without it the number of open files is assumed to
+# be the smallest common limit
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def get_llm_response(client : 'OpenAI', prompt : str) -> str:
     """ This function obtains the client response
 
     Parameters:
@@ -39,9 +66,9 @@ def get_llm_response(client : OpenAI, prompt : str) -> str:
 def partition_training_and_test_sets(pos_tweets : list[str],
                                      neg_tweets : list[str], 
                                      split : float = .8) -> tuple[list[str], 
-                                                                  np.ndarray[float], 
+                                                                  np.ndarray[np.int8], 
                                                                   list[str], 
-                                                                  np.ndarray[float], 
+                                                                  np.ndarray[np.int8], 
                                                                   int, int, int, int]:
     '''
     Partition our sets of tweets into positive and negative tweets based
@@ -79,9 +106,10 @@ def partition_training_and_test_sets(pos_tweets : list[str],
     test_x = test_pos + test_neg
 
     # our labels are 1 for positive, 0 for negative, so we'll create
-    # arrays of 1s and 0s for the training and test sets
-    train_y = np.append(np.ones(len(pos_x)), np.zeros(len(neg_x)))
-    test_y = np.append(np.ones(len(test_pos)), np.zeros(len(test_neg)))
+    # arrays of 1s and 0s for the training and test sets, as int8 since
+    # that's all a label needs
+    train_y = np.append(np.ones(len(pos_x), dtype=np.int8), np.zeros(len(neg_x), dtype=np.int8))
+    test_y = np.append(np.ones(len(test_pos), dtype=np.int8), np.zeros(len(test_neg), dtype=np.int8))
 
     pos_test_size = len(pos_tweets) - pos_train_size
     neg_test_size = len(neg_tweets) - neg_train_size
@@ -100,7 +128,7 @@ def build_word_freq_dict(tweets : list[list[str]], labels : np.ndarray[int]) ->
     see freqs[('happi', 0)] = 3.
 
     Parameters: 
-    tweets -- A list of strings, each a tweet
+    tweets -- A list of tweets, each a list of tokens or an array of token ids
     labels -- A list of integers either 0 or 1 for negative or positive classes
 
     Note that the number of tweets and labels must match. 
@@ -141,6 +169,1237 @@ def test_word_freq_dict(tweets, labels):
     print(f'test of word frequency: {build_word_freq_dict(tweets, labels)}')
 
 
+# checks labels before anything is counted, so bad labels change nothing
+def check_labels(labels : np.ndarray, num_tweets : int) -> np.ndarray:
+    '''
+    Check there's a label of 0 or 1 for each of num_tweets tweets.
+
+    Returns: the labels as an int8 array
+    '''
+    labels = np.asarray(labels)
+    if len(labels) != num_tweets:
+        raise ValueError(f'{num_tweets} tweets but {len(labels)} labels')
+    if ((labels != 0) & (labels != 1)).any():
+        raise ValueError('labels must be 0 or 1')
+    return labels.astype(np.int8)
+
+# the word frequencies of build_word_freq_dict, as one array of counts
+class WordFreqTable:
+    '''
+    The (word, label) frequencies of build_word_freq_dict for tweets of
+    token ids, kept in a 2 x V integer array: counts[label, id] is the
+    number of times the token was seen in tweets with that label. Counting
+    is a single bincount and the totals and likelihoods are sums over the
+    array, and the table takes 16 bytes per token id whatever the size of
+    the corpus. counts is a view of the start of a larger array that
+    doubles when it runs out of room, so adding tweets with new token ids
+    doesn't copy the whole table each time.
+    '''
+
+    def __init__(self, counts : np.ndarray = None):
+        '''
+        Parameters:
+          counts -- a 2 x V array of counts to start from, empty if not given
+        '''
+        if counts is None:
+            counts = np.zeros((2, 0), dtype=np.int64)
+        counts = np.asarray(counts, dtype=np.int64)
+        if counts.ndim != 2 or counts.shape[0] != 2:
+            raise ValueError('counts must be a 2 x V array')
+        self._buffer = counts
+        self._size = counts.shape[1]
+
+    @property
+    def counts(self) -> np.ndarray:
+        '''
+        The 2 x V array of counts.
+        '''
+        return self._buffer[:, :self._size]
+
+    @classmethod
+    def from_tweets(cls, tweets : 'tp.EncodedTweets', labels : np.ndarray) -> 'WordFreqTable':
+        '''
+        Count the tokens of the tweets, the same counts build_word_freq_dict
+        makes.
+        '''
+        table = cls()
+        table.add(tweets, labels)
+        return table
+
+    def add(self, tweets : 'tp.EncodedTweets', labels : np.ndarray,
+            chunk_size : int = 1 << 18) -> None:
+        '''
+        Add the tokens of more tweets to the counts, growing the table for
+        new token ids.
+
+        Parameters:
+          tweets -- the tweets as EncodedTweets
+          labels -- the label of each tweet, 1 for positive and 0 for negative
+          chunk_size -- the number of tweets counted at a time, which bounds
+            the temporary arrays on a large corpus
+        '''
+        labels = check_labels(labels, len(tweets))
+
+        for start in range(0, len(tweets), chunk_size):
+            chunk = tweets[start:start + chunk_size]
+            if chunk.offsets[0] == chunk.offsets[-1]:
+                continue
+            # each token counts at 2 * id + label, so one bincount fills both rows
+            keys = chunk.ids[chunk.offsets[0]:chunk.offsets[-1]].astype(np.int64)
+            keys *= 2
+            keys += np.repeat(labels[start:start + chunk_size], chunk.lengths())
+            size = int(keys.max()) // 2 + 1
+            self._grow(size)
+            if len(keys) < size:
+                # fewer tokens than ids, as in a partial_fit batch: count
+                # just the keys present instead of a bincount over every id
+                keys, key_counts = np.unique(keys, return_counts=True)
+                self._buffer[keys & 1, keys >> 1] += key_counts
+            else:
+                self.counts[:, :size] += np.bincount(keys, minlength=2 * size).reshape(size, 2).T
+
+    def merge(self, other : 'WordFreqTable') -> 'WordFreqTable':
+        '''
+        Add the counts of another table to this one, as if its tweets had
+        been added here, and return this table.
+        '''
+        self._grow(other.counts.shape[1])
+        self.counts[:, :other.counts.shape[1]] += other.counts
+        return self
+
+    def _grow(self, size : int) -> None:
+        '''
+        Make room for token ids below size.
+        '''
+        if size > self._buffer.shape[1]:
+            buffer = np.zeros((2, max(size, 2 * self._buffer.shape[1])), dtype=np.int64)
+            buffer[:, :self._size] = self.counts
+            self._buffer = buffer
+        self._size = max(self._size, size)
+
+    def __len__(self) -> int:
+        '''
+        The number of (word, label) pairs seen, the length of the
+        dictionary build_word_freq_dict would make.
+        '''
+        return int(np.count_nonzero(self.counts))
+
+    def get(self, token_id : int, label : int) -> int:
+        '''
+        Return the count of a token in one class, 0 if it wasn't seen.
+        '''
+        return int(self.counts[label, token_id]) if token_id < self.counts.shape[1] else 0
+
+    def seen(self) -> np.ndarray:
+        '''
+        Return a boolean array marking the token ids that were seen.
+        '''
+        return self.counts.any(axis=0)
+
+    def vocab_size(self) -> int:
+        '''
+        Return the number of distinct tokens seen, the size of the vocab
+        set build_word_freq_dict returns.
+        '''
+        return int(np.count_nonzero(self.seen()))
+
+    def count_pos_neg(self) -> tuple[int, int]:
+        '''
+        Same as count_pos_neg: the total number of positive and of
+        negative events.
+        '''
+        num_neg, num_pos = self.counts.sum(axis=1)
+        return int(num_pos), int(num_neg)
+
+    def loglikelihood(self) -> np.ndarray:
+        '''
+        Same as build_loglikelihood_dict: the Laplacian smoothed
+        log-likelihood of each token id, with 0 for ids that weren't seen.
+        '''
+        freq_neg, freq_pos = self.counts
+        seen = self.seen()
+        vocab_size = np.count_nonzero(seen)
+        num_pos, num_neg = self.count_pos_neg()
+        loglikelihood = (np.log((freq_pos + 1) / (num_pos + vocab_size))
+                         - np.log((freq_neg + 1) / (num_neg + vocab_size)))
+        return np.where(seen, loglikelihood, 0.0)
+
+    def to_dict(self) -> dict[(int, int), int]:
+        '''
+        Return the counts as the dictionary build_word_freq_dict makes.
+        '''
+        labels, token_ids = np.nonzero(self.counts)
+        return {(int(token_id), int(label)): int(self.counts[label, token_id])
+                for label, token_id in zip(labels, token_ids)}
+
+    def nbytes(self) -> int:
+        return self._buffer.nbytes
+
+
+def test_word_freq_table(tweets : 'tp.EncodedTweets', labels : np.ndarray) -> bool:
+    '''
+    Check that a WordFreqTable has the same counts, totals and
+    log-likelihoods as build_word_freq_dict, count_pos_neg and
+    build_loglikelihood_dict.
+    '''
+    freqs, vocab = build_word_freq_dict(tweets, labels)
+    num_pos, num_neg = count_pos_neg(freqs)
+    log_likelihood = build_loglikelihood_dict(freqs, num_pos, num_neg, vocab)
+    table = WordFreqTable.from_tweets(tweets, labels)
+
+    loglikelihood = table.loglikelihood()
+    same = (table.to_dict() == {(int(word), int(label)): count for (word, label), count in freqs.items()}
+            and table.vocab_size() == len(vocab)
+            and table.count_pos_neg() == (num_pos, num_neg)
+            and all(np.isclose(loglikelihood[word], value) for word, value in log_likelihood.items()))
+    print(f'word frequency table matches the dictionary: {same}')
+    return same
+
+def make_synthetic_tweets(num_tweets : int, vocab_size : int, seed : int = 0) -> tuple['tp.EncodedTweets', np.ndarray]:
+    '''
+    Make random tweets of token ids with a zipf-like word distribution and
+    1 to 12 tokens each, along with random int8 labels, for benchmarks.
+    '''
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, 13, size=num_tweets)
+    offsets = np.zeros(num_tweets + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    ids = ((rng.zipf(1.3, size=int(offsets[-1])) - 1) % vocab_size).astype(np.int32)
+    labels = rng.integers(0, 2, size=num_tweets, dtype=np.int8)
+    return tp.EncodedTweets(ids, offsets), labels
+
+def benchmark_word_freq(num_tweets : int = 10_000_000, vocab_size : int = 100_000,
+                        seed : int = 0) -> None:
+    '''
+    Time building the word frequencies, totals and log-likelihoods of
+    num_tweets synthetic tweets with build_word_freq_dict (labels as
+    float64, as they used to be) and with WordFreqTable, and compare the
+    memory of the two results. The peak memory of building the table is
+    traced too, tracing the dictionary would slow it down too much.
+    '''
+    tweets, labels = make_synthetic_tweets(num_tweets, vocab_size, seed)
+    print(f'{num_tweets} tweets, {len(tweets.ids)} tokens')
+
+    start = time.perf_counter()
+    table = WordFreqTable.from_tweets(tweets, labels)
+    num_pos, num_neg = table.count_pos_neg()
+    table.loglikelihood()
+    table_time = time.perf_counter() - start
+    tracemalloc.start()
+    WordFreqTable.from_tweets(tweets, labels)
+    table_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f'WordFreqTable: {table_time:.2f}s, table {table.nbytes() / (1 << 20):.1f} MB, '
+          f'peak while counting {table_peak / (1 << 20):.1f} MB')
+
+    float_labels = labels.astype(np.float64)
+    start = time.perf_counter()
+    freqs, vocab = build_word_freq_dict(tweets, float_labels)
+    num_pos, num_neg = count_pos_neg(freqs)
+    build_loglikelihood_dict(freqs, num_pos, num_neg, vocab)
+    dict_time = time.perf_counter() - start
+    # the dictionary, its tuple keys, the numpy scalars in them and the counts
+    dict_size = sys.getsizeof(freqs) + sum(sys.getsizeof(key) + sys.getsizeof(key[0]) + sys.getsizeof(key[1])
+                                           + sys.getsizeof(count) for key, count in freqs.items())
+    print(f'build_word_freq_dict: {dict_time:.2f}s, dictionary {dict_size / (1 << 20):.1f} MB')
+    print(f'labels: {float_labels.nbytes / (1 << 20):.1f} MB as float64, {labels.nbytes / (1 << 20):.1f} MB as int8')
+    print(f'speedup {dict_time / table_time:.0f}x')
+
+
+# the training data of the pool workers counting shards, set once by
+# _init_count_worker so only the bounds of each shard are sent with a task
+_count_state = {}
+
+def _init_count_worker(tweets, labels : np.ndarray) -> None:
+    '''
+    Pool initializer that keeps the tweets and labels for _count_shard.
+    With the fork start method they're inherited, not copied.
+    '''
+    _count_state['tweets'] = tweets
+    _count_state['labels'] = labels
+
+def _count_shard(bounds : tuple[int, int], table : bool):
+    '''
+    Count the tweets from bounds[0] up to bounds[1] inside a pool worker,
+    into a WordFreqTable if table is set and with build_word_freq_dict
+    otherwise.
+    '''
+    start, stop = bounds
+    tweets = _count_state['tweets'][start:stop]
+    labels = _count_state['labels'][start:stop]
+    if table:
+        return WordFreqTable.from_tweets(tweets, labels)
+    freqs, vocab = build_word_freq_dict(tweets, labels)
+    # numpy scalars are slow to pickle, token ids and labels go back to the
+    # parent as the equal python ints
+    if isinstance(tweets, tp.EncodedTweets):
+        vocab = {int(word) for word in vocab}
+    freqs = {(word if isinstance(word, str) else int(word), int(label)): count
+             for (word, label), count in freqs.items()}
+    return freqs, vocab
+
+def shard_bounds(num_tweets : int, shards : int) -> list[tuple[int, int]]:
+    '''
+    Split num_tweets into shards contiguous slices of nearly equal size.
+    '''
+    edges = np.linspace(0, num_tweets, max(1, shards) + 1).astype(int)
+    return [(int(start), int(stop)) for start, stop in zip(edges[:-1], edges[1:])]
+
+def merge_word_freq_dicts(results) -> tuple[dict[(str, int), int], set]:
+    '''
+    Merge the (freqs, vocab) results of build_word_freq_dict on disjoint
+    slices of the tweets, in the order of the slices. The counts are
+    summed, so the result is the same as build_word_freq_dict on all the
+    tweets, down to the order of the keys.
+    '''
+    freqs = {}
+    vocab = set()
+    for shard_freqs, shard_vocab in results:
+        for key, count in shard_freqs.items():
+            freqs[key] = freqs.get(key, 0) + count
+        vocab |= shard_vocab
+    return freqs, vocab
+
+def count_word_freqs_parallel(tweets, labels : np.ndarray, workers : int = None,
+                              shards : int = None, table : bool = False):
+    '''
+    Count word frequencies with a pool of processes: each worker counts a
+    contiguous slice of the tweets into its own dictionary or table, and
+    the results are merged at the end.
+
+    Parameters:
+      tweets -- the training tweets, token lists or EncodedTweets
+      labels -- the label of each tweet
+      workers -- the number of processes, os.cpu_count() if not given
+      shards -- the number of slices, 4 per worker by default so a slow
+        slice doesn't hold up the others
+      table -- count into a WordFreqTable instead of the dictionary of
+        build_word_freq_dict, tweets must then be EncodedTweets
+
+    Returns:
+    The (freqs, vocab) of build_word_freq_dict, equal to the serial build
+    with numpy token ids and labels as python ints, or a WordFreqTable
+    '''
+    workers = workers or os.cpu_count() or 1
+    bounds = shard_bounds(len(tweets), shards or 4 * workers)
+    with Pool(workers, initializer=_init_count_worker, initargs=(tweets, labels)) as pool:
+        # imap keeps the slices in order, which keeps the dictionary keys
+        # in the order a serial build adds them
+        results = pool.imap(partial(_count_shard, table=table), bounds)
+        if table:
+            merged = WordFreqTable()
+            for shard_table in results:
+                merged.merge(shard_table)
+            return merged
+        return merge_word_freq_dicts(results)
+
+def benchmark_parallel_word_freq(num_tweets : int = 2_000_000, vocab_size : int = 100_000,
+                                 max_workers : int = None, seed : int = 0) -> list[dict]:
+    '''
+    Scaling report for count_word_freqs_parallel: count num_tweets
+    synthetic tweets with 1, 2, 4, ... up to max_workers processes, for
+    both the dictionary and the table, checking every result against the
+    serial build and printing the speedup and efficiency of each.
+
+    Returns: a dictionary of timings for each run
+    '''
+    max_workers = max_workers or os.cpu_count() or 1
+    tweets, labels = make_synthetic_tweets(num_tweets, vocab_size, seed)
+    print(f'{num_tweets} tweets, {len(tweets.ids)} tokens, {os.cpu_count()} cpus')
+
+    start = time.perf_counter()
+    serial_dict = build_word_freq_dict(tweets, labels)
+    serial_times = {False: time.perf_counter() - start}
+    start = time.perf_counter()
+    serial_table = WordFreqTable.from_tweets(tweets, labels)
+    serial_times[True] = time.perf_counter() - start
+
+    counts = sorted({2 ** power for power in range(max_workers.bit_length())} | {max_workers})
+    report = []
+    for table in (False, True):
+        name = 'WordFreqTable' if table else 'build_word_freq_dict'
+        print(f'{name}: serial {serial_times[table]:.2f}s')
+        for workers in counts:
+            start = time.perf_counter()
+            result = count_word_freqs_parallel(tweets, labels, workers, table=table)
+            elapsed = time.perf_counter() - start
+            if table:
+                same = np.array_equal(result.counts, serial_table.counts)
+            else:
+                same = result == serial_dict and list(result[0]) == list(serial_dict[0])
+            speedup = serial_times[table] / elapsed
+            print(f'  {workers:3d} workers: {elapsed:.2f}s, speedup {speedup:.2f}x, '
+                  f'efficiency {speedup / workers:.0%}, same as serial: {same}')
+            report.append({'table': table, 'workers': workers, 'seconds': elapsed,
+                           'serial_seconds': serial_times[table], 'same': same})
+    return report
+
+
+# the word counts of one shard of the training data, in a form that can be
+# written out, sent to another machine and merged with other shards
+class WordFreqSummary:
+    '''
+    The (word, label) counts of some labelled tweets, keyed by the token
+    strings instead of ids so that summaries made on different machines,
+    each with its own Vocabulary, can be merged. tokens is sorted and
+    counts[label, i] is the count of tokens[i], so the summary of a set of
+    tweets is the same however it was put together, and merging is
+    associative and commutative: summaries can be merged in any order or
+    grouping, in a tree or one at a time as they arrive.
+
+    The tokens are kept as their utf-8 bytes end to end in token_bytes,
+    with token i at token_offsets[i]:token_offsets[i + 1], so a long token
+    doesn't widen every other one. Sorting by the utf-8 bytes gives the
+    same order as sorting the strings.
+
+    The pipeline config the tweets were processed with is kept too, and
+    summaries with different configs can't be merged, since their tokens
+    don't mean the same thing.
+    '''
+
+    # format version of the saved file
+    VERSION = 2
+
+    def __init__(self, tokens = (), counts : np.ndarray = None, config : str = None):
+        '''
+        Parameters:
+          tokens -- the sorted, distinct tokens, as strings
+          counts -- a 2 x len(tokens) array of counts
+          config -- the json of the tweet_processor PIPELINE_CONFIG the
+            tokens come from, the current one if not given
+        '''
+        encoded = [token.encode('utf-8') for token in tokens]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(token) for token in encoded], out=offsets[1:])
+        self._set(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets, counts, config)
+
+    def _set(self, token_bytes : np.ndarray, token_offsets : np.ndarray,
+             counts : np.ndarray, config : str) -> None:
+        self.token_bytes = token_bytes
+        self.token_offsets = token_offsets
+        if counts is None:
+            counts = np.zeros((2, len(self)), dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        if self.counts.shape != (2, len(self)):
+            raise ValueError(f'counts must be a 2 x {len(self)} array')
+        if len(token_offsets) == 0 or token_offsets[-1] != len(token_bytes):
+            raise ValueError('the token offsets don\'t match the token bytes')
+        self.config = config if config is not None else json.dumps(tp.PIPELINE_CONFIG, sort_keys=True)
+
+    @classmethod
+    def from_encoded(cls, token_bytes, token_offsets, counts : np.ndarray,
+                     config : str = None) -> 'WordFreqSummary':
+        '''
+        Make a summary from tokens that are already utf-8 encoded end to
+        end, in sorted order, with the offset where each one starts and
+        a final offset for the end.
+        '''
+        summary = cls.__new__(cls)
+        summary._set(np.frombuffer(token_bytes, dtype=np.uint8),
+                     np.asarray(token_offsets, dtype=np.int64), counts, config)
+        return summary
+
+    @classmethod
+    def from_table(cls, table : WordFreqTable, vocab : 'tp.Vocabulary') -> 'WordFreqSummary':
+        '''
+        Make the summary of a WordFreqTable whose token ids come from vocab.
+        '''
+        token_ids = np.flatnonzero(table.seen())
+        tokens = vocab.decode(token_ids)
+        order = sorted(range(len(tokens)), key=tokens.__getitem__)
+        return cls([tokens[i] for i in order], table.counts[:, token_ids[order]])
+
+    @classmethod
+    def from_tweets(cls, tweets : 'tp.EncodedTweets', labels : np.ndarray,
+                    vocab : 'tp.Vocabulary') -> 'WordFreqSummary':
+        '''
+        Count the tokens of a shard of labelled tweets.
+        '''
+        return cls.from_table(WordFreqTable.from_tweets(tweets, labels), vocab)
+
+    def __len__(self) -> int:
+        return len(self.token_offsets) - 1
+
+    def __eq__(self, other) -> bool:
+        return (isinstance(other, WordFreqSummary) and self.config == other.config
+                and np.array_equal(self.token_offsets, other.token_offsets)
+                and np.array_equal(self.token_bytes, other.token_bytes)
+                and np.array_equal(self.counts, other.counts))
+
+    def _iter_token_bytes(self):
+        '''
+        Yield the utf-8 bytes of each token, in sorted order.
+        '''
+        data = self.token_bytes.tobytes()
+        offsets = self.token_offsets.tolist()
+        for start, stop in zip(offsets, offsets[1:]):
+            yield data[start:stop]
+
+    @property
+    def tokens(self) -> list[str]:
+        '''
+        The tokens decoded to strings, in sorted order.
+        '''
+        return [token.decode('utf-8') for token in self._iter_token_bytes()]
+
+    def to_table(self) -> tuple[WordFreqTable, 'tp.Vocabulary']:
+        '''
+        Return the counts as a WordFreqTable, for NaiveBayesModel.from_table,
+        along with the Vocabulary of its token ids.
+        '''
+        return WordFreqTable(self.counts.copy()), tp.Vocabulary(self.tokens)
+
+    def to_freq_dict(self) -> tuple[dict[(str, int), int], set]:
+        '''
+        Return the (freqs, vocab) build_word_freq_dict would make from all
+        the tweets summarized, ready for count_pos_neg and
+        build_loglikelihood_dict.
+        '''
+        tokens = self.tokens
+        freqs = {}
+        for label in (0, 1):
+            nonzero = np.flatnonzero(self.counts[label]).tolist()
+            freqs.update(zip(((tokens[i], label) for i in nonzero),
+                             self.counts[label, nonzero].tolist()))
+        return freqs, set(tokens)
+
+    def save(self, filename : str) -> None:
+        '''
+        Write the summary to an npz file, renamed into place once it's
+        complete. The tokens are saved as their utf-8 bytes and offsets.
+        '''
+        tmp_name = f'{filename}.tmp'
+        with open(tmp_name, 'wb') as file:
+            np.savez(file, version=np.int64(self.VERSION), config=np.array(self.config),
+                     token_bytes=self.token_bytes, token_offsets=self.token_offsets,
+                     counts=self.counts)
+        os.replace(tmp_name, filename)
+
+    @classmethod
+    def load(cls, filename : str) -> 'WordFreqSummary':
+        '''
+        Read a summary written by save.
+        '''
+        with np.load(filename, allow_pickle=False) as data:
+            version = int(data['version'])
+            if version != cls.VERSION:
+                raise ValueError(f'{filename} is summary version {version}, expected {cls.VERSION}')
+            return cls.from_encoded(data['token_bytes'], data['token_offsets'],
+                                    data['counts'], str(data['config']))
+
+def merge_summaries(summaries) -> WordFreqSummary:
+    '''
+    Merge any number of WordFreqSummary into the summary of all their
+    tweets: the counts of each token are summed across the summaries.
+    Merged summaries can be merged again, with the same result as merging
+    all of the originals at once.
+
+    Raises: ValueError if there are no summaries or their pipeline
+    configs differ
+    '''
+    summaries = list(summaries)
+    if not summaries:
+        raise ValueError('there are no summaries to merge')
+    config = summaries[0].config
+    if any(summary.config != config for summary in summaries):
+        raise ValueError('the summaries were made with different pipeline configs')
+    # each summary's tokens are already sorted by their utf-8 bytes, so a
+    # k-way merge of the byte strings gives the merged tokens in order and
+    # where each summary's tokens went, without decoding any of them
+    token_bytes, token_offsets = bytearray(), array('q', [0])
+    positions = [array('q') for _ in summaries]
+    last = None
+    for token, which in heapq.merge(*(zip(summary._iter_token_bytes(), repeat(which))
+                                      for which, summary in enumerate(summaries))):
+        if token != last:
+            token_bytes += token
+            token_offsets.append(len(token_bytes))
+            last = token
+        positions[which].append(len(token_offsets) - 2)
+    # summed as int64, the counts of a word can be past what a float holds
+    # exactly; a summary has each token once, so its positions are distinct
+    counts = np.zeros((2, len(token_offsets) - 1), dtype=np.int64)
+    for summary, position in zip(summaries, positions):
+        counts[:, np.frombuffer(position, dtype=np.int64)] += summary.counts
+    return WordFreqSummary.from_encoded(bytes(token_bytes), token_offsets, counts, config)
+
+def test_merge_summaries(tweets : 'tp.EncodedTweets', labels : np.ndarray, vocab : 'tp.Vocabulary',
+                         shards : int = 4) -> bool:
+    '''
+    Split the tweets into shards the way separate machines would have
+    them, each encoded with its own Vocabulary, summarize each shard and
+    check that merging the summaries all at once, in a tree, one at a time
+    in reverse and after a save and load, in a temporary directory, all
+    give the summary of the whole set, and that its log-likelihoods, from build_loglikelihood_dict and
+    from NaiveBayesModel.from_table, match build_loglikelihood_dict on all
+    the tweets.
+    '''
+    pieces = []
+    for start, stop in shard_bounds(len(tweets), shards):
+        local_vocab = tp.Vocabulary()
+        local_tweets = tp.EncodedTweets.from_token_lists((vocab.decode(tweet) for tweet in tweets[start:stop]),
+                                                         local_vocab)
+        pieces.append(WordFreqSummary.from_tweets(local_tweets, labels[start:stop], local_vocab))
+
+    whole = WordFreqSummary.from_tweets(tweets, labels, vocab)
+    flat = merge_summaries(pieces)
+    tree = pieces
+    while len(tree) > 1:
+        tree = [merge_summaries(tree[i:i + 2]) for i in range(0, len(tree), 2)]
+    running = pieces[-1]
+    for piece in reversed(pieces[:-1]):
+        running = merge_summaries([piece, running])
+    with tempfile.TemporaryDirectory(prefix='word-freq-summaries-') as summary_dir:
+        names = [os.path.join(summary_dir, f'summary-{i}.npz') for i in range(len(pieces))]
+        for piece, name in zip(pieces, names):
+            piece.save(name)
+        loaded = merge_summaries([WordFreqSummary.load(name) for name in names])
+
+    freqs, words = build_word_freq_dict([vocab.decode(tweet) for tweet in tweets], labels)
+    num_pos, num_neg = count_pos_neg(freqs)
+    expected = build_loglikelihood_dict(freqs, num_pos, num_neg, words)
+    merged_freqs, merged_words = flat.to_freq_dict()
+    merged_pos, merged_neg = count_pos_neg(merged_freqs)
+    loglikelihood = build_loglikelihood_dict(merged_freqs, merged_pos, merged_neg, merged_words)
+    table, merged_vocab = flat.to_table()
+    model = NaiveBayesModel.from_table(table)
+    scores = model.loglikelihood[[merged_vocab.lookup(word) for word in expected]]
+    same = (flat == whole and tree[0] == whole and running == whole and loaded == whole
+            and merged_freqs == freqs and loglikelihood == expected
+            and np.allclose(scores, list(expected.values())))
+    print(f'merged summaries of {len(pieces)} shards match the whole set: {same}')
+    return same
+
+
+# approximate word frequencies in a fixed amount of memory, for training
+# sets whose vocabulary is too wide to count exactly
+class SketchWordFreqs:
+    '''
+    Approximate (word, label) frequencies of tweets of token strings in a
+    fixed amount of memory. The counts of each class are kept in a
+    count-min sketch: a depth x width array of counters, where a word adds
+    its count to one counter of each row, picked by hashing the word, and
+    its count is read back as the smallest of its counters. Other words
+    can share those counters, so a count can be too high but never too low.
+
+    The heavy_hitters most frequent words are kept apart in a small exact
+    table, they're counted exactly from the time they enter it (starting
+    from their sketch estimate, which is 0 for a word seen before the
+    sketch fills up) and don't add to the counters every other word
+    shares. A word that falls out of the table has its counts put back
+    into the sketch. The number of distinct words, the V of the
+    Laplacian smoothing, is estimated with a HyperLogLog, and the total
+    positive and negative events are exact.
+
+    There's no record of which words were seen, so a word that never was
+    gets the estimate of the counters it shares with other words, and only
+    scores 0 when every one of its counters in some row is still 0. The
+    smaller the sketch, the more unseen words get a score.
+
+    log_pos_neg_ratio is an attribute kept up to date by add, as it is on
+    NaiveBayesModel, so either model can be used to score tweets.
+    '''
+
+    def __init__(self, width : int = 1 << 16, depth : int = 4, heavy_hitters : int = 1000,
+                 register_bits : int = 12):
+        '''
+        Parameters:
+          width -- the counters in each row of a sketch
+          depth -- the rows of a sketch, each hashes words differently
+          heavy_hitters -- the number of words counted exactly
+          register_bits -- the HyperLogLog has 2 ** register_bits
+            registers, for an error of about 1.04 / sqrt(registers)
+        '''
+        if width < 1 or depth < 1 or heavy_hitters < 0:
+            raise ValueError('width and depth must be positive and heavy_hitters not negative')
+        self.width = width
+        self.depth = depth
+        self.capacity = heavy_hitters
+        # sketch[label, row, column]
+        self.sketch = np.zeros((2, depth, width), dtype=np.int64)
+        # word -> [negative count, positive count]
+        self.heavy = {}
+        # word -> its 2 x 1 sketch estimate when it entered the table, which
+        # is still in the sketch
+        self._heavy_priors = {}
+        self.registers = np.zeros(1 << register_bits, dtype=np.uint8)
+        self.num_pos = 0
+        self.num_neg = 0
+        self.log_pos_neg_ratio = 0.0
+
+    @classmethod
+    def for_budget(cls, nbytes : int, depth : int = 4, heavy_hitters : int = 1000) -> 'SketchWordFreqs':
+        '''
+        Make the widest sketches that fit in nbytes, the heavy hitter table
+        and the HyperLogLog come on top of that.
+        '''
+        return cls(max(1, nbytes // (2 * depth * 8)), depth, heavy_hitters)
+
+    @staticmethod
+    def _hash(tokens : list[str]) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Hash each token to two 64 bit values, one for the sketch columns
+        and one for the HyperLogLog. blake2b is used since python's own
+        hash of a string changes from one process to the next.
+        '''
+        digests = b''.join(blake2b(token.encode('utf-8'), digest_size=16).digest() for token in tokens)
+        hashes = np.frombuffer(digests, dtype='<u8').reshape(-1, 2)
+        return hashes[:, 0], hashes[:, 1]
+
+    def _columns(self, sketch_hash : np.ndarray) -> np.ndarray:
+        '''
+        Return the depth x n columns of n words, row i uses
+        low + i * high of the two halves of the hash.
+        '''
+        low = sketch_hash & np.uint64(0xffffffff)
+        high = (sketch_hash >> np.uint64(32)) | np.uint64(1)
+        rows = np.arange(self.depth, dtype=np.uint64)[:, None]
+        return ((low + rows * high) % np.uint64(self.width)).astype(np.intp)
+
+    def _sketch_add(self, columns : np.ndarray, counts : np.ndarray) -> None:
+        '''
+        Add the 2 x n counts of words to their columns of every row.
+        '''
+        for label in (0, 1):
+            for row in range(self.depth):
+                np.add.at(self.sketch[label, row], columns[row], counts[label])
+
+    def _sketch_estimate(self, columns : np.ndarray) -> np.ndarray:
+        '''
+        Return the 2 x n estimated counts of words, the smallest counter of
+        each across the rows.
+        '''
+        rows = np.arange(self.depth)[:, None]
+        return self.sketch[:, rows, columns].min(axis=1)
+
+    def _count_distinct(self, distinct_hash : np.ndarray) -> None:
+        '''
+        Add hashed words to the HyperLogLog: the top bits of the hash pick
+        a register, which keeps the highest rank (position of the first 1
+        bit) seen in the rest of the hash.
+        '''
+        bits = len(self.registers).bit_length() - 1
+        index = (distinct_hash >> np.uint64(64 - bits)).astype(np.intp)
+        rest = distinct_hash & np.uint64((1 << (64 - bits)) - 1)
+        # the exponent of frexp is the bit length of rest, 0 when rest is 0
+        rank = (64 - bits) - np.frexp(rest.astype(np.float64))[1] + 1
+        np.maximum.at(self.registers, index, rank.astype(np.uint8))
+
+    def add(self, tweets : list[list[str]], labels : np.ndarray, batch_size : int = 10000) -> None:
+        '''
+        Count the tokens of more tweets. Each batch is counted exactly with
+        build_word_freq_dict first, so a word is hashed once per batch
+        however often it appears in it.
+
+        Parameters:
+          tweets -- the tweets as lists of tokens
+          labels -- the label of each tweet, 1 for positive and 0 for negative
+          batch_size -- the number of tweets counted at a time
+        '''
+        labels = np.asarray(labels)
+        if len(labels) != len(tweets):
+            raise ValueError(f'{len(tweets)} tweets but {len(labels)} labels')
+        if ((labels != 0) & (labels != 1)).any():
+            raise ValueError('labels must be 0 or 1')
+
+        for start in range(0, len(tweets), batch_size):
+            freqs, _ = build_word_freq_dict(tweets[start:start + batch_size],
+                                            labels[start:start + batch_size].astype(int).tolist())
+            num_pos, num_neg = count_pos_neg(freqs)
+            self.num_pos += num_pos
+            self.num_neg += num_neg
+            # infinite while only one class has been seen, as in NaiveBayesModel
+            with np.errstate(divide='ignore', invalid='ignore'):
+                self.log_pos_neg_ratio = np.log(self.num_pos) - np.log(self.num_neg)
+            batch = {}
+            for (token, label), count in freqs.items():
+                batch.setdefault(token, [0, 0])[label] += count
+            if not batch:
+                continue
+            tokens = list(batch)
+            counts = np.array(list(batch.values()), dtype=np.int64).T
+            sketch_hash, distinct_hash = self._hash(tokens)
+            self._count_distinct(distinct_hash)
+
+            heavy = self.heavy
+            in_heavy = np.array([token in heavy for token in tokens])
+            for i in np.flatnonzero(in_heavy):
+                counted = heavy[tokens[i]]
+                counted[0] += int(counts[0, i])
+                counted[1] += int(counts[1, i])
+            rest = np.flatnonzero(~in_heavy)
+            self._update_heavy([tokens[i] for i in rest], self._columns(sketch_hash[rest]), counts[:, rest])
+
+    def _update_heavy(self, candidates : list[str], columns : np.ndarray, counts : np.ndarray) -> None:
+        '''
+        Count a batch of words that aren't heavy hitters. Each candidate's
+        total is its sketch estimate from before the batch plus its exact
+        count in the batch, and the capacity words with the largest totals
+        among the heavy hitters and the candidates make up the new table.
+        The current heavy hitters win ties, so the table doesn't churn.
+        Candidates that make it into the table start from their total, the
+        rest have their batch counts added to the sketch, and heavy hitters
+        that drop out have what they counted in the table added to the
+        sketch, their estimate from before is still in it.
+        '''
+        heavy_tokens = list(self.heavy)
+        heavy_counts = np.array(list(self.heavy.values()), dtype=np.int64).reshape(-1, 2).T
+        priors = self._sketch_estimate(columns)
+        estimates = priors + counts
+        totals = np.concatenate((heavy_counts.sum(axis=0), estimates.sum(axis=0)))
+        kept = np.zeros(len(totals), dtype=bool)
+        kept[np.argsort(-totals, kind='stable')[:self.capacity]] = True
+
+        evicted = np.flatnonzero(~kept[:len(heavy_tokens)])
+        if len(evicted):
+            evicted_tokens = [heavy_tokens[i] for i in evicted]
+            evicted_priors = np.column_stack([self._heavy_priors.pop(token) for token in evicted_tokens])
+            self._sketch_add(self._columns(self._hash(evicted_tokens)[0]),
+                             heavy_counts[:, evicted] - evicted_priors)
+            for token in evicted_tokens:
+                del self.heavy[token]
+        admitted = kept[len(heavy_tokens):]
+        for i in np.flatnonzero(admitted):
+            self.heavy[candidates[i]] = estimates[:, i].tolist()
+            self._heavy_priors[candidates[i]] = priors[:, i].tolist()
+        self._sketch_add(columns[:, ~admitted], counts[:, ~admitted])
+
+    def counts(self, tokens : list[str]) -> np.ndarray:
+        '''
+        Return the 2 x n (negative, positive) counts of tokens, exact for
+        the heavy hitters and estimated for the rest.
+        '''
+        counts = np.zeros((2, len(tokens)), dtype=np.int64)
+        heavy = [i for i, token in enumerate(tokens) if token in self.heavy]
+        rest = [i for i, token in enumerate(tokens) if token not in self.heavy]
+        if heavy:
+            counts[:, heavy] = np.array([self.heavy[tokens[i]] for i in heavy], dtype=np.int64).T
+        if rest:
+            counts[:, rest] = self._sketch_estimate(self._columns(self._hash([tokens[i] for i in rest])[0]))
+        return counts
+
+    def count_pos_neg(self) -> tuple[int, int]:
+        '''
+        Same as count_pos_neg, these totals are exact.
+        '''
+        return self.num_pos, self.num_neg
+
+    def vocab_size(self) -> int:
+        '''
+        Estimate the number of distinct words seen from the HyperLogLog,
+        switching to linear counting while many registers are still empty.
+        '''
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / np.sum(np.ldexp(1.0, -self.registers.astype(int)))
+        empty = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * size and empty:
+            estimate = size * np.log(size / empty)
+        return int(round(estimate))
+
+    def loglikelihood(self, tokens : list[str]) -> np.ndarray:
+        '''
+        Same as build_loglikelihood_dict for the given tokens, with 0 for
+        tokens whose estimated counts are 0. An unseen token can have
+        counts estimated from other words in its counters, and scores as if
+        it had been seen that often.
+        '''
+        freq_neg, freq_pos = self.counts(tokens)
+        vocab_size = self.vocab_size()
+        loglikelihood = (np.log((freq_pos + 1) / (self.num_pos + vocab_size))
+                         - np.log((freq_neg + 1) / (self.num_neg + vocab_size)))
+        return np.where((freq_pos > 0) | (freq_neg > 0), loglikelihood, 0.0)
+
+    def predict_batch(self, tweets : list[list[str]]) -> np.ndarray:
+        '''
+        Same as naive_bayes_predict for every tweet, each distinct token is
+        looked up once.
+        '''
+        vocab = tp.Vocabulary()
+        encoded = tp.EncodedTweets.from_token_lists(tweets, vocab)
+        scores = self.loglikelihood(vocab.tokens)
+        owner = np.repeat(np.arange(len(encoded)), encoded.lengths())
+        return self.log_pos_neg_ratio + np.bincount(owner, weights=scores[encoded.ids], minlength=len(encoded))
+
+    def predict(self, tweet : list[str]) -> float:
+        return float(self.predict_batch([tweet])[0])
+
+    def nbytes(self) -> int:
+        '''
+        Return the memory used by the sketches, the HyperLogLog and the
+        heavy hitter table with its words, counts and priors.
+        '''
+        table = sys.getsizeof(self.heavy) + sys.getsizeof(self._heavy_priors)
+        for token, counts in self.heavy.items():
+            prior = self._heavy_priors[token]
+            table += (sys.getsizeof(token) + sys.getsizeof(counts) + sys.getsizeof(prior)
+                      + sum(sys.getsizeof(count) for count in counts + prior))
+        return self.sketch.nbytes + self.registers.nbytes + table
+
+
+def build_word_freq_sketch(tweets : list[list[str]], labels : np.ndarray, nbytes : int,
+                           heavy_hitters : int = 1000) -> SketchWordFreqs:
+    '''
+    The bounded memory version of build_word_freq_dict: count the tweets
+    in sketches of nbytes plus a table of heavy_hitters exact counts.
+    '''
+    freqs = SketchWordFreqs.for_budget(nbytes, heavy_hitters=heavy_hitters)
+    freqs.add(tweets, labels)
+    return freqs
+
+def report_sketch_accuracy(pos_name : str = 'SentimentAnalysis/positive_tweets.json',
+                           neg_name : str = 'SentimentAnalysis/negative_tweets.json',
+                           stopwords_name : str = 'TweetProcessor/english_stopwords.txt',
+                           budgets : tuple[int] = (1 << 10, 1 << 12, 1 << 14, 1 << 16, 1 << 18, 1 << 20),
+                           heavy_hitters : tuple[int] = (0, 100, 1000)) -> list[dict]:
+    '''
+    Train exact Naive Bayes with the dictionaries and approximate Naive
+    Bayes with SketchWordFreqs at each memory budget and heavy hitter
+    table size on the same split as main, and print the test accuracy of
+    each, how often it agrees with the exact model and the memory used.
+
+    Returns: a dictionary of results for each budget and table size
+    '''
+    pos_tweets, neg_tweets, _, pos_raw, neg_raw = tp.process_tweets(pos_name, neg_name, stopwords_name)
+    pos_raw.close()
+    neg_raw.close()
+    train_x, train_y, test_x, test_y, *_ = partition_training_and_test_sets(pos_tweets, neg_tweets)
+
+    freqs, vocab = build_word_freq_dict(train_x, train_y.astype(int).tolist())
+    num_pos, num_neg = count_pos_neg(freqs)
+    log_likelihood = build_loglikelihood_dict(freqs, num_pos, num_neg, vocab)
+    exact = np.array([naive_bayes_predict(log_likelihood, np.log(num_pos / num_neg), tweet) for tweet in test_x])
+    exact_accuracy = np.mean((exact > 0) == (test_y == 1))
+    dict_size = sys.getsizeof(freqs) + sum(sys.getsizeof(key) + sys.getsizeof(key[0]) + sys.getsizeof(count)
+                                           for key, count in freqs.items())
+    print(f'exact: accuracy {exact_accuracy:.4f}, {len(vocab)} words, '
+          f'freqs dictionary {dict_size / 1024:.0f} KB')
+
+    report = []
+    for budget in budgets:
+        for table_size in heavy_hitters:
+            sketch = build_word_freq_sketch(train_x, train_y, budget, table_size)
+            scores = sketch.predict_batch(test_x)
+            accuracy = np.mean((scores > 0) == (test_y == 1))
+            agreement = np.mean((scores > 0) == (exact > 0))
+            print(f'sketch {budget / 1024:6.0f} KB, {table_size:4d} heavy hitters: accuracy {accuracy:.4f} '
+                  f'({accuracy - exact_accuracy:+.4f}), agrees with exact {agreement:.2%}, '
+                  f'estimated vocab {sketch.vocab_size()}, total {sketch.nbytes() / 1024:.0f} KB')
+            report.append({'budget': budget, 'heavy_hitters': table_size, 'accuracy': accuracy,
+                           'exact_accuracy': exact_accuracy, 'agreement': agreement,
+                           'nbytes': sketch.nbytes()})
+    return report
+
+
+# exact word frequencies of a corpus too large to count in memory
+class ExternalWordFreqs:
+    '''
+    Exact (word, label) frequencies of a stream of tweets of token strings
+    in a bounded amount of memory. Words are counted in a dictionary until
+    its estimated size reaches half of memory_limit, then the counts are
+    sorted by word and spilled to a run file in run_dir and the dictionary
+    starts over. Reading the counts back merges the sorted runs, summing the
+    counts of a word across them, so the result is the same as
+    build_word_freq_dict on the whole stream.
+
+    A run is a sequence of records, each the utf-8 length of the word, its
+    negative and its positive count as a '<Iqq' struct, then the word.
+    Each run being merged has a read buffer of buffer_size, and runs are
+    merged a few at a time as they're spilled so there are never more
+    than a handful to merge at the end. No more runs are merged at once
+    than fit in the open file limit; with more than that left at the end
+    they're merged in passes.
+
+    The memory used is the dictionary, up to half of memory_limit, plus
+    the sorted word list and write buffer of a spill, or the buffers of a
+    merge once the dictionary has been emptied; test_external_word_freqs
+    checks the traced peak stays under memory_limit. The words themselves
+    are counted against the limit but shared with the tweets, and the
+    tweets are not counted at all.
+    '''
+
+    # a run record without the word
+    RECORD = struct.Struct('<Iqq')
+    # the bytes of a dictionary slot, the [negative, positive] list and its
+    # two ints, on top of the word itself
+    ENTRY_OVERHEAD = 64 + 72 + 2 * 32
+    # files left to the rest of the process when merging, and the open
+    # file limit assumed when it can't be read
+    FILE_HEADROOM = 32
+    DEFAULT_FILE_LIMIT = 256
+
+    def __init__(self, memory_limit : int = 256 << 20, run_dir : str = None,
+                 buffer_size : int = 1 << 16):
+        '''
+        Parameters:
+          memory_limit -- the most bytes the counts and buffers may take
+          run_dir -- where the runs are written, the system temporary
+            directory if not given
+          buffer_size -- the read and write buffer of each run
+        '''
+        if memory_limit < 4 * buffer_size:
+            raise ValueError(f'memory_limit must be at least 4 buffers, {4 * buffer_size} bytes')
+        self.memory_limit = memory_limit
+        self.buffer_size = buffer_size
+        self.run_dir = tempfile.mkdtemp(prefix='word-freq-runs-', dir=run_dir)
+        self.runs = []
+        # the merge level of each run, a spilled run is level 0 and merging
+        # runs of level n makes a run of level n + 1
+        self._levels = []
+        self._next_run = 0
+        # the runs merged at once: a read buffer each and a write buffer in
+        # half of memory_limit, the other half is left for the merge itself,
+        # and no more files than the process may open
+        self._fan_in = max(2, min(memory_limit // (2 * buffer_size) - 1,
+                                  self.open_file_limit() - self.FILE_HEADROOM - 1))
+        self.num_pos = 0
+        self.num_neg = 0
+        self._counts = {}
+        self._size = 0
+
+    @classmethod
+    def open_file_limit(cls) -> int:
+        '''
+        Return the soft limit on the files this process may have open.
+        '''
+        if resource is None:
+            return cls.DEFAULT_FILE_LIMIT
+        limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        if limit == resource.RLIM_INFINITY:
+            return cls.DEFAULT_FILE_LIMIT * 16
+        return limit
+
+    def add(self, tweets, labels) -> None:
+        '''
+        Count the tokens of more tweets. Both can be iterables that are
+        walked once, so the tweets can be streamed from disk.
+
+        Parameters:
+          tweets -- the tweets as lists of tokens
+          labels -- the label of each tweet, 1 for positive and 0 for negative
+        '''
+        counts = self._counts
+        # the dictionary gets half of memory_limit, spilling it takes a
+        # sorted list of its words and a write buffer on top, and growing
+        # it briefly needs its old and new hash tables at once
+        limit = self.memory_limit // 2
+        for tweet_toks, label in zip(tweets, labels):
+            label = int(label)
+            if label != 0 and label != 1:
+                raise ValueError('labels must be 0 or 1')
+            if label:
+                self.num_pos += len(tweet_toks)
+            else:
+                self.num_neg += len(tweet_toks)
+            for word in tweet_toks:
+                counted = counts.get(word)
+                if counted is None:
+                    if self._size >= limit:
+                        self._spill()
+                    counted = counts[word] = [0, 0]
+                    self._size += sys.getsizeof(word) + self.ENTRY_OVERHEAD
+                counted[label] += 1
+
+    def _spill(self) -> None:
+        '''
+        Write the counts in memory to a new run, sorted by word. The
+        dictionary is emptied before the run is added, so any merges it
+        sets off have all of memory_limit for their buffers.
+        '''
+        name = None
+        if self._counts:
+            name = self._write_run((word, *self._counts[word]) for word in sorted(self._counts))
+        # cleared in place, add keeps a reference to it
+        self._counts.clear()
+        self._size = 0
+        if name is not None:
+            self._add_run(0, name)
+
+    def _add_run(self, level : int, name : str) -> None:
+        '''
+        Add a run, merging the last runs whenever fan_in of them have the
+        same level. The runs are like the digits of a counter in base
+        fan_in, so there are at most fan_in - 1 of each level and the
+        number of runs only grows with the log of the corpus size.
+        '''
+        self.runs.append(name)
+        self._levels.append(level)
+        fan_in = self._fan_in
+        while len(self.runs) >= fan_in and len(set(self._levels[-fan_in:])) == 1:
+            self._merge_last(fan_in)
+
+    def _merge_last(self, count : int) -> None:
+        '''
+        Merge the last count runs into one run and delete them.
+        '''
+        group = self.runs[-count:]
+        level = max(self._levels[-count:]) + 1
+        del self.runs[-count:]
+        del self._levels[-count:]
+        self.runs.append(self._write_run(self._merge([self._read_run(name) for name in group])))
+        self._levels.append(level)
+        for name in group:
+            os.remove(name)
+
+    def _write_run(self, records) -> str:
+        '''
+        Write (word, negative, positive) records to a new run file.
+
+        Returns: the name of the run
+        '''
+        name = os.path.join(self.run_dir, f'run-{self._next_run:06d}')
+        self._next_run += 1
+        pack = self.RECORD.pack
+        with open(name, 'wb', buffering=self.buffer_size) as file:
+            for word, freq_neg, freq_pos in records:
+                encoded = word.encode('utf-8')
+                file.write(pack(len(encoded), freq_neg, freq_pos))
+                file.write(encoded)
+        return name
+
+    def _read_run(self, name : str):
+        '''
+        Yield the (word, negative, positive) records of a run.
+        '''
+        unpack = self.RECORD.unpack
+        size = self.RECORD.size
+        with open(name, 'rb', buffering=self.buffer_size) as file:
+            while True:
+                header = file.read(size)
+                if not header:
+                    return
+                length, freq_neg, freq_pos = unpack(header)
+                yield file.read(length).decode('utf-8'), freq_neg, freq_pos
+
+    def _merge(self, sources):
+        '''
+        Merge sorted (word, negative, positive) iterables, summing the
+        counts of a word that's in more than one of them.
+        '''
+        merged = heapq.merge(*sources, key=lambda record: record[0])
+        current, total_neg, total_pos = None, 0, 0
+        for word, freq_neg, freq_pos in merged:
+            if word == current:
+                total_neg += freq_neg
+                total_pos += freq_pos
+                continue
+            if current is not None:
+                yield current, total_neg, total_pos
+            current, total_neg, total_pos = word, freq_neg, freq_pos
+        if current is not None:
+            yield current, total_neg, total_pos
+
+    def iter_counts(self):
+        '''
+        Yield (word, negative count, positive count) for every word seen,
+        in sorted order. The counts still in memory are spilled first, and
+        the smallest runs are merged until few enough are left to merge at
+        once within memory_limit; then the final merge is streamed.
+        '''
+        self._spill()
+        while len(self.runs) > self._fan_in:
+            self._merge_last(self._fan_in)
+        yield from self._merge([self._read_run(name) for name in self.runs])
+
+    def count_pos_neg(self) -> tuple[int, int]:
+        '''
+        Same as count_pos_neg, kept as the tweets are added.
+        '''
+        return self.num_pos, self.num_neg
+
+    def to_freq_dict(self) -> tuple[dict[(str, int), int], set]:
+        '''
+        Return the (freqs, vocab) build_word_freq_dict makes. These hold
+        every distinct word, so they have to fit in memory even when the
+        corpus doesn't.
+        '''
+        freqs = {}
+        vocab = set()
+        for word, freq_neg, freq_pos in self.iter_counts():
+            vocab.add(word)
+            if freq_neg:
+                freqs[(word, 0)] = freq_neg
+            if freq_pos:
+                freqs[(word, 1)] = freq_pos
+        return freqs, vocab
+
+    def to_summary(self) -> WordFreqSummary:
+        '''
+        Return the counts as a WordFreqSummary, which keeps a word in a
+        numpy array instead of a dictionary entry, for
+        NaiveBayesModel.from_table or merging with other shards.
+        '''
+        token_bytes, token_offsets = bytearray(), array('q', [0])
+        freq_neg, freq_pos = array('q'), array('q')
+        for word, neg, pos in self.iter_counts():
+            token_bytes += word.encode('utf-8')
+            token_offsets.append(len(token_bytes))
+            freq_neg.append(neg)
+            freq_pos.append(pos)
+        counts = np.array([np.frombuffer(freq_neg, dtype=np.int64), np.frombuffer(freq_pos, dtype=np.int64)])
+        return WordFreqSummary.from_encoded(bytes(token_bytes), token_offsets, counts.reshape(2, -1))
+
+    def close(self) -> None:
+        '''
+        Delete the runs.
+        '''
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+        self.runs = []
+
+    def __enter__(self) -> 'ExternalWordFreqs':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def train_out_of_core(pos_name : str, neg_name : str, stopwords_name : str,
+                      memory_limit : int = 256 << 20, run_dir : str = None) -> tuple['NaiveBayesModel', 'tp.Vocabulary']:
+    '''
+    Train a NaiveBayesModel on tweet files of any size. The files are read
+    a line at a time and each tweet is processed and counted with
+    ExternalWordFreqs within memory_limit, so only the final table of
+    distinct words is ever loaded.
+
+    Returns: the model and the Vocabulary of its token ids
+    '''
+    stopwords = tp.parse_stopwords(stopwords_name)
+    with ExternalWordFreqs(memory_limit, run_dir) as freqs:
+        for filename, label in ((pos_name, 1), (neg_name, 0)):
+            with open(filename, 'rb') as file:
+                tweets = (tp.process_tweet(json.loads(line)['text'], stopwords) for line in file if line.strip())
+                freqs.add(tweets, repeat(label))
+        summary = freqs.to_summary()
+    table, vocab = summary.to_table()
+    return NaiveBayesModel.from_table(table), vocab
+
+def test_external_word_freqs(tweets : list[list[str]], labels : np.ndarray,
+                             memory_limit : int = 1 << 20, buffer_size : int = 1 << 12) -> bool:
+    '''
+    Count the tweets with ExternalWordFreqs under a small memory_limit, so
+    they're spilled to many runs and merged in levels, and check the
+    counts against build_word_freq_dict. The peak memory of counting is
+    traced to check it stays under the limit, apart from the tweets
+    themselves which are already in memory.
+    '''
+    freqs, vocab = build_word_freq_dict(tweets, np.asarray(labels).astype(int).tolist())
+    with ExternalWordFreqs(memory_limit, buffer_size=buffer_size) as external:
+        tracemalloc.start()
+        external.add(tweets, labels)
+        num_words = sum(1 for _ in external.iter_counts())
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        num_runs = len(os.listdir(external.run_dir))
+        external_freqs, external_vocab = external.to_freq_dict()
+        num_pos, num_neg = external.count_pos_neg()
+    same = (external_freqs == freqs and external_vocab == vocab
+            and (num_pos, num_neg) == count_pos_neg(freqs))
+    print(f'external counts match the dictionary: {same}, {num_words} words in {num_runs} runs '
+          f'after merging, peak {peak / (1 << 20):.3f} MB, limit {memory_limit / (1 << 20):.3f} MB')
+    assert peak <= memory_limit, f'counting peaked at {peak} bytes, over the {memory_limit} limit'
+    return same
+
+
 def count_pos_neg(freqs : dict[(str, int),  int]) -> tuple[int, int]:
     '''a
     Count the number of positive and negative words in the
@@ -230,12 +1489,683 @@ def naive_bayes_predict(loglikelihood : dict[str, float], log_pos_neg_ratio : fl
     # return the sentiment score
     return sentiment_score
 
-def main():
+
+# words that the stopword list drops but that flip the meaning of the next
+# word, kept when tweets are processed for bigrams so "not happi" survives
+NEGATIONS = ('no', 'nor', 'not')
+
+def keep_negations(stopwords : list[str]) -> list[str]:
+    '''
+    Return the stopwords without the negations, NEGATIONS and the words
+    ending in n't, for processing tweets whose bigrams are wanted.
+    '''
+    return [word for word in stopwords if word not in NEGATIONS and not word.endswith("n't")]
+
+# mixes the bits of a 64 bit hash, the finalizer of splitmix64
+def _mix64(hashes : np.ndarray) -> np.ndarray:
+    hashes = hashes ^ (hashes >> np.uint64(30))
+    hashes = hashes * np.uint64(0xbf58476d1ce4e5b9)
+    hashes = hashes ^ (hashes >> np.uint64(27))
+    hashes = hashes * np.uint64(0x94d049bb133111eb)
+    return hashes ^ (hashes >> np.uint64(31))
+
+# turns tweets of tokens into features in a fixed number of buckets
+class HashingVectorizer:
+    '''
+    Maps the unigrams, and optionally the bigrams, of tweets of tokens to
+    ids in a fixed number of buckets by hashing them, the hashing trick.
+    There's no vocabulary to grow, so a NaiveBayesModel trained on the
+    buckets takes the same memory however many distinct n-grams there are,
+    at the cost of n-grams that share a bucket sharing their counts.
+
+    Each distinct token of a batch is hashed once with blake2b, and a
+    bigram's hash is mixed from the hashes of its two tokens with numpy,
+    so bigrams cost no more python work than unigrams.
+    '''
+
+    # multiplies the first token's hash of a bigram, so (a, b) and (b, a)
+    # hash differently
+    BIGRAM_MULTIPLIER = np.uint64(0x9e3779b97f4a7c15)
+
+    def __init__(self, num_buckets : int = 1 << 18, bigrams : bool = True):
+        '''
+        Parameters:
+          num_buckets -- the number of feature ids
+          bigrams -- add a feature for each pair of neighbouring tokens
+        '''
+        if num_buckets < 1:
+            raise ValueError('num_buckets must be positive')
+        self.num_buckets = num_buckets
+        self.bigrams = bigrams
+
+    def transform(self, tweets : list[list[str]]) -> 'tp.EncodedTweets':
+        '''
+        Return the bucket ids of the features of each tweet, its unigrams
+        followed by its bigrams.
+        '''
+        vocab = tp.Vocabulary()
+        encoded = tp.EncodedTweets.from_token_lists(tweets, vocab)
+        digests = b''.join(blake2b(token.encode('utf-8'), digest_size=8).digest() for token in vocab.tokens)
+        hashes = np.frombuffer(digests, dtype='<u8')[encoded.ids]
+        buckets = np.uint64(self.num_buckets)
+        unigrams = (_mix64(hashes) % buckets).astype(np.int32)
+        if not self.bigrams:
+            return tp.EncodedTweets(unigrams, encoded.offsets.copy())
+
+        # a bigram starts at every token but the last of each tweet
+        lengths = encoded.lengths()
+        starts = np.ones(len(hashes), dtype=bool)
+        ends = encoded.offsets[1:][lengths > 0] - 1
+        starts[ends] = False
+        first = hashes[starts]
+        second = hashes[np.flatnonzero(starts) + 1]
+        bigrams = (_mix64(first * self.BIGRAM_MULTIPLIER + second) % buckets).astype(np.int32)
+
+        # interleave them back into tweet order, unigrams first
+        bigram_lengths = np.maximum(lengths - 1, 0)
+        owners = np.concatenate((np.repeat(np.arange(len(encoded)), lengths),
+                                 np.repeat(np.arange(len(encoded)), bigram_lengths)))
+        order = np.argsort(owners, kind='stable')
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(lengths + bigram_lengths, out=offsets[1:])
+        return tp.EncodedTweets(np.concatenate((unigrams, bigrams))[order], offsets)
+
+
+# the same Naive Bayes model as build_word_freq_dict, count_pos_neg,
+# build_loglikelihood_dict and naive_bayes_predict, on numpy arrays of
+# token ids instead of dictionaries
+class NaiveBayesModel:
+    '''
+    A Naive Bayes sentiment model over the token ids of a tp.Vocabulary.
+    Word counts and likelihoods are arrays indexed by token id, so
+    training is a pair of bincounts and predict_batch scores every tweet
+    of an EncodedTweets (a sparse document-term matrix in CSR form) with
+    a lookup and a segmented sum.
+
+    More labelled tweets can be added with partial_fit, which gives the
+    same model as fitting on all of the tweets at once.
+
+    With a HashingVectorizer the model takes tweets as lists of tokens
+    instead, in fit, partial_fit, predict and predict_batch, and turns
+    them into bucket ids itself.
+
+    Attributes:
+      freqs -- the WordFreqTable of the training tweets
+      loglikelihood -- the log-likelihood of each token id, 0 for tokens
+        that weren't in the training set
+      log_pos_neg_ratio -- the log of the ratio of positive to negative
+        events, the score of a tweet with no known tokens
+      vectorizer -- the HashingVectorizer tweets go through, or None
+    '''
+
+    def __init__(self, vectorizer : HashingVectorizer = None):
+        self.vectorizer = vectorizer
+        self._reset()
+
+    def _reset(self) -> None:
+        '''
+        Forget every count, for a model that hasn't seen any tweets.
+        '''
+        self.freqs = WordFreqTable()
+        self.log_pos_neg_ratio = 0.0
+        # log(freq_pos + 1) - log(freq_neg + 1) of each token id, the part
+        # of its log-likelihood that doesn't depend on the totals, and
+        # whether the id was seen. Both have room past the last id, which
+        # is never seen, so every unknown id is clipped to it.
+        self._word_terms = np.zeros(1)
+        self._seen = np.zeros(1, dtype=bool)
+        self._size = 0
+        # the running totals of positive and negative events and of the
+        # distinct tokens seen, and the shift they give every log-likelihood
+        self._num_pos = 0
+        self._num_neg = 0
+        self._vocab_size = 0
+        self._shift = 0.0
+
+    @property
+    def loglikelihood(self) -> np.ndarray:
+        '''
+        The log-likelihood of each token id, 0 for ids that weren't seen.
+        It's put together from the per word terms when it's read, scoring
+        doesn't need it.
+        '''
+        size = self._size
+        if self._seen is None:
+            return self._word_terms[:size]
+        return np.where(self._seen[:size], self._word_terms[:size] + self._shift, 0.0)
+
+    def fit(self, tweets : 'tp.EncodedTweets', labels : np.ndarray) -> 'NaiveBayesModel':
+        '''
+        Count every token of the tweets by label and compute the
+        log-likelihoods, replacing anything learned before.
+
+        Parameters:
+          tweets -- the training tweets as EncodedTweets
+          labels -- the label of each tweet, 1 for positive and 0 for negative
+
+        Returns: the model, so it can be chained
+        '''
+        check_labels(labels, len(tweets))
+        self._reset()
+        return self.partial_fit(tweets, labels)
+
+    @classmethod
+    def from_table(cls, table : WordFreqTable) -> 'NaiveBayesModel':
+        '''
+        Make the model of word counts that were already made, such as the
+        table of merged WordFreqSummary. The table is kept as freqs, so
+        partial_fit can add to it.
+        '''
+        model = cls()
+        model.freqs = table
+        num_pos, num_neg = table.count_pos_neg()
+        model._update_loglikelihood(np.arange(table.counts.shape[1]), num_pos, num_neg)
+        return model
+
+    def partial_fit(self, tweets : 'tp.EncodedTweets', labels : np.ndarray) -> 'NaiveBayesModel':
+        '''
+        Add more labelled tweets to the model. Their counts are added to
+        freqs in place and only the words in the new tweets have their
+        terms recomputed; the change to the totals and the vocabulary size
+        moves every log-likelihood by the same amount, which is kept as one
+        shift added when tokens are scored, so the update takes time in
+        proportion to the new tweets, not the vocabulary. The result is the
+        same as fitting on the old and new tweets together. The labels are
+        checked before anything is counted, and the tweets may all have
+        one label, the log ratio is infinite until the other is seen.
+
+        Parameters:
+          tweets -- the new tweets as EncodedTweets
+          labels -- the label of each tweet, 1 for positive and 0 for negative
+
+        Returns: the model, so it can be chained
+        '''
+        if self.freqs is None:
+            raise ValueError('a model from load_model has no word counts to update, fit a new one instead')
+        labels = check_labels(labels, len(tweets))
+        tweets = self._encode(tweets)
+        self.freqs.add(tweets, labels)
+        affected = np.unique(tweets.ids[tweets.offsets[0]:tweets.offsets[-1]])
+        lengths = tweets.lengths()
+        num_pos = int(lengths[labels == 1].sum())
+        self._update_loglikelihood(affected, num_pos, int(lengths.sum()) - num_pos)
+        return self
+
+    def _update_loglikelihood(self, affected : np.ndarray, num_pos : int, num_neg : int) -> None:
+        '''
+        Refresh the log-likelihoods and the log ratio after the counts of
+        the affected token ids changed and num_pos and num_neg events were
+        added. Each log-likelihood of build_loglikelihood_dict splits into
+
+          log(freq_pos + 1) - log(freq_neg + 1) + log(N_neg + V) - log(N_pos + V)
+
+        where only the first two terms depend on the word, so those are
+        kept per word and the last two are one shift for every word, made
+        from running totals.
+        '''
+        self._grow(self.freqs.counts.shape[1])
+        freq_neg, freq_pos = self.freqs.counts[:, affected]
+        seen = (freq_pos > 0) | (freq_neg > 0)
+        self._vocab_size += int(np.count_nonzero(seen)) - int(np.count_nonzero(self._seen[affected]))
+        self._seen[affected] = seen
+        self._word_terms[affected] = np.log(freq_pos + 1) - np.log(freq_neg + 1)
+
+        self._num_pos += num_pos
+        self._num_neg += num_neg
+        vocab_size = self._vocab_size
+        # until both classes have been seen the log ratio is infinite, or
+        # nan before any tweets, rather than a division by zero
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self._shift = np.log(self._num_neg + vocab_size) - np.log(self._num_pos + vocab_size)
+            self.log_pos_neg_ratio = np.log(self._num_pos) - np.log(self._num_neg)
+
+    def _grow(self, size : int) -> None:
+        '''
+        Make room for token ids below size, and the unknown id past them,
+        doubling the arrays so a growing vocabulary is copied rarely.
+        '''
+        if size >= len(self._word_terms):
+            capacity = max(size + 1, 2 * len(self._word_terms))
+            word_terms = np.zeros(capacity)
+            word_terms[:len(self._word_terms)] = self._word_terms
+            seen = np.zeros(capacity, dtype=bool)
+            seen[:len(self._seen)] = self._seen
+            self._word_terms, self._seen = word_terms, seen
+        self._size = max(self._size, size)
+
+    def _encode(self, tweets) -> 'tp.EncodedTweets':
+        '''
+        Turn tweets of tokens into bucket ids when there's a vectorizer.
+        '''
+        return tweets if self.vectorizer is None else self.vectorizer.transform(tweets)
+
+    def _token_scores(self, ids : np.ndarray) -> np.ndarray:
+        '''
+        Look up the log-likelihood of each token id, ids past the end of
+        the training vocabulary score 0. The shift is only added to the
+        tokens being scored.
+        '''
+        ids = np.minimum(ids, self._size)
+        if self._seen is None:
+            return self._word_terms[ids]
+        return np.where(self._seen[ids], self._word_terms[ids] + self._shift, 0.0)
+
+    def predict(self, tweet : np.ndarray) -> float:
+        '''
+        Score a single tweet given as an array of token ids, the same
+        score naive_bayes_predict gives.
+        '''
+        if self.vectorizer is not None:
+            tweet = self.vectorizer.transform([tweet])[0]
+        return self.log_pos_neg_ratio + self._token_scores(np.asarray(tweet)).sum()
+
+    def predict_batch(self, tweets : 'tp.EncodedTweets') -> np.ndarray:
+        '''
+        Score every tweet at once. The token scores are summed per tweet
+        with np.add.reduceat over the tweet offsets, in the same order
+        naive_bayes_predict adds them. reduceat can't sum an empty range,
+        so empty tweets are left out of it and score just the log ratio.
+
+        Returns: an array with the score of each tweet
+        '''
+        tweets = self._encode(tweets)
+        scores = self._token_scores(tweets.ids[tweets.offsets[0]:tweets.offsets[-1]])
+        starts = tweets.offsets[:-1] - tweets.offsets[0]
+        sums = np.zeros(len(tweets))
+        nonempty = tweets.lengths() > 0
+        if nonempty.all():
+            sums = np.add.reduceat(scores, starts) if len(tweets) else sums
+        elif nonempty.any():
+            sums[nonempty] = np.add.reduceat(scores, starts[nonempty])
+        return self.log_pos_neg_ratio + sums
+
+
+def report_hashed_ngrams(pos_name : str = 'SentimentAnalysis/positive_tweets.json',
+                         neg_name : str = 'SentimentAnalysis/negative_tweets.json',
+                         stopwords_name : str = 'TweetProcessor/english_stopwords.txt',
+                         bucket_counts : tuple[int] = (1 << 12, 1 << 14, 1 << 16, 1 << 18, 1 << 20)) -> list[dict]:
+    '''
+    Compare the unigram model over a Vocabulary with models over hashed
+    unigrams and hashed unigrams and bigrams at each number of buckets, on
+    the same split as main with the negations kept in the tweets. For each
+    the test accuracy, the tweets per second of training and of scoring
+    (counting the encoding of the tweets) and the memory of the counts
+    are printed.
+
+    Returns: a dictionary of results for each model
+    '''
+    stopwords = keep_negations(tp.parse_stopwords(stopwords_name))
+    tweets = []
+    for filename in (pos_name, neg_name):
+        with tp.RawTweetStore(filename) as store:
+            tweets.append([tp.process_tweet(tweet, stopwords) for tweet in store])
+    train_x, train_y, test_x, test_y, *_ = partition_training_and_test_sets(*tweets)
+    distinct = {(first, second) for tweet in train_x for first, second in zip(tweet, tweet[1:])}
+    print(f'{len(train_x)} training tweets, {len(distinct)} distinct bigrams')
+
+    def run(name, make_model, encode):
+        start = time.perf_counter()
+        model = make_model().fit(encode(train_x), train_y)
+        train_time = time.perf_counter() - start
+        start = time.perf_counter()
+        scores = model.predict_batch(encode(test_x))
+        predict_time = time.perf_counter() - start
+        accuracy = np.mean((scores > 0) == (test_y == 1))
+        nbytes = model.freqs.nbytes() + model.loglikelihood.nbytes
+        print(f'{name:<28} accuracy {accuracy:.4f}, train {len(train_x) / train_time:8.0f} tweets/sec, '
+              f'predict {len(test_x) / predict_time:8.0f} tweets/sec, {nbytes / 1024:8.0f} KB')
+        return {'model': name, 'accuracy': accuracy, 'train_seconds': train_time,
+                'predict_seconds': predict_time, 'nbytes': nbytes}
+
+    vocab = tp.Vocabulary()
+    report = [run('unigrams', NaiveBayesModel, lambda tweets: tp.EncodedTweets.from_token_lists(tweets, vocab))]
+    for num_buckets in bucket_counts:
+        for bigrams in (False, True):
+            name = f"hashed {'uni+bigrams' if bigrams else 'unigrams'} 2^{num_buckets.bit_length() - 1}"
+            vectorizer = HashingVectorizer(num_buckets, bigrams)
+            report.append(run(name, partial(NaiveBayesModel, vectorizer), lambda tweets: tweets))
+    return report
+
+
+# the layout of a saved model: this header, then starting at
+# MODEL_DATA_OFFSET and all little-endian, the scores (the log-likelihood of
+# each token id followed by a 0 for unknown ids) as float64, the byte offset
+# of each vocabulary token as int64, the token ids in the sorted order of
+# their tokens as int64, and the tokens themselves as utf-8
+MODEL_MAGIC = b'NBMODEL\0'
+MODEL_VERSION = 1
+MODEL_HEADER = struct.Struct('<8sIIQQQd')
+MODEL_DATA_OFFSET = 64
+
+def save_model(model : NaiveBayesModel, vocab : 'tp.Vocabulary', filename : str) -> None:
+    '''
+    Write what's needed to score tweets, the log ratio, the log-likelihood
+    vector and the vocabulary, to a binary file that load_model can map.
+    The word counts aren't saved, so a loaded model can't be updated with
+    partial_fit.
+
+    Parameters:
+      model -- a trained NaiveBayesModel
+      vocab -- the Vocabulary the model's token ids come from
+      filename -- the file to write
+    '''
+    if model.vectorizer is not None:
+        raise ValueError('a model over hashed features has no vocabulary to save')
+    encoded = [token.encode('utf-8') for token in vocab.tokens]
+    offsets = np.zeros(len(encoded) + 1, dtype='<i8')
+    np.cumsum([len(token) for token in encoded], out=offsets[1:])
+    # sorted by the utf-8 bytes, the order MappedVocabulary searches in
+    order = np.array(sorted(range(len(encoded)), key=encoded.__getitem__), dtype='<i8')
+    loglikelihood = model.loglikelihood
+    header = MODEL_HEADER.pack(MODEL_MAGIC, MODEL_VERSION, 0, len(loglikelihood),
+                               len(encoded), int(offsets[-1]), model.log_pos_neg_ratio)
+    # written to a temporary file and renamed, so a process loading the
+    # model never maps a half written one
+    tmp_name = f'{filename}.tmp'
+    with open(tmp_name, 'wb') as file:
+        file.write(header.ljust(MODEL_DATA_OFFSET, b'\0'))
+        # a 0 on the end that load_model clips unknown ids to
+        file.write(np.append(loglikelihood, 0.0).astype('<f8').tobytes())
+        file.write(offsets.tobytes())
+        file.write(order.tobytes())
+        file.write(b''.join(encoded))
+    os.replace(tmp_name, filename)
+
+# the vocabulary of a saved model, read straight from the mapped file
+class MappedVocabulary:
+    '''
+    The Vocabulary of a model loaded by load_model. Nothing is built when
+    it's loaded: a token is decoded from the mapped file when it's needed,
+    and a token's id is found with a binary search over the tokens in
+    sorted order. The ids of the last CACHE_SIZE tokens found are
+    remembered, so the common tokens of a stream of tweets are soon all
+    looked up in a dictionary; unknown tokens aren't, so a stream of new
+    words can't grow the cache.
+
+    It has the lookup, decode and len of a tp.Vocabulary, but no tokens
+    can be added.
+    '''
+
+    # the most token ids remembered
+    CACHE_SIZE = 1 << 16
+
+    def __init__(self, mapped : mmap.mmap, offsets_start : int, num_tokens : int, token_bytes : int):
+        '''
+        Parameters:
+          mapped -- the mapped model file
+          offsets_start -- where the token offsets start in the file
+          num_tokens -- the number of tokens
+          token_bytes -- the length of the utf-8 tokens
+        '''
+        view = memoryview(mapped)
+        order_start = offsets_start + 8 * (num_tokens + 1)
+        tokens_start = order_start + 8 * num_tokens
+        self._offsets = view[offsets_start:order_start].cast('q')
+        self._order = view[order_start:tokens_start].cast('q')
+        self._tokens = view[tokens_start:tokens_start + token_bytes]
+        # a miss raises KeyError, which lru_cache doesn't remember
+        self._find = lru_cache(maxsize=self.CACHE_SIZE)(self._search)
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def __contains__(self, token : str) -> bool:
+        return self.lookup(token) != -1
+
+    def _token_bytes(self, token_id : int) -> bytes:
+        return self._tokens[self._offsets[token_id]:self._offsets[token_id + 1]].tobytes()
+
+    def _search(self, token : str) -> int:
+        '''
+        Binary search the sorted tokens for the id of token.
+
+        Raises: KeyError if it's unknown
+        '''
+        key = token.encode('utf-8')
+        order = self._order
+        low = bisect.bisect_left(order, key, key=self._token_bytes)
+        if low < len(order) and self._token_bytes(order[low]) == key:
+            return order[low]
+        raise KeyError(token)
+
+    def lookup(self, token : str, default : int = -1) -> int:
+        '''
+        Return the id of token, or default if it's unknown.
+        '''
+        try:
+            return self._find(token)
+        except KeyError:
+            return default
+
+    def decode(self, token_ids) -> list[str]:
+        '''
+        Return the tokens for a sequence of ids.
+        '''
+        return [self._token_bytes(token_id).decode('utf-8') for token_id in token_ids]
+
+    @property
+    def tokens(self) -> list[str]:
+        '''
+        Every token in id order, decoded from the file on each call.
+        '''
+        return self.decode(range(len(self)))
+
+def load_model(filename : str) -> tuple[NaiveBayesModel, MappedVocabulary]:
+    '''
+    Load a model written by save_model. The file is memory-mapped and the
+    log-likelihoods and the vocabulary are read from the mapping instead of
+    being copied, so every process scoring with the same model file shares
+    one copy of it in memory, and loading only reads the header.
+
+    Returns: the NaiveBayesModel, ready for predict and predict_batch, and
+    its MappedVocabulary
+    '''
+    with open(filename, 'rb') as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(mapped) < MODEL_DATA_OFFSET:
+        raise ValueError(f'{filename} is not a saved sentiment model')
+    magic, version, _, size, num_tokens, token_bytes, log_pos_neg_ratio = MODEL_HEADER.unpack_from(mapped)
+    if magic != MODEL_MAGIC:
+        raise ValueError(f'{filename} is not a saved sentiment model')
+    if version != MODEL_VERSION:
+        raise ValueError(f'{filename} is model version {version}, expected {MODEL_VERSION}')
+    expected = MODEL_DATA_OFFSET + 8 * (size + 1) + 8 * (2 * num_tokens + 1) + token_bytes
+    if len(mapped) != expected:
+        raise ValueError(f'{filename} is {len(mapped)} bytes, expected {expected}')
+
+    scores = np.frombuffer(mapped, dtype='<f8', count=size + 1, offset=MODEL_DATA_OFFSET)
+    model = NaiveBayesModel()
+    # the saved log-likelihoods already have the shift and 0 for unseen
+    # ids, and a 0 on the end for unknown ids, so they're scored as is
+    model.freqs = None
+    model._word_terms = scores
+    model._seen = None
+    model._size = size
+    model.log_pos_neg_ratio = log_pos_neg_ratio
+    vocab = MappedVocabulary(mapped, MODEL_DATA_OFFSET + scores.nbytes, num_tokens, token_bytes)
+    return model, vocab
+
+def encode_for_prediction(tweets : list[list[str]], vocab) -> 'tp.EncodedTweets':
+    '''
+    Encode processed tweets for scoring with an existing tp.Vocabulary or
+    MappedVocabulary. Unlike EncodedTweets.from_token_lists the vocabulary
+    isn't changed: tokens it doesn't have get an id past its end, which
+    every model scores as 0.
+    '''
+    unknown = len(vocab)
+    lookup = vocab.lookup
+    ids = []
+    offsets = [0]
+    for tweet_toks in tweets:
+        ids.extend([lookup(token, unknown) for token in tweet_toks])
+        offsets.append(len(ids))
+    return tp.EncodedTweets(ids, offsets)
+
+def predict_texts(model : NaiveBayesModel, vocab, texts : list[str],
+                  stopwords : list[str]) -> np.ndarray:
+    '''
+    Score raw tweets with a model, for example one from load_model: each
+    tweet is processed with tp.process_tweet, encoded with vocab and the
+    whole batch is scored at once.
+
+    Returns: an array with the score of each tweet
+    '''
+    processed = [tp.process_tweet(text, stopwords) for text in texts]
+    return model.predict_batch(encode_for_prediction(processed, vocab))
+
+def test_save_load_model(model : NaiveBayesModel, vocab : 'tp.Vocabulary',
+                         test_x : 'tp.EncodedTweets') -> bool:
+    '''
+    Save a model to a temporary directory, load it back and check that it
+    gives the same scores and token ids, and that unknown tokens aren't
+    cached, reporting the file size and how long loading takes.
+    '''
+    with tempfile.TemporaryDirectory(prefix='sentiment-model-') as model_dir:
+        return _check_save_load_model(model, vocab, test_x, os.path.join(model_dir, 'sentiment_model.nb'))
+
+def _check_save_load_model(model : NaiveBayesModel, vocab : 'tp.Vocabulary',
+                           test_x : 'tp.EncodedTweets', filename : str) -> bool:
+    save_model(model, vocab, filename)
+    start = time.perf_counter()
+    loaded, loaded_vocab = load_model(filename)
+    load_time = time.perf_counter() - start
+    same = (np.array_equal(loaded.predict_batch(test_x), model.predict_batch(test_x))
+            and loaded_vocab.tokens == vocab.tokens
+            and all(loaded_vocab.lookup(token) == token_id for token, token_id in vocab.ids.items()))
+    # an unknown token is looked up again every time rather than cached
+    cached = loaded_vocab._find.cache_info().currsize
+    same = (same and loaded_vocab.lookup('\0unknown') == -1 and '\0unknown' not in loaded_vocab
+            and loaded_vocab._find.cache_info().currsize == cached)
+    print(f'saved model matches: {same}, {os.path.getsize(filename)} bytes, '
+          f'loaded in {load_time * 1000:.2f}ms')
+    return same
+
+def test_partial_fit(train_x : 'tp.EncodedTweets', train_y : np.ndarray,
+                     test_x : 'tp.EncodedTweets', batches : int = 10) -> float:
+    '''
+    Train one model on a quarter of the training tweets from each end, so
+    both classes are in it when the positive tweets come first as in
+    main, and add the rest with partial_fit in batches, as new labelled
+    tweets would arrive, then check it against a model fit on all of them
+    at once, and time an update against a full retrain.
+
+    Returns: the largest difference between the two models' test scores
+    '''
+    quarter = len(train_x) // 4
+    end = len(train_x) - quarter
+    online = NaiveBayesModel().fit(train_x[:quarter] + train_x[end:],
+                                   np.concatenate((train_y[:quarter], train_y[end:])))
+    batch_size = max(1, (end - quarter) // batches)
+    update_time = 0.0
+    for start in range(quarter, end, batch_size):
+        stop = min(start + batch_size, end)
+        began = time.perf_counter()
+        online.partial_fit(train_x[start:stop], train_y[start:stop])
+        update_time = max(update_time, time.perf_counter() - began)
+
+    began = time.perf_counter()
+    full = NaiveBayesModel().fit(train_x, train_y)
+    retrain_time = time.perf_counter() - began
+
+    same_counts = np.array_equal(online.freqs.counts, full.freqs.counts)
+    difference = max(np.abs(online.loglikelihood - full.loglikelihood).max(initial=0.0),
+                     np.abs(online.predict_batch(test_x) - full.predict_batch(test_x)).max(initial=0.0))
+    print(f'partial_fit: same counts {same_counts}, largest difference {difference}')
+    print(f'slowest update of {batch_size} tweets {update_time * 1000:.2f}ms, '
+          f'full retrain on {len(train_x)} tweets {retrain_time * 1000:.2f}ms')
+    return difference
+
+def test_partial_fit_one_class(train_x : 'tp.EncodedTweets', train_y : np.ndarray) -> bool:
+    '''
+    Fit on the positive tweets alone, which gives an infinite log ratio
+    instead of an error, then add the negative ones with partial_fit and
+    check the result against a model fit on all of them. Bad labels must
+    be refused without changing the model.
+    '''
+    positive = np.flatnonzero(train_y == 1)
+    if len(positive) in (0, len(train_y)) or positive[-1] != len(positive) - 1:
+        raise ValueError('the positive training tweets must come first, then the negative ones')
+    first = len(positive)
+    online = NaiveBayesModel().fit(train_x[:first], train_y[:first])
+    one_class = bool(np.isposinf(online.log_pos_neg_ratio))
+
+    counts = online.freqs.counts.copy()
+    try:
+        online.partial_fit(train_x[first:], np.full(len(train_x) - first, 2))
+        refused = False
+    except ValueError:
+        refused = np.array_equal(online.freqs.counts, counts)
+
+    online.partial_fit(train_x[first:], train_y[first:])
+    full = NaiveBayesModel().fit(train_x, train_y)
+    same = (np.array_equal(online.freqs.counts, full.freqs.counts)
+            and np.allclose(online.loglikelihood, full.loglikelihood)
+            and online.log_pos_neg_ratio == full.log_pos_neg_ratio)
+    print(f'partial_fit from one class: infinite log ratio {one_class}, bad labels refused {refused}, '
+          f'same as a full fit {same}')
+    return one_class and refused and same
+
+def test_naive_bayes_model(train_x : 'tp.EncodedTweets', train_y : np.ndarray,
+                           test_x : 'tp.EncodedTweets', vocab : 'tp.Vocabulary',
+                           repeat : int = 20) -> float:
+    '''
+    Train the dictionary based functions and a NaiveBayesModel on the
+    same tweets, check that predict_batch gives the same scores as
+    naive_bayes_predict on the test tweets, and time both on the test set
+    repeated repeat times. naive_bayes_predict is timed on the tweets as
+    lists of token strings, the way main scored them before the tweets
+    were encoded, and predict_batch both on the encoded tweets and
+    counting the encoding of the token strings.
+
+    Returns: the largest difference between the two sets of scores
+    '''
+    train_tokens = [vocab.decode(tweet) for tweet in train_x]
+    test_tokens = [vocab.decode(tweet) for tweet in test_x]
+    freqs, words = build_word_freq_dict(train_tokens, train_y)
+    num_pos, num_neg = count_pos_neg(freqs)
+    log_pos_neg_ratio = np.log(num_pos / num_neg)
+    log_likelihood = build_loglikelihood_dict(freqs, num_pos, num_neg, words)
+    model = NaiveBayesModel().fit(train_x, train_y)
+
+    expected = np.array([naive_bayes_predict(log_likelihood, log_pos_neg_ratio, tweet) for tweet in test_tokens])
+    difference = np.abs(model.predict_batch(test_x) - expected).max() if len(test_x) else 0.0
+    print(f'largest score difference: {difference}')
+
+    big_tokens = test_tokens * repeat
+    big_test = test_x
+    for _ in range(repeat - 1):
+        big_test = big_test + test_x
+    start = time.perf_counter()
+    for tweet in big_tokens:
+        naive_bayes_predict(log_likelihood, log_pos_neg_ratio, tweet)
+    loop_time = time.perf_counter() - start
+    start = time.perf_counter()
+    model.predict_batch(big_test)
+    batch_time = time.perf_counter() - start
+    start = time.perf_counter()
+    model.predict_batch(encode_for_prediction(big_tokens, vocab))
+    encoded_time = time.perf_counter() - start
+    print(f'{len(big_test)} tweets: naive_bayes_predict {len(big_test) / loop_time:.0f} tweets/sec, '
+          f'predict_batch {len(big_test) / batch_time:.0f} tweets/sec, speedup {loop_time / batch_time:.0f}x, '
+          f'{loop_time / encoded_time:.1f}x counting the encoding')
+    return difference
+
+def main(model_name : str = None):
+    '''
+    Parameters:
+      model_name -- when given, the trained model is saved to this file
+        for load_model, so scoring doesn't need to train again
+    '''
     # first, set up our samples
-    pos_tweets, neg_tweets, stopwords, full_pos_tweets, full_neg_tweets = tp.process_tweets('SentimentAnalysis/positive_tweets.json', 'SentimentAnalysis/negative_tweets.json', 'TweetProcessor/english_stopwords.txt')
+    # the processed tweets are kept as arrays of token ids from token_vocab,
+    # and are only reprocessed when the files or the pipeline change
+    pos_tweets, neg_tweets, stopwords, token_vocab = tp.process_tweets_cached('SentimentAnalysis/positive_tweets.json', 'SentimentAnalysis/negative_tweets.json', 'TweetProcessor/english_stopwords.txt', 'SentimentAnalysis/.tweet_cache')
+    # the raw tweets stay on disk, a tweet's text is only read when it's printed
+    pos_raw = tp.RawTweetStore('SentimentAnalysis/positive_tweets.json')
+    neg_raw = tp.RawTweetStore('SentimentAnalysis/negative_tweets.json')
     
-    print(f'random positive: {pos_tweets[random.randint(0, len(pos_tweets) - 1)]}')
-    print(f'random negative: {neg_tweets[random.randint(0, len(neg_tweets) - 1)]}')
+    print(f'random positive: {token_vocab.decode(pos_tweets[random.randint(0, len(pos_tweets) - 1)])}')
+    print(f'random negative: {token_vocab.decode(neg_tweets[random.randint(0, len(neg_tweets) - 1)])}')
     print(f'random stopword: {stopwords[random.randint(0, len(stopwords) - 1)]}')
 
     # defines the partition between training and test sets
@@ -246,23 +2176,28 @@ def main():
     print(f'N_train_pos = {N_train_pos}, N_train_neg = {N_train_neg}')
     print(f'N_test_pos = {N_test_pos}, N_test_neg = {N_test_neg}')
 
-    # create a frequency dictionary
-    freq_train, vocab = {}, {}
-    freq_train, vocab = build_word_freq_dict(train_x, train_y)
-    print(f'freq dictionary size: {len(freq_train)}, vocab size: {len(vocab)}')
+    # the test set is the end of the positive tweets followed by the end of
+    # the negative ones, so a test index maps back to a raw tweet
+    def raw_test_tweet(idx : int) -> str:
+        if idx < N_test_pos:
+            return pos_raw[N_train_pos + idx]
+        return neg_raw[N_train_neg + idx - N_test_pos]
+
+    # count the words of each class and calculate the log likelihoods, the
+    # same as build_word_freq_dict, count_pos_neg and build_loglikelihood_dict
+    model = NaiveBayesModel().fit(train_x, train_y)
+    print(f'freq dictionary size: {len(model.freqs)}, vocab size: {model.freqs.vocab_size()}')
 
     # count the number of positive and negative words
-    num_pos, num_neg = 0, 0
-    num_pos, num_neg = count_pos_neg(freq_train)
+    num_pos, num_neg = model.freqs.count_pos_neg()
     print(f'Number of positive events: {num_pos}, Number of negative events: {num_neg}')
 
     # log of the ratio of the total positive and total negative tweets from the training set
-    log_pos_neg_ratio = 0
-    log_pos_neg_ratio = np.log(num_pos / num_neg)
-    print(f'log_pos_neg_ratio of the training set = {log_pos_neg_ratio}')
+    print(f'log_pos_neg_ratio of the training set = {model.log_pos_neg_ratio}')
 
-    # now calculate the log likelihood dictionary
-    log_likelihood = build_loglikelihood_dict(freq_train, num_pos, num_neg, vocab)
+    # save the model so scoring doesn't need to train again, see load_model
+    if model_name is not None:
+        save_model(model, token_vocab, model_name)
 
     print("Random Tweets:")
     print()
@@ -270,39 +2205,41 @@ def main():
     # print predictions for 10 random tweets
     for i in range(10):
         idx = random.randint(0, N_test_pos + N_test_neg - 1)
-        print(f'Tweet: {test_x[idx]}')
+        print(f'Tweet: {raw_test_tweet(idx)}')
+        print(f'Tokens: {token_vocab.decode(test_x[idx])}')
         print(f'Label: {test_y[idx]}')
-        print(f'Prediction: {naive_bayes_predict(log_likelihood, log_pos_neg_ratio, test_x[idx])}')
+        print(f'Prediction: {model.predict(test_x[idx])}')
         print()
     
     # now let's see what our error rate is
     # Calculate the error rate and print it out
     # also print out the mislabeled tweets
     # Calculate the error rate
-    error_count = 0
-    mislabeled_tweets = []
-    true_tweets = []
-
-    for (tweet, label) in zip(test_x, test_y):
-        prediction = naive_bayes_predict(log_likelihood, log_pos_neg_ratio, tweet)
-        # Check if the prediction doesn't match the true label
-        if (prediction > -0.0005 and int(label) == 0):
-            error_count += 1
-            mislabeled_tweets.append((tweet, label, prediction))
-        elif(prediction < 0.0005 and int(label) == 1):
-            error_count += 1
-            mislabeled_tweets.append((tweet, label, prediction))
-        else:
-            true_tweets.append((tweet, label, prediction))
+    # score the whole test set at once
+    predictions = model.predict_batch(test_x)
+    labels = test_y.astype(int)
+    # Check if the prediction doesn't match the true label
+    mislabeled = (((predictions > -0.0005) & (labels == 0))
+                  | ((predictions < 0.0005) & (labels == 1)))
+    error_count = np.count_nonzero(mislabeled)
+
+    # tweets are kept by their test index, the text is read back when printed
+    mislabeled_tweets = [(idx, test_y[idx], predictions[idx]) for idx in np.flatnonzero(mislabeled)]
+    true_tweets = [(idx, test_y[idx], predictions[idx]) for idx in np.flatnonzero(~mislabeled)]
 
     print("Mislabeled Tweets:")
     print()
 
     count = 0
     # Part 2 my LLM
+    from openai import OpenAI
+    client = OpenAI()
     # # Print out the mislabeled tweets and determine why they are mislabeled
-    for tweet, label, prediction in mislabeled_tweets:
+    for idx, label, prediction in mislabeled_tweets:
+        # the LLM gets the processed tokens, as it always has
+        tweet = token_vocab.decode(test_x[idx])
         print("Tweet:", tweet)
+        print("Raw tweet:", raw_test_tweet(idx))
         print("True Label:", label)
         print("Prediction:", prediction)
         llm_response = get_llm_response(client, f'Using the {tweet} please determine the sentiment either positive or negative and tell me by saying Positive Sentiment, or Negative Sentiment')
@@ -320,8 +2257,14 @@ def main():
     print("# of truely labeled tweets:", len(true_tweets))
     print(f'Error rate: {error_count / (N_test_pos + N_test_neg)}')
 
+    pos_raw.close()
+    neg_raw.close()
+
 
 
 # run the main function if this is where our program was executed from
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Train and evaluate the tweet sentiment model.')
+    parser.add_argument('--save-model', metavar='FILE',
+                        help='save the trained model to FILE, for load_model')
+    main(parser.parse_args().save_model)
\ No newline at end of file
@@ -7,14 +7,25 @@ Python module to handle the processing of tweets. Generally, we use either
 process_tweet or process_tweets.
 '''
 
+import os
 import re
 import json
+import mmap
+import shutil
+import hashlib
 import string
 import random
+from array import array
+from importlib.metadata import version
+from typing import TYPE_CHECKING
 
-# import tweet tokenizer
-from nltk.tokenize import TweetTokenizer
-from nltk.stem import PorterStemmer 
+import numpy as np
+
+# nltk is slow to import and isn't needed at all when the processed tweets
+# come from the cache, so it's only imported when tweets are processed
+if TYPE_CHECKING:
+    from nltk.tokenize import TweetTokenizer
+    from nltk.stem import PorterStemmer
 
 
 # read a json file and store the tweets from it as a list of strings
@@ -42,6 +53,83 @@ def load_tweets(filename: str) -> list[str]:
     # now return the tweets as a list
     return tweets
 
+# the raw tweets of a json file, read from disk by index when needed
+class RawTweetStore:
+    '''
+    The raw text of a json file of tweets, one tweet per line, without
+    holding the text in memory. The file is memory-mapped and only the
+    offset where each line starts is kept, 8 bytes a tweet, so a tweet's
+    text is parsed from its line each time it's fetched by index. This
+    lets the rest of the code carry tweets around as integer ids.
+
+    Use it like a read-only list of strings, and close it (or use it in a
+    with statement) when done.
+    '''
+
+    # the bytes searched for newlines at once while building the offsets
+    WINDOW = 1 << 24
+
+    def __init__(self, filename : str):
+        '''
+        Parameters:
+          filename -- the name of the json file, each line of the file is
+            a complete json object that's a tweet, as for load_tweets
+        '''
+        self.filename = filename
+        with open(filename, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            # an empty file can't be mapped
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        # every line starts after a newline, the last line may not have one;
+        # the newlines are found a window at a time so the comparison never
+        # needs a temporary the size of the file
+        data = np.frombuffer(self._map, dtype=np.uint8)
+        starts = [np.zeros(1, dtype=np.int64)]
+        for begin in range(0, size, self.WINDOW):
+            window = data[begin:begin + self.WINDOW]
+            starts.append(np.flatnonzero(window == ord('\n')).astype(np.int64) + (begin + 1))
+        del data
+        offsets = np.concatenate(starts)
+        if offsets[-1] != size:
+            offsets = np.append(offsets, size)
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def line(self, index : int) -> bytes:
+        '''
+        Return the json line of the tweet at index.
+        '''
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('tweet index out of range')
+        return self._map[self.offsets[index]:self.offsets[index + 1]]
+
+    def __getitem__(self, index : int) -> str:
+        return json.loads(self.line(index))['text']
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def nbytes(self) -> int:
+        '''
+        Return the number of bytes of memory used by the line index.
+        '''
+        return self.offsets.nbytes
+
+    def close(self) -> None:
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+
+    def __enter__(self) -> 'RawTweetStore':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
 # cleanup the tweets
 def cleanup_tweet(tweet : str) -> str:
     '''
@@ -69,7 +157,7 @@ def cleanup_tweet(tweet : str) -> str:
     return cleaned_tweet
 
 # tokenize the tweets
-def tokenize_tweet(tweet : str, tokenizer : TweetTokenizer) -> list[str]:
+def tokenize_tweet(tweet : str, tokenizer : 'TweetTokenizer') -> list[str]:
     '''
     Converts a tweets to a list of a list of tokens, each a string
 
@@ -115,7 +203,7 @@ def remove_stopwords_and_punctuation(tweet_toks : list[str],
 # takes a list of tweets and returns the tweets with the stemmed words,
 # note that the argument is a list of a list of strings, since each element
 # of a tweet contains a list of tokens in that tweet
-def stem_tweet(tweet_toks : list[str], stemmer : PorterStemmer) -> list[str]:
+def stem_tweet(tweet_toks : list[str], stemmer : 'PorterStemmer') -> list[str]:
     '''
     Take a list of tweet tokens and stem each token, which will replace
     a word with its stem (and possibly just keep it if we can't stem it)
@@ -140,8 +228,139 @@ def parse_stopwords(filename : str) -> list[str]:
         stopwords = file.read().splitlines()
     return stopwords
 
+# maps each distinct token to a small integer id, shared by every tweet
+class Vocabulary:
+    '''
+    A two way mapping between tokens and integer ids. Ids are handed out
+    in the order tokens are first seen, starting at 0, so a token string
+    is only stored once however many tweets it appears in.
+    '''
+
+    def __init__(self, tokens = ()):
+        '''
+        Parameters:
+          tokens -- tokens to add to the vocabulary up front, in id order
+        '''
+        self.ids = {}
+        self.tokens = []
+        for token in tokens:
+            self.add(token)
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def __contains__(self, token : str) -> bool:
+        return token in self.ids
+
+    def add(self, token : str) -> int:
+        '''
+        Return the id of token, giving it the next id if it's new.
+        '''
+        token_id = self.ids.get(token)
+        if token_id is None:
+            token_id = len(self.tokens)
+            self.ids[token] = token_id
+            self.tokens.append(token)
+        return token_id
+
+    def encode(self, tweet_toks : list[str]) -> list[int]:
+        '''
+        Return the ids of a list of tokens, adding any new tokens.
+        '''
+        add = self.add
+        return [add(token) for token in tweet_toks]
+
+    def lookup(self, token : str, default : int = -1) -> int:
+        '''
+        Return the id of token without adding it, or default if it's unknown.
+        '''
+        return self.ids.get(token, default)
+
+    def decode(self, token_ids) -> list[str]:
+        '''
+        Return the tokens for a sequence of ids.
+        '''
+        tokens = self.tokens
+        return [tokens[token_id] for token_id in token_ids]
+
+# processed tweets stored as token ids in two flat arrays
+class EncodedTweets:
+    '''
+    A list of processed tweets in a compressed sparse row layout: ids holds
+    the token ids of every tweet back to back as an int32 array, and the
+    ids of tweet i are ids[offsets[i]:offsets[i + 1]]. This takes a small
+    fraction of the memory of a list of lists of strings.
+
+    Indexing with an int gives the id array of one tweet, indexing with a
+    slice gives a new EncodedTweets, and + joins two of them, so they can
+    be partitioned the same way as a list of tweets.
+    '''
+
+    def __init__(self, ids = None, offsets = None):
+        '''
+        Parameters:
+          ids -- the token ids of every tweet back to back
+          offsets -- where each tweet starts in ids, with one extra entry
+            at the end for the total number of ids
+        '''
+        self.ids = np.asarray(ids if ids is not None else [], dtype=np.int32)
+        self.offsets = np.asarray(offsets if offsets is not None else [0], dtype=np.int64)
+
+    @classmethod
+    def from_token_lists(cls, tweets, vocab : Vocabulary) -> 'EncodedTweets':
+        '''
+        Encode an iterable of processed tweets, adding their tokens to vocab.
+        The iterable is only walked once, so it can be a stream of tweets.
+        '''
+        ids = array('i')
+        offsets = array('q', [0])
+        add = vocab.add
+        for tweet_toks in tweets:
+            ids.extend([add(token) for token in tweet_toks])
+            offsets.append(len(ids))
+        return cls(np.frombuffer(ids, dtype=np.int32), np.frombuffer(offsets, dtype=np.int64))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('EncodedTweets only supports contiguous slices')
+            stop = max(start, stop)
+            offsets = self.offsets[start:stop + 1]
+            return EncodedTweets(self.ids[offsets[0]:offsets[-1]], offsets - offsets[0])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('tweet index out of range')
+        return self.ids[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self):
+        ids, offsets = self.ids, self.offsets
+        for i in range(len(self)):
+            yield ids[offsets[i]:offsets[i + 1]]
+
+    def __add__(self, other : 'EncodedTweets') -> 'EncodedTweets':
+        return EncodedTweets(np.concatenate((self.ids, other.ids)),
+                             np.concatenate((self.offsets[:-1], other.offsets + self.offsets[-1])))
+
+    def lengths(self) -> np.ndarray:
+        '''
+        Return the number of tokens in each tweet.
+        '''
+        return np.diff(self.offsets)
+
+    def nbytes(self) -> int:
+        '''
+        Return the number of bytes used by the id and offset arrays.
+        '''
+        return self.ids.nbytes + self.offsets.nbytes
+
 # parse and load the tweets
-def process_tweets(pos_name : str, neg_name : str, stopwords_name : str)  -> tuple[(list[str], list[str], list[str])] :
+def process_tweets(pos_name : str, neg_name : str, stopwords_name : str,
+                   vocab : Vocabulary = None)  -> tuple[(list[str], list[str], list[str], RawTweetStore, RawTweetStore)] :
     '''
     process_tweets takes three arguments that are file names of
     positive tweets, negative tweets, and stopwords. It then cleans
@@ -152,52 +371,172 @@ def process_tweets(pos_name : str, neg_name : str, stopwords_name : str)  -> tup
     pos_name -- the file name of the positive tweet set
     neg_name -- the file name of the negative tweet set
     stopwords_name -- the file name of the stopwords list
+    vocab -- when given, the processed tweets are returned as EncodedTweets
+      of token ids from this Vocabulary instead of lists of strings
 
     Returns:
-    Three values, a list of strings of the positive tweets, a list of strings
-    of the negative tweets, and a list of strings of the stopwords 
+    Five values, a list of strings of the positive tweets, a list of strings
+    of the negative tweets, a list of strings of the stopwords, and the
+    RawTweetStore of the positive and of the negative tweet file. A tweet's
+    index in the processed list is its index in the store, so its raw text
+    can be read back when it's needed.
     '''
     # punctuation words
     punctuation = string.punctuation
     stopwords = parse_stopwords(stopwords_name)
     
-    # read the samples as json files and get the list of 
-    # positive and negative tweets from each file
-    pos_tweets = load_tweets(pos_name)
-    neg_tweets = load_tweets(neg_name)
+    # index the samples as json files, the text of each tweet is
+    # only read when it's processed
+    pos_tweets = RawTweetStore(pos_name)
+    neg_tweets = RawTweetStore(neg_name)
 
     # now create a tokenizer and porter stemmer so we can reuse 
     # them each function call when calling process tweets
+    from nltk.tokenize import TweetTokenizer
+    from nltk.stem import PorterStemmer
     tokenizer = TweetTokenizer(preserve_case = False, 
                                strip_handles = True,
                                reduce_len=True)
     stemmer = PorterStemmer()
 
-    # now process each tweet and create a new list of processed positive and negative tweets
+    # keep the processed tweets as token lists, or as token ids when
+    # a vocabulary is given
+    if vocab is None:
+        collect = list
+    else:
+        collect = lambda tweets: EncodedTweets.from_token_lists(tweets, vocab)
 
-    # Process positive tweets
-    processed_pos_tweets = []
-    for tweet in pos_tweets:
-        processed_tweet = process_tweet(tweet, stopwords, punctuation, tokenizer, stemmer)
-        processed_pos_tweets.append(processed_tweet)
-
-    # Process negative tweets
-    processed_neg_tweets = []
-    for tweet in neg_tweets:
-        processed_tweet = process_tweet(tweet, stopwords, punctuation, tokenizer, stemmer)
-        processed_neg_tweets.append(processed_tweet)
+    # now process each tweet and create a new list of processed positive and negative tweets
+    processed_pos_tweets = collect(process_tweet(tweet, stopwords, punctuation, tokenizer, stemmer)
+                                   for tweet in pos_tweets)
+    processed_neg_tweets = collect(process_tweet(tweet, stopwords, punctuation, tokenizer, stemmer)
+                                   for tweet in neg_tweets)
     
     # now return the processed tweets and any used stopwords
     return processed_pos_tweets, processed_neg_tweets, stopwords, pos_tweets, neg_tweets
 
 
+# everything about how process_tweets turns a raw tweet into tokens, if any
+# of it changes the processed tweets change too, so it's part of the cache key
+PIPELINE_CONFIG = {
+    'version': 1,
+    'cleanup': [r'^RT', r'https?://\S+', r'#'],
+    'tokenizer': {'class': 'TweetTokenizer',
+                  'preserve_case': False,
+                  'strip_handles': True,
+                  'reduce_len': True},
+    'stemmer': 'PorterStemmer',
+    'punctuation': string.punctuation,
+    # read from the package metadata so making the key doesn't import nltk
+    'nltk': version('nltk'),
+}
+
+def corpus_cache_key(pos_name : str, neg_name : str, stopwords_name : str,
+                     config : dict = PIPELINE_CONFIG) -> str:
+    '''
+    Hash the contents of the tweet and stopword files together with the
+    pipeline configuration, so the key changes whenever any of them do.
+
+    Returns: the hex digest of the hash
+    '''
+    digest = hashlib.sha256()
+    digest.update(json.dumps(config, sort_keys=True).encode('utf-8'))
+    for filename in (pos_name, neg_name, stopwords_name):
+        # hash the length first so the file boundaries can't shift
+        digest.update(str(os.path.getsize(filename)).encode('utf-8'))
+        with open(filename, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+def _save_cached_corpus(path : str, pos_tweets : EncodedTweets, neg_tweets : EncodedTweets,
+                        stopwords : list[str], vocab : Vocabulary) -> None:
+    '''
+    Write a processed corpus to the directory path. The files are written
+    to a temporary directory that's renamed into place, so a cache entry
+    is never seen half written.
+    '''
+    tmp_path = f'{path}.tmp-{os.getpid()}'
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(os.path.join(tmp_path, 'pos_ids.npy'), pos_tweets.ids)
+    np.save(os.path.join(tmp_path, 'pos_offsets.npy'), pos_tweets.offsets)
+    np.save(os.path.join(tmp_path, 'neg_ids.npy'), neg_tweets.ids)
+    np.save(os.path.join(tmp_path, 'neg_offsets.npy'), neg_tweets.offsets)
+    with open(os.path.join(tmp_path, 'vocab.json'), 'w') as file:
+        json.dump({'tokens': vocab.tokens, 'stopwords': stopwords}, file)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process cached the same corpus first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+def _load_cached_corpus(path : str) -> tuple[EncodedTweets, EncodedTweets, list[str], Vocabulary]:
+    '''
+    Read a processed corpus written by _save_cached_corpus, the token id
+    arrays are memory-mapped rather than read in.
+    '''
+    def load(name):
+        return np.load(os.path.join(path, name), mmap_mode='r')
+    pos_tweets = EncodedTweets(load('pos_ids.npy'), load('pos_offsets.npy'))
+    neg_tweets = EncodedTweets(load('neg_ids.npy'), load('neg_offsets.npy'))
+    with open(os.path.join(path, 'vocab.json'), 'r') as file:
+        data = json.load(file)
+    return pos_tweets, neg_tweets, data['stopwords'], Vocabulary(data['tokens'])
+
+def process_tweets_cached(pos_name : str, neg_name : str, stopwords_name : str,
+                          cache_dir : str = '.tweet_cache') -> tuple[EncodedTweets, EncodedTweets, list[str], Vocabulary]:
+    '''
+    Same as process_tweets with a vocabulary, but the processed tweets are
+    kept on disk under cache_dir. The cache entry is named by
+    corpus_cache_key, so changing the tweet files, the stopwords file or
+    the pipeline makes a new entry and the old one is never used again.
+
+    Parameters:
+    pos_name -- the file name of the positive tweet set
+    neg_name -- the file name of the negative tweet set
+    stopwords_name -- the file name of the stopwords list
+    cache_dir -- the directory holding the cached corpora
+
+    Returns:
+    The positive and negative tweets as EncodedTweets, the list of
+    stopwords, and the Vocabulary the token ids come from
+    '''
+    path = os.path.join(cache_dir, corpus_cache_key(pos_name, neg_name, stopwords_name))
+    if os.path.isdir(path):
+        return _load_cached_corpus(path)
+
+    vocab = Vocabulary()
+    pos_tweets, neg_tweets, stopwords, pos_raw, neg_raw = process_tweets(pos_name, neg_name, stopwords_name, vocab)
+    pos_raw.close()
+    neg_raw.close()
+    os.makedirs(cache_dir, exist_ok=True)
+    _save_cached_corpus(path, pos_tweets, neg_tweets, stopwords, vocab)
+    return pos_tweets, neg_tweets, stopwords, vocab
+
+
+# the tokenizer and stemmer process_tweet uses when it isn't given any, made
+# on the first call and shared by every call after it
+_defaults = {}
+
+def _default_tokenizer() -> 'TweetTokenizer':
+    if 'tokenizer' not in _defaults:
+        from nltk.tokenize import TweetTokenizer
+        _defaults['tokenizer'] = TweetTokenizer(preserve_case = False,
+                                                strip_handles = True,
+                                                reduce_len=True)
+    return _defaults['tokenizer']
+
+def _default_stemmer() -> 'PorterStemmer':
+    if 'stemmer' not in _defaults:
+        from nltk.stem import PorterStemmer
+        _defaults['stemmer'] = PorterStemmer()
+    return _defaults['stemmer']
+
 def process_tweet(tweet : str, 
                   stopwords: list[str],
                   punctuation = string.punctuation,
-                  tokenizer = TweetTokenizer(preserve_case = False, 
-                                             strip_handles = True,
-                                             reduce_len=True),
-                  stemmer = PorterStemmer()) -> list[str]:
+                  tokenizer = None,
+                  stemmer = None) -> list[str]:
     '''
     Processes an individual tweet, returning its stemmed version.
 
@@ -207,14 +546,20 @@ def process_tweet(tweet : str,
         to preserving case (so that all words are converted to lowercase),
         stripping handles, and reducing the length of the tweet. Reducing
         the lenght means that any characters repeated more than 3 times will
-        be reduced to 3 characters. So Hiiiiii would be Hiii. 
+        be reduced to 3 characters. So Hiiiiii would be Hiii. The default
+        tokenizer is created on the first call that needs it.
       stemmer -- a stemmer object that takes a string and returns its stem,
         if there is one, or the same string back otherwise. The default is
-        the PorterStemmer from nltk. The object requires a stem method that
-        takes a string and returns the stem of the string.
+        the PorterStemmer from nltk, also created on first use. The object
+        requires a stem method that takes a string and returns the stem of
+        the string.
 
     Return: a list of tokens that have been processed
     '''
+    if tokenizer is None:
+        tokenizer = _default_tokenizer()
+    if stemmer is None:
+        stemmer = _default_stemmer()
     # first cleanup the tweet
     cleaned_tweet = cleanup_tweet(tweet)
     
@@ -238,10 +583,11 @@ def test_tweet_processing():
 
     # try processing all of the positive and negative tweets now!
     print(f'processing all of the tweets now...')
-    pos_tweets, neg_tweets, stopwords = process_tweets('TweetProcessor/positive_tweets.json', 'TweetProcessor/negative_tweets.json', 'TweetProcessor/english_stopwords.txt')
+    pos_tweets, neg_tweets, stopwords, pos_raw, neg_raw = process_tweets('TweetProcessor/positive_tweets.json', 'TweetProcessor/negative_tweets.json', 'TweetProcessor/english_stopwords.txt')
     print(f'done!')
 
-    print(f'random positive tweet: {pos_tweets[random.randint(0, len(pos_tweets) - 1)]}')
+    index = random.randint(0, len(pos_tweets) - 1)
+    print(f'random positive tweet: {pos_raw[index]} -> {pos_tweets[index]}')
     print(f'random negative tweet: {neg_tweets[random.randint(0, len(neg_tweets) - 1)]}')
     print(f'random stopword: {stopwords[random.randint(0, len(stopwords) - 1)]}')
     
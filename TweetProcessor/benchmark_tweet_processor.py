@@ -0,0 +1,239 @@
+'''
+File: benchmark_tweet_processor.py
+Author: Lucy Kien
+
+Benchmarks for tweet_processor. Synthetic tweet corpora of increasing size
+are generated, and each stage of process_tweet (cleanup, tokenize, stopword
+and punctuation removal, stemming) is timed separately, along with the full
+process_tweets. Results are printed, and saved to a json file with --output
+so runs from different commits can be compared.
+
+Run from the repository root, for example:
+    python TweetProcessor/benchmark_tweet_processor.py --sizes 10000 100000 --output results.json
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import tweet_processor as tp
+
+# words for the synthetic tweets, roughly ordered from most to least common
+# so that picking them with zipf-like weights gives a realistic vocabulary
+WORDS = ('i the to a you and my is it in for of me so on that have be just '
+         'love day good happy thanks great today follow now new see back '
+         'time like get one know can what night miss sad sorry hope best '
+         'friends fun weekend work sleep tomorrow feel lol haha omg wish '
+         'morning birthday amazing tired hate bad awful cry pain rain '
+         'stream music movie game video photo watching waiting loving '
+         'followed following followers beautiful sunshine coffee').split()
+EXTRAS = (':)', ':(', ':-)', ':D', ':p', 'xD', '<3', '!', '!!', '?', '...', ',',
+          '.', '&amp;', 'soooo', 'yessss', 'noooo', 'pleaseeee')
+
+
+def make_tweet(rng : random.Random) -> str:
+    '''
+    Build one synthetic tweet: a mix of common words, emoticons and
+    punctuation, with the occasional handle, hashtag, URL or RT prefix.
+    '''
+    words = []
+    for _ in range(rng.randint(3, 20)):
+        roll = rng.random()
+        if roll < 0.75:
+            # zipf-like, the first words are picked far more often
+            words.append(WORDS[min(int(rng.paretovariate(1.0)) - 1, len(WORDS) - 1)])
+        elif roll < 0.9:
+            words.append(rng.choice(EXTRAS))
+        elif roll < 0.94:
+            words.append(f'@user{rng.randint(0, 5000)}')
+        elif roll < 0.98:
+            words.append(f'#{rng.choice(WORDS)}{rng.randint(0, 50)}')
+        else:
+            words.append(f'https://t.co/{rng.getrandbits(40):x}')
+    if rng.random() < 0.2:
+        words.insert(0, 'RT')
+    if rng.random() < 0.3:
+        words[0] = words[0].capitalize()
+    return ' '.join(words)
+
+
+def write_corpus(filename : str, size : int, seed : int) -> None:
+    '''
+    Write size synthetic tweets to filename, one json object per line, with
+    a few extra fields so the json looks like a real tweet.
+    '''
+    rng = random.Random(seed)
+    with open(filename, 'w') as file:
+        for i in range(size):
+            tweet = {'id': i, 'text': make_tweet(rng), 'lang': 'en',
+                     'user': {'id': rng.getrandbits(32), 'followers_count': rng.randint(0, 10000)}}
+            file.write(json.dumps(tweet) + '\n')
+
+
+def peak_rss_mb(who : int = resource.RUSAGE_SELF) -> float:
+    '''
+    Return the peak resident set size in megabytes of this process, or
+    with RUSAGE_CHILDREN of the largest child process that has finished,
+    such as a process_tweets pool worker.
+    '''
+    peak = resource.getrusage(who).ru_maxrss
+    # linux reports kilobytes, macOS reports bytes
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024
+
+
+def benchmark_stages(filename : str, stopwords : list[str], tokenizer_backend : str,
+                     batch_size : int = 10000) -> dict[str, float]:
+    '''
+    Time each stage of processing every tweet of filename, with the same
+    TweetPipeline configuration process_tweets runs, doing what
+    TweetPipeline.process does one stage at a time. Tweets go through the
+    stages a batch at a time so memory stays bounded.
+
+    Returns: the total seconds spent in each stage
+    '''
+    pipeline = tp.TweetPipeline(stopwords, tp.PUNCTUATION, tp.make_tokenizer(tokenizer_backend))
+    tokenize = pipeline.tokenizer.tokenize
+    removed = pipeline.removed
+    stem = pipeline.stemmer.stem
+    times = {'load': 0.0, 'cleanup': 0.0, 'tokenize': 0.0, 'filter': 0.0, 'stem': 0.0}
+
+    tweets = tp.iter_tweets(filename)
+    while True:
+        start = time.perf_counter()
+        batch = [tweet for _, tweet in zip(range(batch_size), tweets)]
+        times['load'] += time.perf_counter() - start
+        if not batch:
+            break
+
+        start = time.perf_counter()
+        cleaned = [pipeline.cleanup(tweet) for tweet in batch]
+        times['cleanup'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        tokens = [tokenize(tweet) for tweet in cleaned]
+        times['tokenize'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        filtered = [[token for token in toks if token not in removed] for toks in tokens]
+        times['filter'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        for toks in filtered:
+            [stem(token) for token in toks]
+        times['stem'] += time.perf_counter() - start
+    return times
+
+
+def run_size(size : int, seed : int, stopwords_name : str, tokenizer_backend : str,
+             workers : int) -> dict:
+    '''
+    Generate a corpus of size tweets and benchmark it. This runs in its own
+    process so the peak RSS belongs to this corpus size alone.
+    '''
+    stopwords = tp.parse_stopwords(stopwords_name)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pos_name = os.path.join(tmp_dir, 'positive.json')
+        neg_name = os.path.join(tmp_dir, 'negative.json')
+        write_corpus(pos_name, size // 2, seed)
+        write_corpus(neg_name, size - size // 2, seed + 1)
+
+        stage_times = benchmark_stages(pos_name, stopwords, tokenizer_backend)
+        neg_times = benchmark_stages(neg_name, stopwords, tokenizer_backend)
+        for stage in stage_times:
+            stage_times[stage] += neg_times[stage]
+        stage_total = sum(stage_times.values())
+
+        start = time.perf_counter()
+        tp.process_tweets(pos_name, neg_name, stopwords_name, workers=workers,
+                          tokenizer_backend=tokenizer_backend)
+        end_to_end = time.perf_counter() - start
+
+    return {
+        'tweets': size,
+        'stages': {stage: {'seconds': seconds,
+                           'tweets_per_sec': size / seconds if seconds else None,
+                           'share': seconds / stage_total}
+                   for stage, seconds in stage_times.items()},
+        'process_tweets': {'seconds': end_to_end, 'tweets_per_sec': size / end_to_end},
+        'peak_rss_mb': peak_rss_mb(),
+        # the pool workers have all been joined by now, each can be as
+        # large as the largest one and they all run at once
+        'peak_worker_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN),
+        'peak_total_rss_mb': peak_rss_mb() + (workers * peak_rss_mb(resource.RUSAGE_CHILDREN) if workers > 1 else 0.0),
+    }
+
+
+def git_commit() -> str:
+    '''
+    Return the commit the benchmark is running on, or None outside of git.
+    '''
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(result : dict) -> None:
+    '''
+    Print the results for one corpus size.
+    '''
+    print(f"{result['tweets']} tweets: process_tweets {result['process_tweets']['tweets_per_sec']:.0f} tweets/sec, "
+          f"peak RSS {result['peak_total_rss_mb']:.1f} MB ({result['peak_rss_mb']:.1f} MB main process, "
+          f"{result['peak_worker_rss_mb']:.1f} MB largest worker)")
+    for stage, timing in result['stages'].items():
+        print(f"  {stage:<9} {timing['seconds']:8.3f}s  {timing['share']:6.1%}  "
+              f"{timing['tweets_per_sec']:.0f} tweets/sec")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the stages of tweet processing.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000, 10000000],
+                        help='the corpus sizes to benchmark, in tweets')
+    parser.add_argument('--stopwords', default='TweetProcessor/english_stopwords.txt',
+                        help='the stopwords file')
+    parser.add_argument('--tokenizer', choices=tp.TOKENIZER_BACKENDS, default='nltk',
+                        help='the tokenizer backend')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='the number of processes for the process_tweets run')
+    parser.add_argument('--seed', type=int, default=0, help='the seed for the synthetic tweets')
+    parser.add_argument('--output', help='the json file the results are written to, '
+                                         'they are only printed when not given')
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        # a fresh process for each size, so each gets its own peak RSS
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            result = executor.submit(run_size, size, args.seed, args.stopwords,
+                                     args.tokenizer, args.workers).result()
+        print_result(result)
+        results.append(result)
+
+    report = {
+        'commit': git_commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'tokenizer': args.tokenizer,
+        'workers': args.workers,
+        'seed': args.seed,
+        'results': results,
+    }
+    if args.output is None:
+        return
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f'results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,349 @@
+'''
+File: tweet_follow.py
+Author: Lucy Kien
+
+Incremental processing of tweet files that keep growing. The byte offset
+reached in each file is saved to a checkpoint, so the next run only
+processes the lines added since then, and follow keeps watching the files
+and processes new lines as they're written, coping with files that are
+truncated or rotated (renamed away and replaced by a new file).
+
+Run from the repository root, for example:
+    python TweetProcessor/tweet_follow.py --checkpoint tweets.ckpt --follow tweets.json
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+
+import tweet_processor as tp
+
+
+# read and write the per file offsets
+def load_checkpoint(checkpoint_name : str) -> dict:
+    '''
+    Read a checkpoint written by save_checkpoint, an empty one is returned
+    if the file doesn't exist yet.
+
+    Returns: a dictionary from file name to its offset and inode
+    '''
+    try:
+        with open(checkpoint_name, 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+def save_checkpoint(checkpoint_name : str, checkpoint : dict) -> None:
+    '''
+    Write the checkpoint to a temporary file and rename it into place, so
+    a crash never leaves a half written checkpoint behind.
+    '''
+    tmp_name = f'{checkpoint_name}.tmp'
+    with open(tmp_name, 'w') as file:
+        json.dump(checkpoint, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_name, checkpoint_name)
+
+
+# one file being followed
+class FollowedFile:
+    '''
+    Reads the complete lines appended to a file since a byte offset. A line
+    that's still being written (no newline yet) is left for the next read.
+
+    The file is truncated if it's now shorter than the offset, and it's
+    been rotated if the name now points to a different inode; in both
+    cases reading starts over at the beginning of the file, after the rest
+    of a rotated file has been read. A file rotated between runs is found
+    again by its saved inode in the same directory, under whatever name
+    it was rotated to, so its unread tail isn't lost; if it's gone a
+    warning says how much may have been missed.
+    '''
+
+    def __init__(self, filename : str, offset : int = 0, inode : int = None):
+        '''
+        Parameters:
+          filename -- the name of the tweet file
+          offset -- the byte offset to continue from
+          inode -- the inode the offset belongs to, when it's different
+            from the file's inode the file was rotated and is read from 0
+        '''
+        self.filename = filename
+        self.offset = offset
+        self.inode = inode
+        self.file = None
+
+    def checkpoint(self) -> dict:
+        '''
+        Return the position to save in the checkpoint.
+        '''
+        return {'offset': self.offset, 'inode': self.inode}
+
+    def _open(self) -> bool:
+        '''
+        Open the file if it isn't already open, returning False if it
+        doesn't exist (a rotated file that hasn't been recreated yet).
+        '''
+        if self.file is not None:
+            return True
+        try:
+            self.file = open(self.filename, 'rb')
+        except FileNotFoundError:
+            return False
+        inode = os.fstat(self.file.fileno()).st_ino
+        if self.inode is not None and inode != self.inode:
+            # rotated again since _finish_rotated looked
+            print(f'{self.filename} was rotated while opening it, lines after byte '
+                  f'{self.offset} of the old file may be lost', file=sys.stderr)
+            self.offset = 0
+        self.inode = inode
+        return True
+
+    def _find_rotated(self):
+        '''
+        Return the name the file with the saved inode was rotated to, in
+        the same directory as the followed file, or None if it's gone.
+        '''
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.inode() == self.inode and entry.is_file(follow_symlinks=False):
+                    return entry.path
+        return None
+
+    def _finish_rotated(self):
+        '''
+        Yield the rest of the file the saved offset belongs to, if the
+        file was rotated since the checkpoint was saved, and start the
+        new file from the beginning.
+        '''
+        try:
+            if os.stat(self.filename).st_ino == self.inode:
+                return
+        except FileNotFoundError:
+            pass
+        rotated_name = self._find_rotated()
+        if rotated_name is None:
+            print(f'{self.filename} was rotated and the old file is gone, lines after byte '
+                  f'{self.offset} of it may be lost', file=sys.stderr)
+        else:
+            with open(rotated_name, 'rb') as file:
+                file.seek(self.offset)
+                for line in file:
+                    # nothing more will be written to the old file, so a
+                    # last line without a newline is complete too
+                    self.offset += len(line)
+                    yield line
+        self.offset = 0
+        self.inode = None
+
+    def _close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def read_lines(self):
+        '''
+        Yield each complete line added since the last read. The offset is
+        moved past a line as it's yielded, so a checkpoint taken between
+        lines never skips or repeats one.
+        '''
+        if self.file is None and self.inode is not None:
+            yield from self._finish_rotated()
+        if not self._open():
+            return
+        if os.fstat(self.file.fileno()).st_size < self.offset:
+            # truncated, the old content is gone so start over
+            self.offset = 0
+        self.file.seek(self.offset)
+        for line in self.file:
+            if not line.endswith(b'\n'):
+                break
+            self.offset += len(line)
+            yield line
+
+        try:
+            rotated = os.stat(self.filename).st_ino != self.inode
+        except FileNotFoundError:
+            rotated = True
+        if rotated:
+            # nothing more will be written to the old file, so a last line
+            # without a newline is complete too
+            self.file.seek(self.offset)
+            rest = self.file.read()
+            if rest.strip():
+                self.offset += len(rest)
+                yield rest
+            self._close()
+            self.offset = 0
+            self.inode = None
+
+    def close(self) -> None:
+        self._close()
+
+
+class TweetFollower:
+    '''
+    Processes the new tweets of a set of files, keeping the offset reached
+    in each file in a checkpoint file. A line that isn't a tweet is
+    skipped, counted in errors and reported on stderr, so it can't stop
+    the checkpoint moving past it.
+    '''
+
+    def __init__(self, filenames : list[str], checkpoint_name : str,
+                 pipeline : 'tp.TweetPipeline', backend : str = 'auto'):
+        '''
+        Parameters:
+          filenames -- the tweet files to follow
+          checkpoint_name -- the file the offsets are saved to
+          pipeline -- the TweetPipeline the tweets are processed with
+          backend -- the json backend, see tweet_processor.get_text_extractor
+        '''
+        self.checkpoint_name = checkpoint_name
+        self.pipeline = pipeline
+        self.extract = tp.get_text_extractor(backend)
+        checkpoint = load_checkpoint(checkpoint_name)
+        self.files = []
+        for filename in filenames:
+            saved = checkpoint.get(os.path.abspath(filename), {})
+            self.files.append(FollowedFile(filename, saved.get('offset', 0), saved.get('inode')))
+        # the lines of each file that couldn't be processed
+        self.errors = {filename: 0 for filename in filenames}
+        self._saved = self._positions()
+
+    def _positions(self) -> list[dict]:
+        return [followed.checkpoint() for followed in self.files]
+
+    def moved(self) -> bool:
+        '''
+        Return whether any offset has moved since the last save.
+        '''
+        return self._positions() != self._saved
+
+    def save(self) -> None:
+        '''
+        Save the current offset of every file. Files in the checkpoint that
+        aren't followed by this follower are kept.
+        '''
+        checkpoint = load_checkpoint(self.checkpoint_name)
+        for followed in self.files:
+            checkpoint[os.path.abspath(followed.filename)] = followed.checkpoint()
+        save_checkpoint(self.checkpoint_name, checkpoint)
+        self._saved = self._positions()
+
+    def iter_new(self, filename : str):
+        '''
+        Yield the processed tokens of each tweet added to one of the
+        followed files since the last checkpoint, without saving. Lines
+        that can't be processed are skipped and counted.
+        '''
+        for followed in self.files:
+            if followed.filename == filename:
+                for line in followed.read_lines():
+                    if not line.strip():
+                        continue
+                    try:
+                        tokens = self.pipeline.process(self.extract(line))
+                    except (ValueError, KeyError, TypeError) as error:
+                        self.errors[filename] += 1
+                        print(f'skipping the line of {filename} ending at byte {followed.offset}: '
+                              f'{type(error).__name__}: {error}', file=sys.stderr)
+                        continue
+                    yield tokens
+                return
+        raise ValueError(f'{filename!r} is not being followed')
+
+    def process_new(self) -> dict[str, list[list[str]]]:
+        '''
+        Process the tweets added to every file since the last checkpoint,
+        then save the new offsets.
+
+        Returns: a dictionary from file name to its new processed tweets
+        '''
+        processed = {followed.filename: list(self.iter_new(followed.filename))
+                     for followed in self.files}
+        self.save()
+        return processed
+
+    def follow(self, poll_interval : float = 1.0, save_every : float = 5.0):
+        '''
+        Keep watching the files, yielding (file name, processed tokens) for
+        every new tweet as it's written. The checkpoint is saved at most
+        every save_every seconds while tweets arrive, and when the files
+        go idle if an offset has moved since the last save. This runs
+        until the generator is closed, which also saves the checkpoint.
+        '''
+        last_save = time.monotonic()
+        try:
+            while True:
+                found = False
+                for followed in self.files:
+                    for tokens in self.iter_new(followed.filename):
+                        found = True
+                        yield followed.filename, tokens
+                        if time.monotonic() - last_save >= save_every:
+                            self.save()
+                            last_save = time.monotonic()
+                if not found:
+                    if self.moved():
+                        self.save()
+                        last_save = time.monotonic()
+                    time.sleep(poll_interval)
+        finally:
+            if self.moved():
+                self.save()
+            for followed in self.files:
+                followed.close()
+
+
+def process_new_tweets(pos_name : str, neg_name : str, stopwords_name : str,
+                       checkpoint_name : str) -> tuple[list[list[str]], list[list[str]], list[str]]:
+    '''
+    The incremental version of tweet_processor.process_tweets: only the
+    tweets added to the positive and negative files since the previous
+    call with the same checkpoint are processed.
+
+    Returns:
+    The new processed positive tweets, the new processed negative tweets,
+    and the list of stopwords
+    '''
+    stopwords = tp.parse_stopwords(stopwords_name)
+    follower = TweetFollower([pos_name, neg_name], checkpoint_name, tp.TweetPipeline(stopwords))
+    processed = follower.process_new()
+    return processed[pos_name], processed[neg_name], stopwords
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Process the tweets added to growing tweet files.')
+    parser.add_argument('files', nargs='+', help='the tweet files to process')
+    parser.add_argument('--checkpoint', required=True, help='the file the offsets are saved to')
+    parser.add_argument('--stopwords', default='TweetProcessor/english_stopwords.txt',
+                        help='the stopwords file')
+    parser.add_argument('--follow', action='store_true',
+                        help='keep running and process tweets as they are written')
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help='seconds between checks for new tweets when following')
+    args = parser.parse_args()
+
+    pipeline = tp.TweetPipeline(tp.parse_stopwords(args.stopwords))
+    follower = TweetFollower(args.files, args.checkpoint, pipeline)
+    if not args.follow:
+        for filename, tweets in follower.process_new().items():
+            for tokens in tweets:
+                print(json.dumps({'file': filename, 'tokens': tokens}))
+        for filename, errors in follower.errors.items():
+            if errors:
+                print(f'skipped {errors} lines of {filename}', file=sys.stderr)
+        return
+    try:
+        for filename, tokens in follower.follow(args.poll_interval):
+            print(json.dumps({'file': filename, 'tokens': tokens}), flush=True)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
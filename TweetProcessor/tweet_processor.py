@@ -7,18 +7,299 @@ Python module to handle the processing of tweets. Generally, we use either
 process_tweet or process_tweets.
 '''
 
+import os
 import re
+import bz2
+import glob
+import gzip
+import lzma
+import queue
+import threading
+import html
+import html.entities
 import json
+import hashlib
+import mmap
 import string
 import random
+import time
+import tempfile
+from collections import deque, OrderedDict
+from multiprocessing import Pool
+from array import array
+from json.decoder import scanstring
+from typing import TYPE_CHECKING
 
-# import tweet tokenizer
-from nltk.tokenize import TweetTokenizer
-from nltk.stem import PorterStemmer 
+# nltk and numpy take most of the time it takes to import this module, so
+# they're imported where they're first used instead: a pool worker or a
+# short script that uses the fast tokenizer and no Vocabulary never loads
+# them at all
+if TYPE_CHECKING:
+    import numpy as np
+    from nltk.tokenize import TweetTokenizer
+    from nltk.stem import PorterStemmer
 
 
+# numpy, imported the first time anything asks for it
+def _np():
+    '''
+    Return the numpy module, importing it on the first call.
+    '''
+    import numpy
+    return numpy
+
+
+# orjson parses json several times faster than the json module, but it's
+# optional so fall back to the standard library when it isn't installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# the "text" key of a tweet, a quote inside a json string is always escaped
+# so this can only match a real key
+TEXT_KEY_RE = re.compile(r'"text"\s*:\s*"')
+
+# a json string or a bracket, for finding how deeply nested a key is
+JSON_NESTING_RE = re.compile(r'"(?:[^"\\]|\\.)*"|[{}\[\]]')
+
+def _is_top_level(line : str, position : int) -> bool:
+    '''
+    Return whether position in a line of json is directly inside the
+    outermost object, skipping over the strings before it.
+    '''
+    # the usual tweet, with no other bracket before the key at all
+    if line.startswith('{') and line.find('{', 1, position) < 0 and line.find('[', 0, position) < 0:
+        return True
+    if not line.lstrip().startswith('{'):
+        return False
+    depth = 0
+    for match in JSON_NESTING_RE.finditer(line, 0, position):
+        bracket = match.group()
+        if bracket in ('{', '['):
+            depth += 1
+        elif bracket in ('}', ']'):
+            depth -= 1
+    return depth == 1
+
+def _text_from_line_scan(line : bytes) -> str:
+    '''
+    Pull the text out of one line of json without parsing the rest of the
+    tweet. When "text" is a key exactly once and it belongs to the
+    outermost object it has to be the tweet's own text, so only that
+    string is decoded; otherwise (retweets with a nested tweet, or a tweet
+    with no text of its own, for example) the whole line is parsed, so a
+    missing text fails the same way json.loads(line)['text'] does.
+    '''
+    line = line.decode('utf-8')
+    match = TEXT_KEY_RE.search(line)
+    if (match is not None and TEXT_KEY_RE.search(line, match.end()) is None
+            and _is_top_level(line, match.start())):
+        return scanstring(line, match.end())[0]
+    return json.loads(line)['text']
+
+def _text_from_line_json(line : bytes) -> str:
+    '''
+    Pull the text out of one line of json by parsing the whole tweet.
+    '''
+    return json.loads(line)['text']
+
+def _text_from_line_orjson(line : bytes) -> str:
+    '''
+    Pull the text out of one line of json by parsing the whole tweet
+    with orjson.
+    '''
+    return orjson.loads(line)['text']
+
+# the ways a line of json can be turned into the text of a tweet
+TEXT_EXTRACTORS = {
+    'scan': _text_from_line_scan,
+    'json': _text_from_line_json,
+    'orjson': _text_from_line_orjson,
+}
+
+def get_text_extractor(backend : str = 'auto'):
+    '''
+    Return the function for a json backend name, 'auto' picks orjson when
+    it's installed and the scanner otherwise.
+    '''
+    if backend == 'auto':
+        backend = 'orjson' if orjson is not None else 'scan'
+    if backend == 'orjson' and orjson is None:
+        raise ValueError('the orjson backend needs the orjson package installed')
+    if backend not in TEXT_EXTRACTORS:
+        raise ValueError(f'unknown json backend {backend!r}, expected auto or one of {tuple(TEXT_EXTRACTORS)}')
+    return TEXT_EXTRACTORS[backend]
+
+def _iter_texts(lines, backend : str = 'auto'):
+    '''
+    Yield the text of each tweet from an iterable of lines of json as
+    bytes, skipping blank lines.
+    '''
+    extract = get_text_extractor(backend)
+    for line in lines:
+        if line and not line.isspace():
+            yield extract(line)
+
+# yield the text of each tweet in a buffer holding lines of json
+def iter_tweets_from_buffer(buffer, backend : str = 'auto'):
+    '''
+    Yield the text of each tweet of a bytes object or an mmap holding one
+    json tweet per line. Blank lines are skipped.
+
+    Parameters:
+    buffer -- bytes read in bulk from a tweet file, or an mmap of one
+    backend -- the json backend, see get_text_extractor
+    '''
+    if isinstance(buffer, mmap.mmap):
+        lines = iter(buffer.readline, b'')
+    else:
+        lines = buffer.splitlines()
+    yield from _iter_texts(lines, backend)
+
+# openers for compressed tweet shards, chosen by file extension; each one
+# decompresses as the file is read so nothing is written to disk
+COMPRESSED_OPENERS = {
+    '.gz': gzip.open,
+    '.bz2': bz2.open,
+    '.xz': lzma.open,
+    '.lzma': lzma.open,
+}
+
+# read a json file one line at a time and yield the text of each tweet
+def iter_tweets(filename: str, backend : str = 'auto'):
+    '''
+    Read a json file lazily, yielding the text of one tweet at a time.
+    Plain files are memory-mapped rather than read in, and gzip, bz2 and
+    xz files are decompressed as they're read, so this works on files of
+    any size.
+
+    Parameters:
+    filename -- the name of the json file to read, this assumes that
+    each line of the file is a complete json object that's a tweet
+    backend -- the json backend, see get_text_extractor
+    '''
+    # note that the json object will have a .text field which is the 
+    # actual content of the tweet--and what we want to yield
+    opener = COMPRESSED_OPENERS.get(os.path.splitext(filename)[1].lower())
+    if opener is not None:
+        with opener(filename, 'rb') as file:
+            yield from _iter_texts(file, backend)
+        return
+    with open(filename, 'rb') as file:
+        # an empty file can't be memory-mapped
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            yield from iter_tweets_from_buffer(buffer, backend)
+
+# turn a corpus spec into the list of shard files it names
+def expand_corpus(corpus) -> list[str]:
+    '''
+    Expand a corpus spec into a list of file names. A corpus is a file
+    name, a glob like 'tweets/pos-*.json.gz', or a list of either; globs
+    are expanded in sorted order so the shards are always read in the
+    same order.
+
+    Parameters:
+    corpus -- a file name, a glob, or a list of file names and globs
+    '''
+    if isinstance(corpus, (str, os.PathLike)):
+        corpus = [corpus]
+    shards = []
+    for pattern in corpus:
+        pattern = os.fspath(pattern)
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise FileNotFoundError(f'no tweet files match {pattern!r}')
+            shards.extend(matches)
+        else:
+            shards.append(pattern)
+    return shards
+
+def _read_shard(filename : str, backend : str, chunk_size : int,
+                chunks : queue.Queue, stop : threading.Event) -> None:
+    '''
+    Reader thread body: read a shard and put lists of up to chunk_size
+    tweets on the chunks queue, followed by None when the shard is done
+    (or the exception that stopped it). The queue is bounded, so a reader
+    that gets ahead of the processing waits here.
+    '''
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        for chunk in _iter_chunks(iter_tweets(filename, backend), chunk_size):
+            if not put(chunk):
+                return
+    except Exception as error:
+        put(error)
+        return
+    put(None)
+
+# read the tweets of every shard of a corpus
+def iter_corpus(corpus, backend : str = 'auto', readers : int = 4,
+                chunk_size : int = 1000):
+    '''
+    Yield the text of every tweet of a corpus, shard by shard in the order
+    expand_corpus gives. With more than one shard, up to readers shards
+    are read and decompressed on background threads while the tweets of
+    the current shard are being handled, each holding at most a few
+    chunks of tweets in memory.
+
+    Parameters:
+    corpus -- a file name, a glob, or a list of file names and globs
+    backend -- the json backend, see get_text_extractor
+    readers -- the number of shards read at the same time
+    chunk_size -- the number of tweets a reader hands over at a time
+    '''
+    shards = expand_corpus(corpus)
+    if readers <= 1 or len(shards) <= 1:
+        for shard in shards:
+            yield from iter_tweets(shard, backend)
+        return
+
+    stop = threading.Event()
+    pending = deque()
+    next_shard = 0
+
+    def start_reader():
+        nonlocal next_shard
+        chunks = queue.Queue(maxsize=4)
+        reader = threading.Thread(target=_read_shard, daemon=True,
+                                  args=(shards[next_shard], backend, chunk_size, chunks, stop))
+        reader.start()
+        pending.append(chunks)
+        next_shard += 1
+
+    try:
+        while next_shard < len(shards) and len(pending) < readers:
+            start_reader()
+        while pending:
+            chunks = pending.popleft()
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield from chunk
+            # the shard is done, so start reading the next one
+            if next_shard < len(shards):
+                start_reader()
+    finally:
+        # lets any readers still running exit if we stopped early
+        stop.set()
+
 # read a json file and store the tweets from it as a list of strings
-def load_tweets(filename: str) -> list[str]:
+def load_tweets(filename: str, backend : str = 'auto') -> list[str]:
     '''
     Read a json file and returns a list of
     strings representing the tweets.
@@ -26,21 +307,10 @@ def load_tweets(filename: str) -> list[str]:
     Parameters:
     filename -- the name of the json file to read, this assumes that
     each line of the file is a complete json object that's a tweet
+    backend -- the json backend, see get_text_extractor
     '''
-    tweets = []
-    # read the file line by line and use json.loads to read it in
-    # note that the json object will have a .text field which is the 
-    # actual content of the tweet--and what we want to return 
-    # read the file line by line
-    # open the file
-    with open(filename, 'r') as file:
-        # for each line in the file use json to load it
-        for line in file:
-            tweet_data = json.loads(line)
-            # append it to the tweets list 
-            tweets.append(tweet_data['text'])
-    # now return the tweets as a list
-    return tweets
+    # materialize the lazy reader into a list
+    return list(iter_tweets(filename, backend))
 
 # cleanup the tweets
 def cleanup_tweet(tweet : str) -> str:
@@ -68,7 +338,7 @@ def cleanup_tweet(tweet : str) -> str:
     return cleaned_tweet
 
 # tokenize the tweets
-def tokenize_tweet(tweet : str, tokenizer : TweetTokenizer) -> list[str]:
+def tokenize_tweet(tweet : str, tokenizer : 'TweetTokenizer') -> list[str]:
     '''
     Converts a tweets to a list of a list of tokens, each a string
 
@@ -83,6 +353,159 @@ def tokenize_tweet(tweet : str, tokenizer : TweetTokenizer) -> list[str]:
     # return the tweet with the tokenized version
     return tokens
 
+# a faster stand-in for TweetTokenizer(preserve_case=False, strip_handles=True,
+# reduce_len=True) built on the standard library re module
+class FastTweetTokenizer:
+    '''
+    Tokenizes tweets with one precompiled pattern holding the same token
+    rules as nltk's TweetTokenizer, run with a single findall. The handle
+    stripping and lengthening passes are plain re substitutions that are
+    skipped when the tweet can't need them, and html entities are only
+    decoded when the tweet has an & in it.
+
+    The output is meant to be the same as TweetTokenizer(preserve_case =
+    False, strip_handles = True, reduce_len = True); use test_fast_tokenizer
+    to compare the two on a set of tweets.
+    '''
+
+    # html entities like &amp; or &#128512;
+    ENTITY_RE = re.compile(r'&(#?(x?))([^&;\s]+);')
+
+    # handles, the same rule nltk uses: up to 15 word characters after an
+    # @ that isn't part of an email address
+    HANDLES_RE = re.compile(r"(?<![A-Za-z0-9_!@#\$%&*])@"
+                            r"(?:[A-Za-z0-9_]{15}(?!@)|[A-Za-z0-9_]{1,14}(?![A-Za-z0-9_]*@))")
+
+    # any character repeated three or more times
+    LENGTHENING_RE = re.compile(r'(.)\1{2,}')
+
+    # the emoticon rule, tokens containing one keep their case
+    EMOTICONS = r"""
+        (?:
+          [<>]?
+          [:;=8]                     # eyes
+          [\-o\*\']?                 # optional nose
+          [\)\]\(\[dDpP/\:\}\{@\|\\] # mouth
+          |
+          [\)\]\(\[dDpP/\:\}\{@\|\\] # mouth
+          [\-o\*\']?                 # optional nose
+          [:;=8]                     # eyes
+          [<>]?
+          |
+          </?3                       # heart
+        )"""
+    EMOTICON_RE = re.compile(EMOTICONS, re.VERBOSE | re.I)
+
+    # every token rule, tried in the same order as nltk tries them
+    TOKEN_RE = re.compile(r"""
+        (?:                                          # urls with a protocol or path
+          (?:https?:(?:/{1,3}|[a-z0-9%])|[a-z0-9.\-]{1,255}[.][a-z]{2,13}/)
+          (?:[^\s()<>{}\[\]]+|\([^\s()]{0,255}?\([^\s()]{1,255}\)[^\s()]{0,255}?\)|\([^\s]{1,255}?\))+
+          (?:\([^\s()]{0,255}?\([^\s()]{1,255}\)[^\s()]{0,255}?\)|\([^\s]{1,255}?\)|[^\s`!()\[\]{};:'".,<>?«»“”‘’])
+        )
+        |
+        (?:(?<!@)[a-z0-9]+(?:[.\-][a-z0-9]+){0,126}[.][a-z]{2,13}\b/?(?!@))   # naked domains
+        |
+        (?:(?:\+?[01][ *\-.\)]*)?(?:[\(]?\d{3}[ *\-.\)]*)?\d{3}[ *\-.\)]*\d{4})  # phone numbers
+        |
+        """ + EMOTICONS + r"""
+        |
+        <[^>\s]+>                                    # html tags
+        |
+        [\-]+>|<[\-]+                                # arrows
+        |
+        (?:@[\w_]+)                                  # handles that weren't stripped
+        |
+        (?:\#+[\w_]+[\w\'_\-]*[\w_]+)                # hash-tags
+        |
+        [\w.+-]{1,64}@[\w-]{1,63}\.(?:[\w-]\.?){1,251}[\w-]   # email addresses
+        |
+        .(?:[\U0001f3fb-\U0001f3ff]?(?:‍.[\U0001f3fb-\U0001f3ff]?)+|[\U0001f3fb-\U0001f3ff])  # emoji sequences
+        |
+        (?:[\U0001F1E6-\U0001F1FF]{2}
+           |\U0001F3F4\U000E0067\U000E0062\U000E0065\U000E006e\U000E0067\U000E007F
+           |\U0001F3F4\U000E0067\U000E0062\U000E0073\U000E0063\U000E0074\U000E007F
+           |\U0001F3F4\U000E0067\U000E0062\U000E0077\U000E006C\U000E0073\U000E007F)  # flags
+        |
+        (?:[^\W\d_](?:[^\W\d_]|['\-_])+[^\W\d_])     # words with apostrophes or dashes
+        |
+        (?:[+\-]?\d+[,/.:-]\d+[+\-]?)                # numbers, including fractions, decimals
+        |
+        (?:[\w_]+)                                   # words without apostrophes or dashes
+        |
+        (?:\.(?:\s*\.){1,})                          # ellipsis dots
+        |
+        (?:\S)                                       # everything else that isn't whitespace
+        """, re.VERBOSE | re.I)
+
+    @staticmethod
+    def _convert_entity(match) -> str:
+        '''
+        Replace one html entity with its character the way nltk does,
+        entities that can't be converted are removed.
+        '''
+        body = match.group(3)
+        number = None
+        if match.group(1):
+            try:
+                number = int(body, 16 if match.group(2) else 10)
+                # windows-1252 characters that are often sent as numbers
+                if 0x80 <= number <= 0x9F:
+                    return bytes((number,)).decode('cp1252')
+            except ValueError:
+                number = None
+        else:
+            number = html.entities.name2codepoint.get(body)
+        if number is not None:
+            try:
+                return chr(number)
+            except (ValueError, OverflowError):
+                pass
+        return ''
+
+    def tokenize(self, text : str) -> list[str]:
+        '''
+        Split a tweet into lowercased tokens, with handles stripped and
+        lengthened characters reduced to three.
+        '''
+        if '&' in text:
+            text = self.ENTITY_RE.sub(self._convert_entity, text)
+        if '@' in text:
+            # replace with a space so the text on either side stays apart
+            text = self.HANDLES_RE.sub(' ', text)
+        text = self.LENGTHENING_RE.sub(r'\1\1\1', text)
+        emoticon = self.EMOTICON_RE.search
+        tokens = []
+        for token in self.TOKEN_RE.findall(text):
+            lowered = token.lower()
+            # emoticons like :D keep their case, everything else is lowercased
+            if lowered != token and emoticon(token):
+                tokens.append(token)
+            else:
+                tokens.append(lowered)
+        return tokens
+
+# the tokenizer backends that can be selected by name
+TOKENIZER_BACKENDS = ('nltk', 'fast')
+
+def make_tokenizer(backend : str = 'nltk'):
+    '''
+    Create the tokenizer for a backend name.
+
+    Parameters:
+      backend -- 'nltk' for nltk's TweetTokenizer, or 'fast' for the
+        FastTweetTokenizer, both lowercasing, stripping handles and
+        reducing lengthening
+    '''
+    if backend == 'nltk':
+        from nltk.tokenize import TweetTokenizer
+        return TweetTokenizer(preserve_case = False, 
+                              strip_handles = True,
+                              reduce_len=True)
+    if backend == 'fast':
+        return FastTweetTokenizer()
+    raise ValueError(f'unknown tokenizer backend {backend!r}, expected one of {TOKENIZER_BACKENDS}')
+
 # here we remove the stopwords and punctuation
 def remove_stopwords_and_punctuation(tweet_toks : list[str], 
                                      stopwords : list[str], 
@@ -110,7 +533,7 @@ def remove_stopwords_and_punctuation(tweet_toks : list[str],
 # takes a list of tweets and returns the tweets with the stemmed words,
 # note that the argument is a list of a list of strings, since each element
 # of a tweet contains a list of tokens in that tweet
-def stem_tweet(tweet_toks : list[str], stemmer : PorterStemmer) -> list[str]:
+def stem_tweet(tweet_toks : list[str], stemmer : 'PorterStemmer') -> list[str]:
     '''
     Take a list of tweet tokens and stem each token, which will replace
     a word with its stem (and possibly just keep it if we can't stem it)
@@ -126,6 +549,72 @@ def stem_tweet(tweet_toks : list[str], stemmer : PorterStemmer) -> list[str]:
         stemmed_toks.append(stemmer.stem(token))
     return stemmed_toks
 
+# wraps a stemmer with a bounded least-recently-used cache of stems
+class CachingStemmer:
+    '''
+    A stemmer that remembers the stems of the most recently used tokens.
+    Tweet vocabularies are dominated by a few thousand common words, so
+    most calls to stem are answered from the cache instead of running
+    the Porter algorithm again.
+
+    Attributes:
+      maxsize -- the largest number of stems kept in the cache
+      hits -- the number of stem calls answered from the cache
+      misses -- the number of stem calls passed to the wrapped stemmer
+      evictions -- the number of stems dropped to stay within maxsize
+    '''
+
+    def __init__(self, stemmer = None, maxsize : int = 100000):
+        '''
+        Parameters:
+          stemmer -- the stemmer to wrap, defaults to a PorterStemmer
+          maxsize -- the largest number of stems kept in the cache
+        '''
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+        if stemmer is None:
+            from nltk.stem import PorterStemmer
+            stemmer = PorterStemmer()
+        self.stemmer = stemmer
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._cache = OrderedDict()
+
+    def stem(self, token : str) -> str:
+        '''
+        Return the stem of token, using the cached stem when there is one.
+        '''
+        cache = self._cache
+        if token in cache:
+            self.hits += 1
+            cache.move_to_end(token)
+            return cache[token]
+        self.misses += 1
+        stemmed = self.stemmer.stem(token)
+        cache[token] = stemmed
+        # drop the least recently used stem when the cache is full
+        if len(cache) > self.maxsize:
+            cache.popitem(last=False)
+            self.evictions += 1
+        return stemmed
+
+    def stats(self) -> dict[str, int]:
+        '''
+        Return the cache counters, along with the current cache size.
+        '''
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self._cache),
+                'maxsize': self.maxsize}
+
+    def clear(self) -> None:
+        '''
+        Empty the cache and reset the counters.
+        '''
+        self._cache.clear()
+        self.hits = self.misses = self.evictions = 0
+
 # read and return a list of stopwords
 def parse_stopwords(filename : str) -> list[str]:
     # read our stopwords from a file and return them as a list of strings
@@ -135,8 +624,681 @@ def parse_stopwords(filename : str) -> list[str]:
         stopwords = file.read().splitlines()
     return stopwords
 
+# punctuation words
+PUNCTUATION = [',', "'", '?', ".", "!", ";", ":", "&", "...", "(", ")", "/", ":(", ":)", ":-(", "-", ">:(", "xD", ":p", ".."]
+
+# the stages of process_tweet, in the order they run
+STAGES = ('cleanup', 'tokenize', 'filter', 'stem')
+
+# counters filled in by an instrumented process_tweet or TweetPipeline
+class PipelineStats:
+    '''
+    Time, call and token counters for each stage of processing a tweet,
+    plus a histogram of the time taken by each whole tweet. Processing
+    only records into it when one is passed in, otherwise the only cost
+    is checking for it.
+
+    Attributes:
+      times -- the seconds spent in each stage
+      calls -- the number of times each stage ran
+      tokens -- the number of tokens each stage produced
+      tweets -- the number of tweets processed, duplicates included
+      duplicates -- the tweets a TweetDeduplicator answered from an
+        earlier result instead of processing
+      latency_histogram -- tweet counts by latency, bucket i holds the
+        tweets that took under 2**i microseconds (and at least 2**(i-1))
+    '''
+
+    HISTOGRAM_BUCKETS = 32
+
+    def __init__(self, dump_every : float = None, dump_to : str = None):
+        '''
+        Parameters:
+          dump_every -- when given, dump the stats every this many seconds
+            while tweets are being processed
+          dump_to -- the file each dump is appended to as a line of json,
+            dumps are printed when not given
+        '''
+        self.times = dict.fromkeys(STAGES, 0.0)
+        self.calls = dict.fromkeys(STAGES, 0)
+        self.tokens = dict.fromkeys(STAGES, 0)
+        self.tweets = 0
+        self.duplicates = 0
+        self.latency_histogram = [0] * self.HISTOGRAM_BUCKETS
+        self.dump_every = dump_every
+        self.dump_to = dump_to
+        self._last_dump = time.monotonic()
+
+    def add(self, stage : str, seconds : float, tokens : int = 0) -> None:
+        '''
+        Record one run of a stage.
+        '''
+        self.times[stage] += seconds
+        self.calls[stage] += 1
+        self.tokens[stage] += tokens
+
+    def add_tweet(self, seconds : float, duplicate : bool = False) -> None:
+        '''
+        Record the time taken by one whole tweet, and dump the stats if
+        it's time to.
+        '''
+        self.tweets += 1
+        self.duplicates += duplicate
+        bucket = min(int(seconds * 1e6).bit_length(), self.HISTOGRAM_BUCKETS - 1)
+        self.latency_histogram[bucket] += 1
+        self._maybe_dump()
+
+    def add_duplicates(self, count : int) -> None:
+        '''
+        Record tweets answered from a deduplicator's earlier results
+        without timing them, as when the pool splits off duplicates.
+        '''
+        self.tweets += count
+        self.duplicates += count
+        self._maybe_dump()
+
+    def _maybe_dump(self) -> None:
+        if self.dump_every is not None and time.monotonic() - self._last_dump >= self.dump_every:
+            self.dump()
+
+    def merge(self, other : 'PipelineStats') -> None:
+        '''
+        Add the counters of other, such as the stats of a pool worker, to
+        these stats, and dump them if it's time to.
+        '''
+        for stage in STAGES:
+            self.times[stage] += other.times[stage]
+            self.calls[stage] += other.calls[stage]
+            self.tokens[stage] += other.tokens[stage]
+        self.tweets += other.tweets
+        self.duplicates += other.duplicates
+        for bucket, count in enumerate(other.latency_histogram):
+            self.latency_histogram[bucket] += count
+        self._maybe_dump()
+
+    def latency_percentile(self, percent : float) -> float:
+        '''
+        Return an upper bound in seconds on the given latency percentile,
+        taken from the histogram buckets, which leave out the duplicates
+        from add_duplicates.
+        '''
+        target = sum(self.latency_histogram) * percent / 100
+        seen = 0
+        for bucket, count in enumerate(self.latency_histogram):
+            seen += count
+            if count and seen >= target:
+                return (1 << bucket) / 1e6
+        return 0.0
+
+    def snapshot(self) -> dict:
+        '''
+        Return the stats as a dictionary that can be written as json.
+        '''
+        total = sum(self.times.values())
+        return {
+            'tweets': self.tweets,
+            'duplicates': self.duplicates,
+            'stages': {stage: {'seconds': self.times[stage],
+                               'calls': self.calls[stage],
+                               'tokens': self.tokens[stage],
+                               'share': self.times[stage] / total if total else 0.0}
+                       for stage in STAGES},
+            'latency_histogram_us': {f'<{1 << bucket}': count
+                                     for bucket, count in enumerate(self.latency_histogram) if count},
+            'latency_p50': self.latency_percentile(50),
+            'latency_p99': self.latency_percentile(99),
+        }
+
+    def dump(self) -> None:
+        '''
+        Write a snapshot of the stats to dump_to, or print it.
+        '''
+        self._last_dump = time.monotonic()
+        line = json.dumps(dict(self.snapshot(), time=time.time()))
+        if self.dump_to is None:
+            print(line)
+        else:
+            with open(self.dump_to, 'a') as file:
+                file.write(line + '\n')
+
+    def __getstate__(self):
+        # a stats object crossing from a pool worker only needs the counters
+        state = self.__dict__.copy()
+        state['dump_every'] = None
+        return state
+
+# a configured processing pipeline, built once and reused for every tweet
+class TweetPipeline:
+    '''
+    Holds everything process_tweet needs, prepared a single time: the
+    stopwords and punctuation as one set, a single regex doing all of the
+    cleanup_tweet substitutions, the tokenizer and the stemmer. The tokens
+    produced are the same as process_tweet with the same arguments.
+    '''
+
+    # the three cleanup_tweet substitutions as one pass: RT at the start
+    # of the tweet, http:// or https:// URLs, and the hash of a hash-tag
+    CLEANUP_PATTERN = re.compile(r'^RT|https?://\S+|#')
+
+    def __init__(self, stopwords : list[str],
+                 punctuation = PUNCTUATION,
+                 tokenizer = None,
+                 stemmer = None,
+                 stats : PipelineStats = None):
+        '''
+        Parameters:
+          stopwords -- a list of stopwords
+          punctuation -- a list of punctuation, or a string of punctuation
+            characters like string.punctuation
+          tokenizer -- a tokenizer with a tokenize method, such as one from
+            make_tokenizer, an nltk TweetTokenizer is created if not given
+          stemmer -- a stemmer, a CachingStemmer is created if not given
+          stats -- a PipelineStats to record each stage into, or None to
+            process without instrumentation
+        '''
+        if isinstance(punctuation, str):
+            # `token not in punctuation` on a string is a substring test,
+            # so every substring of it has to be treated as punctuation
+            punct_set = {punctuation[i:j] for i in range(len(punctuation))
+                                          for j in range(i + 1, len(punctuation) + 1)}
+        else:
+            punct_set = set(punctuation)
+        self.stopwords = set(stopwords)
+        self.punctuation = punct_set
+        self.removed = self.stopwords | self.punctuation
+        if tokenizer is None:
+            tokenizer = make_tokenizer('nltk')
+        if stemmer is None:
+            stemmer = CachingStemmer()
+        self.tokenizer = tokenizer
+        self.stemmer = stemmer
+        self.stats = stats
+
+    def cleanup(self, tweet : str) -> str:
+        '''
+        Same as cleanup_tweet, using the combined cleanup regex.
+        '''
+        return self.CLEANUP_PATTERN.sub('', tweet)
+
+    def process(self, tweet : str) -> list[str]:
+        '''
+        Clean up, tokenize, filter and stem a single tweet.
+        '''
+        stats = self.stats
+        if stats is None:
+            return self.process_cleaned(self.CLEANUP_PATTERN.sub('', tweet))
+        start = time.perf_counter()
+        cleaned = self.CLEANUP_PATTERN.sub('', tweet)
+        stats.add('cleanup', time.perf_counter() - start)
+        tokens = self.process_cleaned(cleaned)
+        stats.add_tweet(time.perf_counter() - start)
+        return tokens
+
+    def process_cleaned(self, cleaned : str) -> list[str]:
+        '''
+        Tokenize, filter and stem a tweet that's already been cleaned up.
+        '''
+        if self.stats is not None:
+            return self._process_cleaned_instrumented(cleaned)
+        removed = self.removed
+        stem = self.stemmer.stem
+        tokens = self.tokenizer.tokenize(cleaned)
+        return [stem(token) for token in tokens if token not in removed]
+
+    def _process_cleaned_instrumented(self, cleaned : str) -> list[str]:
+        '''
+        process_cleaned, recording the time and tokens of each stage.
+        '''
+        stats = self.stats
+        removed = self.removed
+        stem = self.stemmer.stem
+
+        start = time.perf_counter()
+        tokens = self.tokenizer.tokenize(cleaned)
+        tokenized = time.perf_counter()
+        kept = [token for token in tokens if token not in removed]
+        filtered = time.perf_counter()
+        stemmed = [stem(token) for token in kept]
+        done = time.perf_counter()
+
+        stats.add('tokenize', tokenized - start, len(tokens))
+        stats.add('filter', filtered - tokenized, len(kept))
+        stats.add('stem', done - filtered, len(stemmed))
+        return stemmed
+
+    def process_batch(self, tweets) -> list[list[str]]:
+        '''
+        Process each tweet of an iterable of tweets, in order.
+        '''
+        process = self.process
+        return [process(tweet) for tweet in tweets]
+
+# remembers the processed tokens of every distinct cleaned up tweet
+class TweetDeduplicator:
+    '''
+    Processes each distinct tweet only once. Tweets are keyed by a hash of
+    their cleaned up text, so retweets that only differ by the RT prefix,
+    URLs or hash marks share one result. Duplicates get the very same
+    token list as the first copy, so don't modify the lists in place.
+
+    Every distinct result is kept for the lifetime of the deduplicator, so
+    its memory grows with the number of distinct tweets.
+
+    Attributes:
+      tweets -- the number of tweets seen
+      duplicates -- the number of tweets that reused an earlier result
+      process_time -- seconds spent processing the distinct tweets
+    '''
+
+    def __init__(self):
+        self.results = {}
+        self.tweets = 0
+        self.duplicates = 0
+        self.process_time = 0.0
+
+    @staticmethod
+    def key(cleaned : str) -> bytes:
+        '''
+        Return the hash that identifies a cleaned up tweet.
+        '''
+        return hashlib.blake2b(cleaned.encode('utf-8'), digest_size=16).digest()
+
+    def process(self, tweet : str, pipeline : 'TweetPipeline') -> list[str]:
+        '''
+        Return the processed tokens of tweet, running pipeline only if
+        the same cleaned up text hasn't been seen before. With pipeline
+        stats, the cleanup is timed and every tweet is recorded, the
+        duplicates counted as such.
+        '''
+        stats = pipeline.stats
+        self.tweets += 1
+        start = time.perf_counter()
+        cleaned = pipeline.cleanup(tweet)
+        cleaned_at = time.perf_counter()
+        if stats is not None:
+            stats.add('cleanup', cleaned_at - start)
+        key = self.key(cleaned)
+        tokens = self.results.get(key)
+        if tokens is not None:
+            self.duplicates += 1
+            if stats is not None:
+                stats.add_tweet(time.perf_counter() - start, duplicate=True)
+            return tokens
+        tokens = pipeline.process_cleaned(cleaned)
+        done = time.perf_counter()
+        self.process_time += done - cleaned_at
+        if stats is not None:
+            stats.add_tweet(done - start)
+        self.results[key] = tokens
+        return tokens
+
+    def split(self, chunk : list[str]) -> tuple[list[bytes], list[str]]:
+        '''
+        For the process pool: return the key of every tweet of chunk, and
+        the tweets that still need processing (the first copy of each new
+        text). Pass the processed new tweets to resolve once they're back.
+        '''
+        keys = []
+        new_tweets = []
+        results = self.results
+        for tweet in chunk:
+            key = self.key(TweetPipeline.CLEANUP_PATTERN.sub('', tweet))
+            keys.append(key)
+            if key in results:
+                self.duplicates += 1
+            else:
+                # a placeholder until the worker's result comes back
+                results[key] = None
+                new_tweets.append(tweet)
+        self.tweets += len(chunk)
+        return keys, new_tweets
+
+    def resolve(self, keys : list[bytes], processed : list[list[str]],
+                process_time : float = 0.0) -> list[list[str]]:
+        '''
+        Store the results for the new tweets returned by split, in order,
+        and return the processed tokens of every tweet of the chunk.
+        '''
+        results = self.results
+        processed = iter(processed)
+        for key in keys:
+            if results[key] is None:
+                results[key] = next(processed)
+        self.process_time += process_time
+        return [results[key] for key in keys]
+
+    def stats(self) -> dict[str, float]:
+        '''
+        Return the counters along with the duplicate ratio and an estimate
+        of the time saved: the average time to process a distinct tweet
+        times the number of duplicates that skipped processing.
+        '''
+        unique = self.tweets - self.duplicates
+        per_tweet = self.process_time / unique if unique else 0.0
+        return {'tweets': self.tweets, 'unique': unique,
+                'duplicates': self.duplicates,
+                'duplicate_ratio': self.duplicates / self.tweets if self.tweets else 0.0,
+                'process_time': self.process_time,
+                'time_saved': per_tweet * self.duplicates}
+
+    def report(self) -> str:
+        '''
+        Return the stats as a line of text.
+        '''
+        stats = self.stats()
+        return (f"{stats['duplicates']} of {stats['tweets']} tweets were duplicates "
+                f"({stats['duplicate_ratio']:.1%}), saving about {stats['time_saved']:.2f}s")
+
+# maps each distinct token to a small integer id, shared by every tweet
+class Vocabulary:
+    '''
+    A two way mapping between tokens and integer ids. Ids are handed out
+    in the order tokens are first seen, starting at 0, so a token string
+    is only stored once however many tweets it appears in.
+    '''
+
+    def __init__(self, tokens = ()):
+        '''
+        Parameters:
+          tokens -- tokens to add to the vocabulary up front, in id order
+        '''
+        self.ids = {}
+        self.tokens = []
+        for token in tokens:
+            self.add(token)
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def __contains__(self, token : str) -> bool:
+        return token in self.ids
+
+    def add(self, token : str) -> int:
+        '''
+        Return the id of token, giving it the next id if it's new.
+        '''
+        token_id = self.ids.get(token)
+        if token_id is None:
+            token_id = len(self.tokens)
+            self.ids[token] = token_id
+            self.tokens.append(token)
+        return token_id
+
+    def encode(self, tweet_toks : list[str]) -> list[int]:
+        '''
+        Return the ids of a list of tokens, adding any new tokens.
+        '''
+        add = self.add
+        return [add(token) for token in tweet_toks]
+
+    def lookup(self, token : str, default : int = -1) -> int:
+        '''
+        Return the id of token without adding it, or default if it's unknown.
+        '''
+        return self.ids.get(token, default)
+
+    def decode(self, token_ids) -> list[str]:
+        '''
+        Return the tokens for a sequence of ids.
+        '''
+        tokens = self.tokens
+        return [tokens[token_id] for token_id in token_ids]
+
+# processed tweets stored as token ids in two flat arrays
+class EncodedTweets:
+    '''
+    A list of processed tweets in a compressed sparse row layout: ids holds
+    the token ids of every tweet back to back as an int32 array, and the
+    ids of tweet i are ids[offsets[i]:offsets[i + 1]]. This takes a small
+    fraction of the memory of a list of lists of strings.
+
+    Indexing with an int gives the id array of one tweet, indexing with a
+    slice gives a new EncodedTweets, and + joins two of them, so they can
+    be partitioned the same way as a list of tweets.
+    '''
+
+    def __init__(self, ids = None, offsets = None):
+        '''
+        Parameters:
+          ids -- the token ids of every tweet back to back
+          offsets -- where each tweet starts in ids, with one extra entry
+            at the end for the total number of ids
+        '''
+        np = _np()
+        self.ids = np.asarray(ids if ids is not None else [], dtype=np.int32)
+        self.offsets = np.asarray(offsets if offsets is not None else [0], dtype=np.int64)
+
+    @classmethod
+    def from_token_lists(cls, tweets, vocab : Vocabulary) -> 'EncodedTweets':
+        '''
+        Encode an iterable of processed tweets, adding their tokens to vocab.
+        The iterable is only walked once, so it can be a stream of tweets.
+        '''
+        ids = array('i')
+        offsets = array('q', [0])
+        add = vocab.add
+        for tweet_toks in tweets:
+            ids.extend([add(token) for token in tweet_toks])
+            offsets.append(len(ids))
+        np = _np()
+        return cls(np.frombuffer(ids, dtype=np.int32), np.frombuffer(offsets, dtype=np.int64))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('EncodedTweets only supports contiguous slices')
+            stop = max(start, stop)
+            offsets = self.offsets[start:stop + 1]
+            return EncodedTweets(self.ids[offsets[0]:offsets[-1]], offsets - offsets[0])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('tweet index out of range')
+        return self.ids[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self):
+        ids, offsets = self.ids, self.offsets
+        for i in range(len(self)):
+            yield ids[offsets[i]:offsets[i + 1]]
+
+    def __add__(self, other : 'EncodedTweets') -> 'EncodedTweets':
+        np = _np()
+        return EncodedTweets(np.concatenate((self.ids, other.ids)),
+                             np.concatenate((self.offsets[:-1], other.offsets + self.offsets[-1])))
+
+    def lengths(self) -> 'np.ndarray':
+        '''
+        Return the number of tokens in each tweet.
+        '''
+        return _np().diff(self.offsets)
+
+    def nbytes(self) -> int:
+        '''
+        Return the number of bytes used by the id and offset arrays.
+        '''
+        return self.ids.nbytes + self.offsets.nbytes
+
+# lazily read and process the tweets of a single file
+def iter_processed_tweets(corpus,
+                          stopwords : list[str],
+                          punctuation = PUNCTUATION,
+                          tokenizer = None,
+                          stemmer = None,
+                          readers : int = 4,
+                          dedup : TweetDeduplicator = None,
+                          stats : PipelineStats = None):
+    '''
+    Read a json file of tweets line by line and yield each tweet as a
+    processed list of tokens. Neither the raw tweets nor the processed
+    ones are kept around, so memory stays constant whatever the file size.
+
+    Parameters:
+    corpus -- the name of the json file of tweets, or a glob or list of
+      shards, see expand_corpus
+    stopwords -- a list of stopwords
+    punctuation -- a list of punctuation
+    tokenizer -- a TweetTokenizer, one is created if not given
+    stemmer -- a stemmer, a CachingStemmer is created if not given
+    readers -- the number of shards read at the same time, see iter_corpus
+    dedup -- a TweetDeduplicator, when given each distinct tweet is only
+      processed once
+    stats -- a PipelineStats to record each stage into
+    '''
+    # build the pipeline once and reuse it for every tweet of the file
+    pipeline = TweetPipeline(stopwords, punctuation, tokenizer, stemmer, stats)
+    if dedup is not None:
+        for tweet in iter_corpus(corpus, readers=readers):
+            yield dedup.process(tweet, pipeline)
+        return
+    for tweet in iter_corpus(corpus, readers=readers):
+        yield pipeline.process(tweet)
+
+# state for each process pool worker, built once by _init_worker so the
+# pipeline isn't pickled along with every chunk
+_worker_state = {}
+
+def _init_worker(stopwords : list[str], punctuation, tokenizer_backend : str = 'nltk',
+                 instrument : bool = False) -> None:
+    '''
+    Pool initializer that builds the per-worker TweetPipeline (tokenizer,
+    stemmer, stopword and punctuation sets) a single time at worker startup.
+    When instrument is set the pipeline records into a PipelineStats that's
+    sent back with each chunk.
+    '''
+    _worker_state['pipeline'] = TweetPipeline(stopwords, punctuation,
+                                              make_tokenizer(tokenizer_backend),
+                                              stats=PipelineStats() if instrument else None)
+
+def _process_chunk(chunk : list[str]) -> list[list[str]]:
+    '''
+    Process a chunk of raw tweets inside a pool worker using the
+    pipeline built by _init_worker.
+    '''
+    return _worker_state['pipeline'].process_batch(chunk)
+
+def _process_chunk_timed(chunk : list[str]) -> tuple[list[list[str]], float, PipelineStats]:
+    '''
+    Same as _process_chunk, but also returns the seconds it took and the
+    stats recorded for the chunk, if the worker is instrumented.
+    '''
+    pipeline = _worker_state['pipeline']
+    start = time.perf_counter()
+    processed = pipeline.process_batch(chunk)
+    elapsed = time.perf_counter() - start
+    stats = pipeline.stats
+    if stats is not None:
+        # start the next chunk with empty counters
+        pipeline.stats = PipelineStats()
+    return processed, elapsed, stats
+
+def _iter_chunks(tweets, chunk_size : int):
+    '''
+    Group an iterable of tweets into lists of at most chunk_size tweets.
+    '''
+    chunk = []
+    for tweet in tweets:
+        chunk.append(tweet)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def iter_processed_tweets_parallel(corpus,
+                                   pool : Pool,
+                                   workers : int,
+                                   chunk_size : int = 1000,
+                                   readers : int = 4,
+                                   dedup : TweetDeduplicator = None,
+                                   stats : PipelineStats = None):
+    '''
+    Same as iter_processed_tweets, but the file is split into chunks that
+    are processed by a pool created with _init_worker as its initializer.
+    Tweets are yielded in the same order as they appear in the file, and
+    only a couple of chunks per worker are in flight at any time.
+
+    Parameters:
+    corpus -- the name of the json file of tweets, or a glob or list of
+      shards, see expand_corpus
+    pool -- a multiprocessing Pool set up with _init_worker
+    workers -- the number of processes in the pool
+    chunk_size -- the number of tweets sent to a worker at a time
+    readers -- the number of shards read at the same time, see iter_corpus
+    dedup -- a TweetDeduplicator, when given only tweets whose cleaned up
+      text hasn't been seen before are sent to the workers
+    stats -- a PipelineStats the workers' stats are merged into, the pool
+      must have been started with instrument set
+    '''
+    if dedup is not None:
+        yield from _iter_dedup_parallel(corpus, pool, workers, chunk_size, readers, dedup, stats)
+        return
+    if stats is not None:
+        yield from _iter_instrumented_parallel(corpus, pool, workers, chunk_size, readers, stats)
+        return
+    pending = deque()
+    for chunk in _iter_chunks(iter_corpus(corpus, readers=readers), chunk_size):
+        pending.append(pool.apply_async(_process_chunk, (chunk,)))
+        # wait on the oldest chunk once enough work is queued up
+        if len(pending) >= 2 * workers:
+            yield from pending.popleft().get()
+    while pending:
+        yield from pending.popleft().get()
+
+def _iter_instrumented_parallel(corpus, pool : Pool, workers : int, chunk_size : int,
+                                readers : int, stats : PipelineStats):
+    '''
+    The instrumented version of iter_processed_tweets_parallel, merging
+    the stats each worker sends back with its chunk.
+    '''
+    def collect(result):
+        processed, _, chunk_stats = result.get()
+        stats.merge(chunk_stats)
+        return processed
+
+    pending = deque()
+    for chunk in _iter_chunks(iter_corpus(corpus, readers=readers), chunk_size):
+        pending.append(pool.apply_async(_process_chunk_timed, (chunk,)))
+        if len(pending) >= 2 * workers:
+            yield from collect(pending.popleft())
+    while pending:
+        yield from collect(pending.popleft())
+
+def _iter_dedup_parallel(corpus, pool : Pool, workers : int, chunk_size : int,
+                         readers : int, dedup : TweetDeduplicator,
+                         stats : PipelineStats = None):
+    '''
+    The deduplicating version of iter_processed_tweets_parallel. Chunks are
+    resolved in the order they were sent, so a duplicate of a tweet that's
+    still being processed always finds its result once its chunk is reached.
+    '''
+    def resolve(keys, result):
+        processed, process_time, chunk_stats = result.get()
+        if stats is not None:
+            # the workers only saw the new tweets, the rest were duplicates
+            stats.merge(chunk_stats)
+            stats.add_duplicates(len(keys) - len(processed))
+        return dedup.resolve(keys, processed, process_time)
+
+    pending = deque()
+    for chunk in _iter_chunks(iter_corpus(corpus, readers=readers), chunk_size):
+        keys, new_tweets = dedup.split(chunk)
+        pending.append((keys, pool.apply_async(_process_chunk_timed, (new_tweets,))))
+        if len(pending) >= 2 * workers:
+            yield from resolve(*pending.popleft())
+    while pending:
+        yield from resolve(*pending.popleft())
+
 # parse and load the tweets
-def process_tweets(pos_name : str, neg_name : str, stopwords_name : str) -> tuple[(list[str], list[str], list[str])] :
+def process_tweets(pos_name : str, neg_name : str, stopwords_name : str,
+                   workers : int = 1, chunk_size : int = 1000,
+                   stemmer = None, tokenizer_backend : str = 'nltk',
+                   vocab : Vocabulary = None, readers : int = 4,
+                   dedup : TweetDeduplicator = None,
+                   stats : PipelineStats = None) -> tuple[(list[str], list[str], list[str])] :
     '''
     process_tweets takes three arguments that are file names of
     positive tweets, negative tweets, and stopwords. It then cleans
@@ -144,54 +1306,84 @@ def process_tweets(pos_name : str, neg_name : str, stopwords_name : str) -> tupl
     and stemming the words in the tweets.
 
     Parameters:
-    pos_name -- the file name of the positive tweet set
-    neg_name -- the file name of the negative tweet set
+    pos_name -- the file name of the positive tweet set, or a glob or list
+      of (possibly compressed) shards, see expand_corpus
+    neg_name -- the file name of the negative tweet set, or a corpus spec
+      like pos_name
     stopwords_name -- the file name of the stopwords list
+    workers -- the number of processes to use, 1 processes everything
+      in this process
+    chunk_size -- the number of tweets handed to a worker at a time
+    stemmer -- the stemmer to use when workers is 1, a CachingStemmer is
+      created if not given (pass one in to read its hit/miss counters)
+    tokenizer_backend -- 'nltk' or 'fast', see make_tokenizer
+    vocab -- when given, the processed tweets are returned as EncodedTweets
+      of token ids from this Vocabulary instead of lists of strings
+    readers -- the number of shards of a corpus read at the same time
+    dedup -- a TweetDeduplicator, when given each distinct tweet is only
+      processed once; read its stats or report afterwards for the
+      duplicate ratio and the time saved
+    stats -- a PipelineStats, when given the time, calls and tokens of each
+      stage and the latency of each tweet are recorded into it (merged
+      from the workers when workers is more than 1)
 
     Returns:
     Three values, a list of strings of the positive tweets, a list of strings
     of the negative tweets, and a list of strings of the stopwords 
     '''
-    # punctuation words
-    punctuation = [',', "'", '?', ".", "!", ";", ":", "&", "...", "(", ")", "/", ":(", ":)", ":-(", "-", ">:(", "xD", ":p", ".."]
-    
-    # read the samples as json files and get the list of 
-    # positive and negative tweets from each file
-    pos_tweets = load_tweets(pos_name)
-    neg_tweets = load_tweets(neg_name)
+    stopwords = parse_stopwords(stopwords_name)
+
+    # keep the processed tweets as token lists, or as token ids when
+    # a vocabulary is given
+    if vocab is None:
+        collect = list
+    else:
+        collect = lambda tweets: EncodedTweets.from_token_lists(tweets, vocab)
+
+    # split the files into chunks for a pool of workers, the pool is
+    # shared by both files so the workers are only started once
+    if workers > 1:
+        with Pool(workers, initializer=_init_worker, initargs=(stopwords, PUNCTUATION, tokenizer_backend,
+                                                            stats is not None)) as pool:
+            processed_pos_tweets = collect(iter_processed_tweets_parallel(pos_name, pool, workers, chunk_size, readers, dedup, stats))
+            processed_neg_tweets = collect(iter_processed_tweets_parallel(neg_name, pool, workers, chunk_size, readers, dedup, stats))
+        return processed_pos_tweets, processed_neg_tweets, stopwords
 
     # now create a tokenizer and porter stemmer so we can reuse 
-    # them each function call when calling process tweets
-    tokenizer = TweetTokenizer(preserve_case = False, 
-                               strip_handles = True,
-                               reduce_len=True)
-    stemmer = PorterStemmer()
-
-    # now process each tweet and create a new list of processed positive and negative tweets
-
-    # Process positive tweets
-    processed_pos_tweets = []
-    for tweet in pos_tweets:
-        processed_tweet = process_tweet(tweet, stopwords_name, punctuation, tokenizer, stemmer)
-        processed_pos_tweets.append(processed_tweet)
-
-    # Process negative tweets
-    processed_neg_tweets = []
-    for tweet in neg_tweets:
-        processed_tweet = process_tweet(tweet, stopwords_name, punctuation, tokenizer, stemmer)
-        processed_neg_tweets.append(processed_tweet)
+    # them for both files
+    tokenizer = make_tokenizer(tokenizer_backend)
+    if stemmer is None:
+        stemmer = CachingStemmer()
+
+    # stream each file through the processing steps, only the
+    # processed tweets are collected
+    processed_pos_tweets = collect(iter_processed_tweets(pos_name, stopwords, PUNCTUATION, tokenizer, stemmer, readers, dedup, stats))
+    processed_neg_tweets = collect(iter_processed_tweets(neg_name, stopwords, PUNCTUATION, tokenizer, stemmer, readers, dedup, stats))
     
     # now return the processed tweets and any used stopwords
-    return processed_pos_tweets, processed_neg_tweets, stopwords_name
+    return processed_pos_tweets, processed_neg_tweets, stopwords
+
+
+# the tokenizer and stemmer process_tweet uses when it isn't given any, made
+# on the first call and shared by every call after it
+_defaults = {}
 
+def _default_tokenizer():
+    if 'tokenizer' not in _defaults:
+        _defaults['tokenizer'] = make_tokenizer('nltk')
+    return _defaults['tokenizer']
+
+def _default_stemmer() -> CachingStemmer:
+    if 'stemmer' not in _defaults:
+        _defaults['stemmer'] = CachingStemmer()
+    return _defaults['stemmer']
 
 def process_tweet(tweet : str, 
                   stopwords: list[str],
                   punctuation = string.punctuation,
-                  tokenizer = TweetTokenizer(preserve_case = False, 
-                                             strip_handles = True,
-                                             reduce_len=True),
-                  stemmer = PorterStemmer()) -> list[str]:
+                  tokenizer = None,
+                  stemmer = None,
+                  stats : PipelineStats = None) -> list[str]:
     '''
     Processes an individual tweet, returning its stemmed version.
 
@@ -201,14 +1393,25 @@ def process_tweet(tweet : str,
         to preserving case (so that all words are converted to lowercase),
         stripping handles, and reducing the length of the tweet. Reducing
         the lenght means that any characters repeated more than 3 times will
-        be reduced to 3 characters. So Hiiiiii would be Hiii. 
+        be reduced to 3 characters. So Hiiiiii would be Hiii. The default
+        tokenizer is created on the first call that needs it.
       stemmer -- a stemmer object that takes a string and returns its stem,
         if there is one, or the same string back otherwise. The default is
-        the PorterStemmer from nltk. The object requires a stem method that
-        takes a string and returns the stem of the string.
+        a CachingStemmer wrapping the PorterStemmer from nltk, also created
+        on first use and shared between calls. The object requires a stem
+        method that takes a string and returns the stem of the string.
+      stats -- a PipelineStats to record the time and tokens of each stage
+        into, or None (the default) to skip the timing
 
     Return: a list of tokens that have been processed
     '''
+    if tokenizer is None:
+        tokenizer = _default_tokenizer()
+    if stemmer is None:
+        stemmer = _default_stemmer()
+    if stats is not None:
+        return _process_tweet_instrumented(tweet, stopwords, punctuation, tokenizer, stemmer, stats)
+
     # first cleanup the tweet
     cleaned_tweet = cleanup_tweet(tweet)
     
@@ -224,6 +1427,28 @@ def process_tweet(tweet : str,
     # and return the result
     return stemmed_tokens
 
+def _process_tweet_instrumented(tweet : str, stopwords : list[str], punctuation,
+                                tokenizer, stemmer, stats : PipelineStats) -> list[str]:
+    '''
+    process_tweet, recording the time and tokens of each stage into stats.
+    '''
+    start = time.perf_counter()
+    cleaned_tweet = cleanup_tweet(tweet)
+    cleaned = time.perf_counter()
+    token = tokenize_tweet(cleaned_tweet, tokenizer)
+    tokenized = time.perf_counter()
+    remove_stop_punc = remove_stopwords_and_punctuation(token, stopwords, punctuation)
+    filtered = time.perf_counter()
+    stemmed_tokens = stem_tweet(remove_stop_punc, stemmer)
+    done = time.perf_counter()
+
+    stats.add('cleanup', cleaned - start)
+    stats.add('tokenize', tokenized - cleaned, len(token))
+    stats.add('filter', filtered - tokenized, len(remove_stop_punc))
+    stats.add('stem', done - filtered, len(stemmed_tokens))
+    stats.add_tweet(done - start)
+    return stemmed_tokens
+
 def test_tweet_processing():
     tweets = ["I am happy", "I am sad", "RT: Hi there", "Hi #happy #sad!", "You should go to DU: https://www.du.edu!"]
     stopwords = parse_stopwords('TweetProcessor/english_stopwords.txt')
@@ -241,6 +1466,104 @@ def test_tweet_processing():
     
 
 
+def test_fast_tokenizer(pos_name : str = 'TweetProcessor/positive_tweets.json',
+                        neg_name : str = 'TweetProcessor/negative_tweets.json') -> int:
+    '''
+    Tokenize every cleaned up tweet of the positive and negative sets with
+    both the nltk and the fast tokenizer, print any tweets where they
+    disagree along with how much faster the fast tokenizer was.
+
+    Returns: the number of tweets that were tokenized differently
+    '''
+    tweets = [cleanup_tweet(tweet) for tweet in load_tweets(pos_name) + load_tweets(neg_name)]
+    nltk_tokenizer = make_tokenizer('nltk')
+    fast_tokenizer = make_tokenizer('fast')
+
+    start = time.perf_counter()
+    expected = [nltk_tokenizer.tokenize(tweet) for tweet in tweets]
+    nltk_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = [fast_tokenizer.tokenize(tweet) for tweet in tweets]
+    fast_time = time.perf_counter() - start
+
+    differences = 0
+    for tweet, nltk_toks, fast_toks in zip(tweets, expected, actual):
+        if nltk_toks != fast_toks:
+            differences += 1
+            print(f'difference in {tweet!r}:')
+            print(f'  nltk: {nltk_toks}')
+            print(f'  fast: {fast_toks}')
+
+    print(f'{differences} of {len(tweets)} tweets tokenized differently')
+    print(f'nltk: {nltk_time:.3f}s, fast: {fast_time:.3f}s, speedup {nltk_time / fast_time:.2f}x')
+    return differences
+
+def benchmark_load_tweets(pos_name : str = 'TweetProcessor/positive_tweets.json',
+                          neg_name : str = 'TweetProcessor/negative_tweets.json',
+                          scale : int = 100) -> None:
+    '''
+    Write the positive and negative tweets repeated scale times to a
+    temporary file, then time reading the text back with a json.loads per
+    line (the original load_tweets) and with each available json backend.
+    '''
+    with open(pos_name, 'rb') as file:
+        data = file.read()
+    with open(neg_name, 'rb') as file:
+        data += file.read()
+    with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as file:
+        for _ in range(scale):
+            file.write(data)
+        scaled_name = file.name
+    megabytes = len(data) * scale / 1e6
+
+    def original_load_tweets(filename):
+        with open(filename, 'r') as file:
+            return [json.loads(line)['text'] for line in file]
+
+    try:
+        start = time.perf_counter()
+        expected = original_load_tweets(scaled_name)
+        baseline = time.perf_counter() - start
+        print(f'original: {len(expected) / baseline:.0f} tweets/sec, {megabytes / baseline:.1f} MB/s')
+
+        for backend in TEXT_EXTRACTORS:
+            if backend == 'orjson' and orjson is None:
+                continue
+            start = time.perf_counter()
+            tweets = load_tweets(scaled_name, backend)
+            elapsed = time.perf_counter() - start
+            same = 'same' if tweets == expected else 'DIFFERENT'
+            print(f'{backend}: {len(tweets) / elapsed:.0f} tweets/sec, {megabytes / elapsed:.1f} MB/s, '
+                  f'speedup {baseline / elapsed:.2f}x, {same} text')
+    finally:
+        os.remove(scaled_name)
+
+def benchmark_workers(pos_name : str, neg_name : str, stopwords_name : str,
+                      max_workers : int = None) -> None:
+    '''
+    Time process_tweets with 1 up to max_workers processes and print the
+    throughput of each run, which shows how well the pool scales.
+
+    Parameters:
+    pos_name -- the file name of the positive tweet set
+    neg_name -- the file name of the negative tweet set
+    stopwords_name -- the file name of the stopwords list
+    max_workers -- the largest pool to try, defaults to the number of cores
+    '''
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    baseline = None
+    for workers in range(1, max_workers + 1):
+        start = time.perf_counter()
+        pos_tweets, neg_tweets, _ = process_tweets(pos_name, neg_name, stopwords_name, workers)
+        elapsed = time.perf_counter() - start
+        rate = (len(pos_tweets) + len(neg_tweets)) / elapsed
+        if baseline is None:
+            baseline = rate
+        print(f'workers = {workers}: {rate:.0f} tweets/sec, speedup {rate / baseline:.2f}x')
+
+
 def main():
     test_tweet_processing()
 
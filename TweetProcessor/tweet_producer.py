@@ -0,0 +1,102 @@
+'''
+File: tweet_producer.py
+Author: Lucy Kien
+
+A stand-in for the upstream tweet feed, used to try out tweet_server.py.
+It sends the lines of one or more tweet files to the server, optionally at
+a fixed rate, while reading the processed tweets back, then reports the
+throughput.
+
+Run from the repository root, for example:
+    python TweetProcessor/tweet_producer.py --tcp 127.0.0.1:8765 TweetProcessor/positive_tweets.json
+'''
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+
+async def send(writer : asyncio.StreamWriter, filenames : list[str], repeat : int,
+               rate : float) -> int:
+    '''
+    Write every line of the files to the server, repeat times over, at
+    most rate lines a second (as fast as the server accepts them when rate
+    is 0). The writing side is closed at the end so the server sees the
+    end of the input.
+
+    Returns: the number of lines sent
+    '''
+    sent = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for filename in filenames:
+            with open(filename, 'rb') as file:
+                for line in file:
+                    if not line.strip():
+                        continue
+                    writer.write(line if line.endswith(b'\n') else line + b'\n')
+                    sent += 1
+                    if rate:
+                        delay = start + sent / rate - time.perf_counter()
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                    # waits whenever the server has stopped reading
+                    await writer.drain()
+    writer.write_eof()
+    return sent
+
+
+async def receive(reader : asyncio.StreamReader, show : int) -> tuple[int, int]:
+    '''
+    Read the processed tweets until the server closes the connection,
+    printing the first show of them.
+
+    Returns: the number of processed tweets and the number of errors
+    '''
+    received = 0
+    errors = 0
+    async for line in reader:
+        result = json.loads(line)
+        if isinstance(result, dict) and 'error' in result:
+            errors += 1
+        received += 1
+        if received <= show:
+            print(result)
+    return received, errors
+
+
+async def produce(args : argparse.Namespace) -> None:
+    if args.unix:
+        reader, writer = await asyncio.open_unix_connection(args.unix)
+    else:
+        host, port = args.tcp.rsplit(':', 1)
+        reader, writer = await asyncio.open_connection(host, int(port))
+
+    start = time.perf_counter()
+    sent, (received, errors) = await asyncio.gather(
+        send(writer, args.files, args.repeat, args.rate),
+        receive(reader, args.show))
+    elapsed = time.perf_counter() - start
+    writer.close()
+
+    print(f'sent {sent} tweets, received {received} ({errors} errors) in {elapsed:.2f}s, '
+          f'{received / elapsed:.0f} tweets/sec', file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Send tweets to tweet_server.py.')
+    parser.add_argument('files', nargs='+', help='json tweet files to send')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--tcp', metavar='HOST:PORT', help='the TCP address of the server')
+    target.add_argument('--unix', metavar='PATH', help='the Unix socket of the server')
+    parser.add_argument('--repeat', type=int, default=1, help='how many times to send the files')
+    parser.add_argument('--rate', type=float, default=0, help='tweets per second, 0 for no limit')
+    parser.add_argument('--show', type=int, default=5, help='how many processed tweets to print')
+    args = parser.parse_args()
+    asyncio.run(produce(args))
+
+
+if __name__ == '__main__':
+    main()
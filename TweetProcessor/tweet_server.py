@@ -0,0 +1,270 @@
+'''
+File: tweet_server.py
+Author: Lucy Kien
+
+An asyncio front end for live tweet processing. Tweets arrive as one json
+object per line over a local TCP socket, a Unix socket or stdin, and each
+processed tweet is written back as a json list of tokens on its own line,
+in the same order the tweets arrived.
+
+The CPU-bound processing runs in a process pool. The tweets of each
+connection pass through a bounded queue of in-flight batches; when it's
+full the server stops reading from the connection, so a burst of traffic
+is pushed back to the sender instead of piling up in memory.
+
+Run from the repository root, for example:
+    python TweetProcessor/tweet_server.py --tcp 127.0.0.1:8765
+and send it tweets with tweet_producer.py.
+'''
+
+import os
+import sys
+import json
+import stat
+import shutil
+import asyncio
+import threading
+import multiprocessing
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import tweet_processor as tp
+
+# the largest line the server will read, tweets with all their metadata
+# can be well over asyncio's default of 64KB
+LINE_LIMIT = 1 << 20
+
+# the pipeline of each pool worker, built once by _init_worker
+_pipeline = None
+
+def _init_worker(stopwords_name : str, tokenizer_backend : str) -> None:
+    '''
+    Pool initializer that builds the worker's TweetPipeline.
+    '''
+    global _pipeline
+    _pipeline = tp.TweetPipeline(tp.parse_stopwords(stopwords_name),
+                                 tokenizer=tp.make_tokenizer(tokenizer_backend))
+
+def _process_lines(lines : list[bytes]) -> list[bytes]:
+    '''
+    Process a batch of lines of json inside a pool worker, returning the
+    output line for each one: the json list of tokens, or a json object
+    with an error for a line that couldn't be processed.
+    '''
+    extract = tp.get_text_extractor()
+    output = []
+    for line in lines:
+        try:
+            result = _pipeline.process(extract(line))
+        except (ValueError, KeyError, TypeError) as error:
+            result = {'error': f'{type(error).__name__}: {error}'}
+        output.append(json.dumps(result).encode('utf-8') + b'\n')
+    return output
+
+
+class TweetServer:
+    '''
+    Reads tweets from streams, processes them in a process pool and writes
+    the tokens back out.
+    '''
+
+    def __init__(self, executor : ProcessPoolExecutor, batch_size : int = 100,
+                 batch_timeout : float = 0.005, max_pending : int = 8):
+        '''
+        Parameters:
+          executor -- a process pool set up with _init_worker
+          batch_size -- the most tweets sent to a worker at a time
+          batch_timeout -- seconds to wait for more tweets before sending
+            a batch that isn't full
+          max_pending -- the most batches of a connection in flight at
+            once, reading stops while this many are pending
+        '''
+        self.executor = executor
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.max_pending = max_pending
+
+    async def _read_batch(self, reader : asyncio.StreamReader) -> list[bytes]:
+        '''
+        Wait for a line, then gather more until the batch is full or no
+        line arrives within batch_timeout. An empty batch means the input
+        has ended.
+        '''
+        batch = []
+        line = await reader.readline()
+        while line:
+            if line.strip():
+                batch.append(line)
+            if len(batch) >= self.batch_size:
+                break
+            try:
+                line = await asyncio.wait_for(reader.readline(), self.batch_timeout)
+            except asyncio.TimeoutError:
+                if batch:
+                    break
+                line = await reader.readline()
+        return batch
+
+    async def handle(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter) -> None:
+        '''
+        Process every tweet of one stream. The reading side submits batches
+        to the pool and queues their futures, the writing side waits on
+        them in order, so the queue bound limits how far reading can get
+        ahead of writing.
+        '''
+        loop = asyncio.get_running_loop()
+        pending = asyncio.Queue(maxsize=self.max_pending)
+
+        async def read_side():
+            cancelled = False
+            try:
+                while True:
+                    batch = await self._read_batch(reader)
+                    if not batch:
+                        break
+                    await pending.put(loop.run_in_executor(self.executor, _process_lines, batch))
+            except asyncio.CancelledError:
+                # the writing side has stopped, nothing would take the end
+                # marker off a full queue
+                cancelled = True
+                raise
+            finally:
+                if not cancelled:
+                    await pending.put(None)
+
+        async def write_side():
+            while True:
+                future = await pending.get()
+                if future is None:
+                    break
+                writer.writelines(await future)
+                await writer.drain()
+
+        reading = asyncio.create_task(read_side())
+        try:
+            await write_side()
+            await reading
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except ValueError as error:
+            # a line longer than LINE_LIMIT
+            print(f'dropping connection: {error}', file=sys.stderr)
+        finally:
+            reading.cancel()
+            try:
+                await reading
+            except (asyncio.CancelledError, Exception):
+                pass
+            # the batches no one will write, those not started yet are dropped
+            while not pending.empty():
+                future = pending.get_nowait()
+                if future is not None:
+                    future.cancel()
+            writer.close()
+
+
+def _as_pipe(file, reading : bool):
+    '''
+    asyncio only connects pipes, sockets and character devices, so when
+    file is a regular file (stdin or stdout redirected to a file) a thread
+    copies it through a pipe instead. The thread's blocking writes to the
+    pipe keep the same backpressure.
+
+    Returns: a file for asyncio to use, and the copying thread or None
+    '''
+    mode = os.fstat(file.fileno()).st_mode
+    if stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode) or stat.S_ISCHR(mode):
+        return file, None
+    read_fd, write_fd = os.pipe()
+    if reading:
+        source, target, piped = file.buffer, os.fdopen(write_fd, 'wb'), os.fdopen(read_fd, 'rb')
+    else:
+        source, target, piped = os.fdopen(read_fd, 'rb'), file.buffer, os.fdopen(write_fd, 'wb')
+
+    def copy():
+        with source:
+            shutil.copyfileobj(source, target)
+        if reading:
+            target.close()
+        else:
+            target.flush()
+
+    thread = threading.Thread(target=copy, daemon=True)
+    thread.start()
+    return piped, thread
+
+async def open_stdio() -> tuple[asyncio.StreamReader, asyncio.StreamWriter, list[threading.Thread]]:
+    '''
+    Wrap stdin and stdout in asyncio streams.
+
+    Returns: the reader, the writer, and any copying threads to wait for
+    once the writer is closed
+    '''
+    loop = asyncio.get_running_loop()
+    stdin, stdin_thread = _as_pipe(sys.stdin, reading=True)
+    stdout, stdout_thread = _as_pipe(sys.stdout, reading=False)
+    reader = asyncio.StreamReader(limit=LINE_LIMIT)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), stdin)
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, stdout)
+    writer = asyncio.StreamWriter(transport, protocol, None, loop)
+    return reader, writer, [thread for thread in (stdin_thread, stdout_thread) if thread]
+
+
+async def serve(args : argparse.Namespace) -> None:
+    '''
+    Start the pool and serve the stream, or streams, named by args.
+    '''
+    # forked workers would inherit the connections and pipes open at the
+    # time, which then never see end of file, so start them from a clean
+    # forkserver process where it exists
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else None)
+    with ProcessPoolExecutor(args.workers, mp_context=context, initializer=_init_worker,
+                             initargs=(args.stopwords, args.tokenizer)) as executor:
+        server = TweetServer(executor, args.batch_size, args.batch_timeout, args.max_pending)
+        if args.stdin:
+            reader, writer, threads = await open_stdio()
+            await server.handle(reader, writer)
+            for thread in threads:
+                # the stdout thread still has the last output to copy, it
+                # ends once the closed writer has flushed the pipe
+                await asyncio.to_thread(thread.join)
+            return
+        if args.unix:
+            listener = await asyncio.start_unix_server(server.handle, args.unix, limit=LINE_LIMIT)
+        else:
+            host, port = args.tcp.rsplit(':', 1)
+            listener = await asyncio.start_server(server.handle, host, int(port), limit=LINE_LIMIT)
+        async with listener:
+            names = ', '.join(str(sock.getsockname()) for sock in listener.sockets)
+            print(f'processing tweets on {names}', file=sys.stderr)
+            await listener.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Process tweets streamed over a socket or stdin.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--tcp', metavar='HOST:PORT', help='listen on a local TCP port')
+    source.add_argument('--unix', metavar='PATH', help='listen on a Unix socket')
+    source.add_argument('--stdin', action='store_true', help='read tweets from stdin, write to stdout')
+    parser.add_argument('--stopwords', default='TweetProcessor/english_stopwords.txt',
+                        help='the stopwords file')
+    parser.add_argument('--tokenizer', choices=tp.TOKENIZER_BACKENDS, default='nltk',
+                        help='the tokenizer backend')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='the number of processes in the pool')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='the most tweets sent to a worker at a time')
+    parser.add_argument('--batch-timeout', type=float, default=0.005,
+                        help='seconds to wait to fill a batch')
+    parser.add_argument('--max-pending', type=int, default=8,
+                        help='the most batches of a connection in flight before reading pauses')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()